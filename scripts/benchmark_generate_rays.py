@@ -0,0 +1,71 @@
+"""
+This script measures the per-photo cost of generating color projection rays,
+comparing the original per-pixel Python loop to the array-based
+implementation in MeshColorSource.generate_rays.
+
+Usage: python -m scripts.benchmark_generate_rays [width] [height] [repeat]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from PIL import Image
+
+from server.mapping2.scene import MeshColorSource
+
+
+def loop_ray_directions(width, height, fx, fy):
+    cx = 0.5 * width
+    cy = 0.5 * height
+
+    directions = np.ones((width * height, 3))
+    i = 0
+    for y in range(height):
+        for x in range(width):
+            directions[i, 0] = (x - cx) / fx
+            directions[i, 1] = (cy - y) / fy
+            i += 1
+
+    return directions
+
+
+def time_call(func, repeat):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return min(durations), result
+
+
+if __name__ == "__main__":
+    width = int(sys.argv[1]) if len(sys.argv) >= 2 else 1920
+    height = int(sys.argv[2]) if len(sys.argv) >= 3 else 1080
+    repeat = int(sys.argv[3]) if len(sys.argv) >= 4 else 3
+
+    pixels = np.random.randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+    rotation = np.eye(3)
+    position = np.zeros(3)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "photo.png")
+        Image.fromarray(pixels).save(path)
+
+        source = MeshColorSource(0, path, (0.5, 0.5), position, rotation)
+
+        load_time, _ = time_call(source.load_image, repeat)
+        loop_time, expected = time_call(lambda: loop_ray_directions(width, height, 0.5 * width, 0.5 * height), 1)
+        f64_time, (_, directions, _) = time_call(lambda: source.generate_rays(), repeat)
+        f32_time, _ = time_call(lambda: source.generate_rays(dtype=np.float32), repeat)
+
+    assert np.array_equal(directions, expected)
+
+    print("Image size: {}x{} ({} rays)".format(width, height, width * height))
+    print("Image load:                  {:.3f} s".format(load_time))
+    print("Python loop (directions):    {:.3f} s".format(loop_time))
+    print("generate_rays (float64):     {:.3f} s".format(f64_time))
+    print("generate_rays (float32):     {:.3f} s".format(f32_time))
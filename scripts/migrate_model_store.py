@@ -0,0 +1,56 @@
+"""
+This script converts pickled location models (model.pickle and
+colored.pickle) in a data directory to the array-based model store format.
+The mapping and modeling tasks do this conversion on their next run, but
+migrating ahead of time avoids paying the pickle load cost on the first map
+update after an upgrade.
+
+The original pickle files are left in place unless --remove is given.
+
+Usage: python -m scripts.migrate_model_store [--remove] [data_dir]
+"""
+
+import os
+import sys
+
+from server.mapping2.scene import LocationModel
+
+
+MIGRATIONS = [
+    ("model.pickle", "model_store"),
+    ("colored.pickle", "colored_store"),
+]
+
+
+def migrate_location(location_dir, remove=False):
+    for pickle_name, store_name in MIGRATIONS:
+        pickle_path = os.path.join(location_dir, pickle_name)
+        store_path = os.path.join(location_dir, store_name)
+
+        if not os.path.exists(pickle_path) or os.path.exists(store_path):
+            continue
+
+        print("Migrate {} to {}".format(pickle_path, store_path))
+        model = LocationModel.from_pickle(pickle_path)
+        model.save_store(store_path)
+
+        if remove:
+            os.remove(pickle_path)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    remove = "--remove" in args
+    if remove:
+        args.remove("--remove")
+
+    data_dir = args[0] if len(args) > 0 else "data"
+
+    locations_dir = os.path.join(data_dir, "locations")
+    if not os.path.isdir(locations_dir):
+        print("No locations directory found in {}".format(data_dir))
+        sys.exit(1)
+
+    for name in sorted(os.listdir(locations_dir)):
+        migrate_location(os.path.join(locations_dir, name), remove=remove)
@@ -133,6 +133,8 @@ async def create_openapi_spec(app, base_url=None):
         spec.path(view=locations.get_location_qrcode)
         spec.path(view=locations.get_location_model)
         spec.path(view=locations.get_location_route)
+        spec.path(view=locations.get_location_routes)
+        spec.path(view=other.get_navigator_metrics)
 
         spec.path(view=map_paths.list_map_paths)
         spec.path(view=map_paths.create_map_path)
@@ -158,6 +160,7 @@ async def create_openapi_spec(app, base_url=None):
         spec.path(view=pose_changes.create_pose_change)
 
         spec.path(view=surfaces.list_surfaces)
+        spec.path(view=surfaces.list_surface_changes)
         spec.path(view=surfaces.clear_surfaces)
         spec.path(view=surfaces.delete_surface)
         spec.path(view=surfaces.get_surface)
@@ -27,6 +27,10 @@ from .models import DeviceConfiguration, DeviceConfigurationSchema, Location, Lo
 # would instruct browsers to cache the file for 12 hours.
 MODEL_OBJ_MAX_AGE = 60
 
+# Media type for binary glTF models, which clients can request instead of
+# OBJ through the Accept header.
+MODEL_GLB_MIMETYPE = "model/gltf-binary"
+
 
 locations = Blueprint("locations", __name__)
 
@@ -38,6 +42,63 @@ def get_location_dir(location_id):
     return os.path.join(g.data_dir, 'locations', location_id.hex)
 
 
+def prefers_glb():
+    """
+    Check whether the client asked for a binary glTF model over OBJ.
+    """
+    return request.accept_mimetypes.best_match(["model/obj", MODEL_GLB_MIMETYPE]) == MODEL_GLB_MIMETYPE
+
+
+def get_lod():
+    lod = request.args.get("lod", 0, type=int)
+    if lod < 0:
+        raise exceptions.BadRequest(description="Level of detail must be a non-negative integer")
+    return lod
+
+
+def find_model_file(location_dir, base_name, lod=0, use_glb=False, min_mtime=None):
+    """
+    Find the best available model file.
+
+    Files for the requested level of detail are preferred over the full
+    resolution model, and GLB is preferred over OBJ if use_glb is set.
+    Files older than min_mtime are ignored.
+
+    Returns the file name or None.
+    """
+    extensions = [".glb", ".obj"] if use_glb else [".obj"]
+
+    names = []
+    if lod > 0:
+        names.extend("{}-lod{}{}".format(base_name, lod, ext) for ext in extensions)
+    names.extend(base_name + ext for ext in extensions)
+
+    for name in names:
+        path = os.path.join(location_dir, name)
+        if os.path.exists(path) and (min_mtime is None or os.path.getmtime(path) >= min_mtime):
+            return name
+
+    return None
+
+
+async def send_model_file(location_dir, source_file_name, attachment_filename):
+    """
+    Send a model file with support for ETag and Range requests.
+
+    The response depends on the Accept header, so caches are told to vary
+    on it.
+    """
+    mimetype = None
+    if source_file_name.endswith(".glb"):
+        mimetype = MODEL_GLB_MIMETYPE
+
+    response = await send_from_directory(location_dir, source_file_name,
+            mimetype=mimetype, as_attachment=True, attachment_filename=attachment_filename,
+            cache_timeout=MODEL_OBJ_MAX_AGE, conditional=True)
+    response.vary.add("Accept")
+    return response
+
+
 @locations.route('/locations', methods=['GET'])
 async def list_locations():
     """
@@ -422,11 +483,23 @@ async def get_location_model(location_id):
             in: path
             required: true
             description: Location ID
+          - name: lod
+            in: query
+            required: false
+            description: |-
+                Level of detail, where 0 (default) is the full resolution
+                model and each higher level is further simplified. Falls
+                back to the full resolution model if the level is not
+                available.
         responses:
             200:
-                description: An object model file.
+                description: |-
+                    An object model file. Binary glTF is returned instead
+                    if the Accept header prefers it and the model is available
+                    in that format.
                 content:
                     model/obj: {}
+                    model/gltf-binary: {}
     """
     stmt = sa.select(Location) \
             .where(Location.id == location_id) \
@@ -438,17 +511,23 @@ async def get_location_model(location_id):
         raise exceptions.NotFound(description="Location {} was not found".format(location_id))
 
     location_dir = get_location_dir(location_id)
+    use_glb = prefers_glb()
+    lod = get_lod()
 
     # If caller requested a colored model, preferentially return that if available.
     # Otherwise, fall back to ordinary OBJ file.
     colored = request.args.get("colored")
     if colored is not None:
-        obj_path = os.path.join(location_dir, "colored.obj")
-        if os.path.exists(obj_path):
-            source_file_name = "colored.obj"
-            return await send_from_directory(location_dir, source_file_name,
-                    as_attachment=True, attachment_filename="model.obj",
-                    cache_timeout=MODEL_OBJ_MAX_AGE)
+        source_file_name = find_model_file(location_dir, "colored", lod, use_glb)
+        if source_file_name is not None:
+            return await send_model_file(location_dir, source_file_name, "model" + os.path.splitext(source_file_name)[1])
+
+    # The GLB and simplified files are only written by the mapping task, so
+    # fall back to OBJ if they are missing or older than the location.
+    if use_glb or lod > 0:
+        source_file_name = find_model_file(location_dir, "model", lod, use_glb, min_mtime=location.updated_time.timestamp())
+        if source_file_name is not None and source_file_name != "model.obj":
+            return await send_model_file(location_dir, source_file_name, "model" + os.path.splitext(source_file_name)[1])
 
     source_file_name = "model.obj"
     obj_path = os.path.join(location_dir, source_file_name)
@@ -457,9 +536,7 @@ async def get_location_model(location_id):
         future = current_app.modeling_pool.submit(obj_maker.make_obj)
         await asyncio.wrap_future(future)
 
-    return await send_from_directory(location_dir, source_file_name,
-            as_attachment=True, attachment_filename="model.obj",
-            cache_timeout=MODEL_OBJ_MAX_AGE)
+    return await send_model_file(location_dir, source_file_name, "model.obj")
 
 
 @locations.route('/locations/<uuid:location_id>/colored.obj', methods=['GET'])
@@ -476,11 +553,22 @@ async def get_colored_model(location_id):
             in: path
             required: true
             description: Location ID
+          - name: lod
+            in: query
+            required: false
+            description: |-
+                Level of detail, where 0 (default) is the full resolution
+                model and each higher level is further simplified. Falls
+                back to the full resolution model if the level is not
+                available.
         responses:
             200:
-                description: An object model file.
+                description: |-
+                    An object model file. Binary glTF is returned instead
+                    if the Accept header prefers it and it is available.
                 content:
                     model/obj: {}
+                    model/gltf-binary: {}
     """
     stmt = sa.select(Location) \
             .where(Location.id == location_id) \
@@ -492,11 +580,12 @@ async def get_colored_model(location_id):
         raise exceptions.NotFound(description="Location {} was not found".format(location_id))
 
     location_dir = get_location_dir(location_id)
-    obj_path = os.path.join(location_dir, "colored.obj")
 
-    return await send_from_directory(location_dir, "colored.obj",
-            as_attachment=True, attachment_filename="colored.obj",
-            cache_timeout=MODEL_OBJ_MAX_AGE)
+    source_file_name = find_model_file(location_dir, "colored", get_lod(), prefers_glb())
+    if source_file_name is None:
+        source_file_name = "colored.obj"
+
+    return await send_model_file(location_dir, source_file_name, "colored" + os.path.splitext(source_file_name)[1])
 
 
 @locations.route('/locations/<uuid:location_id>/route', methods=['GET'])
@@ -563,7 +652,10 @@ async def get_location_route(location_id):
     except:
         raise exceptions.BadRequest("Invalid starting or destination point")
 
-    path = current_app.mapper.find_path(location_id, start, end)
+    # Path finding may need to load the navigation mesh, so run it in a
+    # worker thread to avoid blocking other requests.
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(current_app.thread_pool, current_app.mapper.find_path, location_id, start, end)
 
     output = []
     for point in path:
@@ -577,3 +669,96 @@ async def get_location_route(location_id):
         result = output
 
     return jsonify(result), HTTPStatus.OK
+
+
+@locations.route('/locations/<uuid:location_id>/routes', methods=['GET'])
+async def get_location_routes(location_id):
+    """
+    Get routes from several points to a common destination.
+    ---
+    get:
+        summary: Get routes from several points to a common destination.
+        description: |-
+            This method uses the location map to find a path from each of the
+            starting points to the same destination, for example when several
+            users are navigating to the same marker. It is more efficient than
+            querying each route separately.
+
+            The following example queries for paths from coordinates (-2, 0, 7.5)
+            and (4, 0, 1) to (22, 0, 9.5).
+
+                GET /locations/224c17c4-dd9a-4d62-a075-61f57438a209/routes?from=-2,0,7.5&from=4,0,1&to=22,0,9.5
+
+            The response will be a list of routes in the same order as the
+            starting points, where each route is a list of waypoints.
+
+                200 OK
+                Content-Type: application/json
+                [
+                    [
+                        {"x": -2.0, "y": 0.0, "z": 7.5},
+                        {"x": 22.0, "y": 0.0, "z": 9.5}
+                    ],
+                    [
+                        {"x": 4.0, "y": 0.0, "z": 1.0},
+                        {"x": 22.0, "y": 0.0, "z": 9.5}
+                    ]
+                ]
+        tags:
+          - locations
+        parameters:
+          - name: id
+            in: path
+            required: true
+            description: Location ID
+          - name: envelope
+            in: query
+            required: false
+            description: If set, the returned list will be wrapped in an envelope with this name.
+          - name: from
+            in: query
+            required: true
+            description: Starting point in comma-separated format (x,y,z), may be repeated
+          - name: to
+            in: query
+            required: false
+            description: Ending point in comma-separated format (x,y,z)
+        responses:
+            200:
+                description: A list of paths, each consisting of a list of points.
+                content:
+                    application/json:
+                        schema:
+                            type: array
+                            items:
+                                type: array
+                                items: Vector3f
+    """
+    query = request.args
+
+    def get_vector(value):
+        return [float(v) for v in value.split(",")]
+
+    try:
+        starts = [get_vector(value) for value in query.getlist("from")]
+        end = get_vector(query.get("to", "0,0,0"))
+    except:
+        raise exceptions.BadRequest("Invalid starting or destination point")
+
+    if len(starts) == 0:
+        raise exceptions.BadRequest("At least one starting point is required")
+
+    loop = asyncio.get_running_loop()
+    paths = await loop.run_in_executor(current_app.thread_pool, current_app.mapper.find_paths, location_id, starts, end)
+
+    output = []
+    for path in paths:
+        output.append([dict(zip(("x", "y", "z"), point)) for point in path])
+
+    # Wrap the list if the caller requested an envelope.
+    if "envelope" in query:
+        result = {query.get("envelope"): output}
+    else:
+        result = output
+
+    return jsonify(result), HTTPStatus.OK
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import tempfile
 
@@ -164,6 +165,15 @@ async def before_first_request():
     await initialize_photo_queues(app)
 
 
+@app.after_serving
+async def after_serving():
+    # Write any floor grid changes that are waiting for the save interval.
+    navigator = getattr(app, "navigator", None)
+    if navigator is not None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, navigator.flush)
+
+
 @app.before_request
 async def before_request():
     g.data_dir = data_dir
@@ -1,10 +1,165 @@
 import collections
 import heapq
 
+import numba
 import numpy as np
 from PIL import Image
 
 
+@numba.njit(cache=True)
+def heap_less(heap_f, heap_r, heap_c, i, j):
+    """
+    Order heap entries by f-score and then by cell, like (f, (r, c)) tuples.
+    """
+    if heap_f[i] != heap_f[j]:
+        return heap_f[i] < heap_f[j]
+    if heap_r[i] != heap_r[j]:
+        return heap_r[i] < heap_r[j]
+    return heap_c[i] < heap_c[j]
+
+
+@numba.njit(cache=True)
+def heap_swap(heap_f, heap_r, heap_c, i, j):
+    heap_f[i], heap_f[j] = heap_f[j], heap_f[i]
+    heap_r[i], heap_r[j] = heap_r[j], heap_r[i]
+    heap_c[i], heap_c[j] = heap_c[j], heap_c[i]
+
+
+@numba.njit(cache=True)
+def a_star_kernel(passable, cost, start_r, start_c, end_r, end_c, step):
+    """
+    Compiled A* search over dense passability and cost grids.
+
+    This follows the same steps as the DataGrid.a_star slow path, including
+    the order in which ties are broken, so that both produce the same
+    route. The start cell must be inside the grid.
+
+    Returns an (N, 2) array with the cells of the path from start to end, or
+    an empty array if there is no path.
+    """
+    H, W = passable.shape
+
+    g_score = np.full((H, W), np.inf)
+    closed = np.zeros((H, W), dtype=np.bool_)
+    came_from = np.full((H, W), -1, dtype=np.int64)
+
+    capacity = 1024
+    heap_f = np.empty(capacity)
+    heap_r = np.empty(capacity, dtype=np.int64)
+    heap_c = np.empty(capacity, dtype=np.int64)
+    size = 0
+
+    direction_r = np.array([-1, 0, 1, 0])
+    direction_c = np.array([0, 1, 0, -1])
+    diagonal_r = np.array([-1, 1, 1, -1])
+    diagonal_c = np.array([1, 1, -1, -1])
+    diagonal_step = np.sqrt(2.0) * step
+    reachable = np.zeros(4, dtype=np.bool_)
+
+    g_score[start_r, start_c] = 0.0
+    heap_f[0] = step * np.sqrt(float((start_r - end_r)**2 + (start_c - end_c)**2))
+    heap_r[0] = start_r
+    heap_c[0] = start_c
+    size = 1
+
+    found = False
+    while size > 0:
+        # Pop the smallest entry and restore the heap.
+        r = heap_r[0]
+        c = heap_c[0]
+        size -= 1
+        if size > 0:
+            heap_swap(heap_f, heap_r, heap_c, 0, size)
+            i = 0
+            while True:
+                smallest = i
+                left = 2 * i + 1
+                right = left + 1
+                if left < size and heap_less(heap_f, heap_r, heap_c, left, smallest):
+                    smallest = left
+                if right < size and heap_less(heap_f, heap_r, heap_c, right, smallest):
+                    smallest = right
+                if smallest == i:
+                    break
+                heap_swap(heap_f, heap_r, heap_c, i, smallest)
+                i = smallest
+
+        if r == end_r and c == end_c:
+            found = True
+            break
+
+        closed[r, c] = True
+
+        for k in range(8):
+            if k < 4:
+                nr = r + direction_r[k]
+                nc = c + direction_c[k]
+                neighbors_g = g_score[r, c] + step
+            else:
+                nr = r + diagonal_r[k - 4]
+                nc = c + diagonal_c[k - 4]
+                neighbors_g = g_score[r, c] + diagonal_step
+
+            if nr < 0 or nr >= H or nc < 0 or nc >= W or closed[nr, nc] or not passable[nr, nc]:
+                if k < 4:
+                    reachable[k] = False
+                continue
+
+            if k < 4:
+                reachable[k] = True
+            elif not (reachable[k - 4] and reachable[(k - 3) % 4]):
+                # Only move diagonally if both adjacent cells are reachable.
+                continue
+
+            tentative_g = neighbors_g + cost[nr, nc]
+            if tentative_g < g_score[nr, nc]:
+                g_score[nr, nc] = tentative_g
+                came_from[nr, nc] = r * W + c
+
+                if size == capacity:
+                    capacity *= 2
+                    heap_f = np.concatenate((heap_f, np.empty(size)))
+                    heap_r = np.concatenate((heap_r, np.empty(size, dtype=np.int64)))
+                    heap_c = np.concatenate((heap_c, np.empty(size, dtype=np.int64)))
+
+                # Push the new entry and restore the heap.
+                heap_f[size] = tentative_g + step * np.sqrt(float((nr - end_r)**2 + (nc - end_c)**2))
+                heap_r[size] = nr
+                heap_c[size] = nc
+                i = size
+                size += 1
+                while i > 0:
+                    parent = (i - 1) // 2
+                    if not heap_less(heap_f, heap_r, heap_c, i, parent):
+                        break
+                    heap_swap(heap_f, heap_r, heap_c, i, parent)
+                    i = parent
+
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+
+    length = 1
+    r = end_r
+    c = end_c
+    while r != start_r or c != start_c:
+        index = came_from[r, c]
+        r = index // W
+        c = index % W
+        length += 1
+
+    path = np.empty((length, 2), dtype=np.int64)
+    r = end_r
+    c = end_c
+    for i in range(length - 1, -1, -1):
+        path[i, 0] = r
+        path[i, 1] = c
+        index = came_from[r, c]
+        r = index // W
+        c = index % W
+
+    return path
+
+
 class DataGrid:
     """
     Generic data structure that stores values in a dense grid.
@@ -131,11 +286,75 @@ class DataGrid:
 
         return np.min(self.data[zi, xi])
 
-    def a_star(self, a, b, cost=None, passable=None):
+    def a_star(self, a, b, cost=None, passable=None, engine=None):
+        """
+        Find a path between two points with A* search.
+
+        The passable and cost arguments may be functions of (cell, value) or
+        arrays with the same shape as the grid. With arrays, or with the
+        ones_passable and zero_passable functions, the search runs in a
+        compiled kernel. Other functions use the slower Python search, which
+        can also be selected with engine="python".
+
+        Returns a list of (x, z) points or None if there is no path.
+        """
+        if passable is None:
+            passable = self.ones_passable
+
+        # These functions only depend on the cell value, so they can be
+        # evaluated over the whole grid.
+        if passable is self.ones_passable or passable is self.zero_passable:
+            passable = passable(None, self.data)
+
+        if engine is None:
+            engine = "numba" if isinstance(passable, np.ndarray) and (cost is None or isinstance(cost, np.ndarray)) else "python"
+
+        if engine == "numba":
+            return self.a_star_compiled(a, b, cost=cost, passable=passable)
+        else:
+            return self.a_star_python(a, b, cost=cost, passable=passable)
+
+    def a_star_compiled(self, a, b, cost=None, passable=None):
+        """
+        A* search using the compiled kernel with passable and cost arrays.
+        """
+        start = self.xyz_to_index(a)
+        end = self.xyz_to_index(b)
+
+        # The kernel needs the start cell inside the grid. Leave the unusual
+        # case of starting outside the grid to the Python search.
+        if start not in self:
+            return self.a_star_python(a, b, cost=cost, passable=passable)
+
+        if cost is None:
+            cost = np.zeros((self.H, self.W))
+
+        passable = np.ascontiguousarray(passable, dtype=np.bool_)
+        cost = np.ascontiguousarray(cost, dtype=np.float64)
+
+        cells = a_star_kernel(passable, cost, start[0], start[1], end[0], end[1], float(self.step))
+        if len(cells) == 0:
+            return None
+
+        path = [self.index_to_xz(tuple(cell)) for cell in cells]
+        return self.douglas_peucker_path_smoothing(path)
+
+    def a_star_python(self, a, b, cost=None, passable=None):
+        """
+        A* search in Python, with passable and cost given as functions of
+        (cell, value) or as arrays.
+        """
         if cost is None:
             cost = lambda cell, value: 0
+        elif isinstance(cost, np.ndarray):
+            cost_grid = cost
+            cost = lambda cell, value: cost_grid[cell]
+
         if passable is None:
             passable = self.ones_passable
+        elif isinstance(passable, np.ndarray):
+            passable_grid = passable
+            passable = lambda cell, value: passable_grid[cell]
 
         a = self.xyz_to_index(a)
         b = self.xyz_to_index(b)
@@ -366,8 +585,13 @@ class DataGrid:
         """
         Load grid object from a numpy npz file
         """
-        npz = np.load(path)
+        return cls.from_npz(np.load(path))
 
+    @classmethod
+    def from_npz(cls, npz):
+        """
+        Create grid object from the arrays of a loaded npz file
+        """
         grid = cls()
         grid.data = npz['data']
 
@@ -3,7 +3,6 @@ import json
 import math
 import os
 
-import networkx as nx
 import numpy as np
 import svgwrite
 
@@ -21,44 +20,100 @@ def calculate_dot_plane(points, headset_position, plane_normal):
     the point (at least twice).
     """
     plane = np.dot(headset_position, plane_normal)
-
-    pdotplane = []
-    for p in points:
-        pdotplane.append(np.dot(p, plane_normal) - plane)
-
-    return pdotplane
+    return np.dot(np.asarray(points, dtype=float).reshape(-1, 3), plane_normal) - plane
 
 
 def lp_intersect(p0, p1, p_co, p_no, epsilon=1e-6):
     """
-    p0, p1: Define the line.
+    p0, p1: Define the lines, one per row.
     p_co, p_no: define the plane:
         p_co Is a point on the plane (plane coordinate).
         p_no Is a normal vector defining the plane direction;
              (does not need to be normalized).
 
-    Return a Vector or None (when the intersection can't be found).
+    Return an array with the intersection point of each line. Lines that are
+    parallel to the plane have no single intersection point, and p0 is
+    returned for them.
     """
+    p0 = np.asarray(p0, dtype=float).reshape(-1, 3)
+    p1 = np.asarray(p1, dtype=float).reshape(-1, 3)
 
-    u = np.subtract(p1, p0)
-    dot = np.dot(p_no, u)
+    u = p1 - p0
+    dot = np.dot(u, p_no)
 
     # In this case, epsilon is an error bound of some type where if the dot product is close to 0 (difference < epsilon)
     # , then the point and plane are parallel
+    parallel = np.abs(dot) <= epsilon
+
+    # The factor of the point between p0 -> p1 (0 - 1)
+    # if 'fac' is between (0 - 1) the point intersects with the segment.
+    # Otherwise:
+    #  < 0.0: behind p0.
+    #  > 1.0: infront of p1.
+    w = p0 - np.asarray(p_co, dtype=float)
+    fac = np.zeros(len(p0))
+    fac[~parallel] = -1 * np.dot(w[~parallel], p_no) / dot[~parallel]
+
+    return p0 + u * fac[:, np.newaxis]
+
+
+def chain_segments(segments, num_nodes):
+    """
+    Join line segments that share end points into chains.
 
-    if abs(dot) > epsilon:
-        # The factor of the point between p0 -> p1 (0 - 1)
-        # if 'fac' is between (0 - 1) the point intersects with the segment.
-        # Otherwise:
-        #  < 0.0: behind p0.
-        #  > 1.0: infront of p1.
-        w = np.subtract(p0, p_co)
-        fac = -1 * np.dot(p_no, w) / dot
-        u = u * fac
-        return np.add(p0, u)
+    segments: array of node index pairs.
 
-    # The segment is parallel to plane.
-    return None
+    Returns a list of node index lists. Each chain is walked from an end point
+    until it reaches another end point or a node where more than two segments
+    meet. Closed loops repeat their first node at the end. Every segment is
+    visited once, so this takes linear time.
+    """
+    segments = np.asarray(segments, dtype=int).reshape(-1, 2)
+
+    # Compressed adjacency lists: the segments touching node n are
+    # incident_segments[offsets[n]:offsets[n+1]].
+    ends = segments.reshape(-1)
+    order = np.argsort(ends, kind='stable')
+    offsets = np.searchsorted(ends[order], np.arange(num_nodes + 1)).tolist()
+    incident_segments = (order // 2).tolist()
+    degree = np.bincount(ends, minlength=num_nodes).tolist()
+    pairs = segments.tolist()
+
+    used = [False] * len(pairs)
+
+    def walk(node):
+        chain = [node]
+        while True:
+            for k in range(offsets[node], offsets[node+1]):
+                segment = incident_segments[k]
+                if not used[segment]:
+                    break
+            else:
+                return chain
+
+            used[segment] = True
+            a, b = pairs[segment]
+            node = b if a == node else a
+            chain.append(node)
+
+            if degree[node] != 2:
+                return chain
+
+    chains = []
+
+    # Open chains start and end at nodes that do not have exactly two
+    # segments. A branching node may start several chains.
+    for node in range(num_nodes):
+        if degree[node] != 2:
+            while offsets[node] < offsets[node+1] and not all(used[incident_segments[k]] for k in range(offsets[node], offsets[node+1])):
+                chains.append(walk(node))
+
+    # Any segments left over form closed loops.
+    for segment, (a, b) in enumerate(pairs):
+        if not used[segment]:
+            chains.append(walk(a))
+
+    return chains
 
 
 class Floorplanner:
@@ -85,80 +140,42 @@ class Floorplanner:
         }
 
     def calculate_intersections(self, mesh, headset_position=[0, 0, 0], vector_normal=[0, 1, 0], json_serialize=False):
-        points = np.asarray(mesh.vertices)
-        triangles = np.asarray(mesh.triangles)
-
-        paths = []
-
-        # We will construct a graph, where each node represents an intersection
-        # point along the edge of a triangle. Each triangle should have two
-        # intersection points, which will be connected by an edge in the graph,
-        # and later, a line segment in the map.
-        graph = nx.Graph()
+        points = np.asarray(mesh.vertices, dtype=float).reshape(-1, 3)
+        triangles = np.asarray(mesh.triangles, dtype=int).reshape(-1, 3)
 
         pdotplane = calculate_dot_plane(points, headset_position, vector_normal)
 
-        # iterate through list of triangle arrays
-        # triangle array = [point 1, point 2, point 3]
-        for i in range(len(triangles)):
-            nodes = []
-
-            for j in range(3):
-                v0 = pdotplane[triangles[i, j]]
-                v1 = pdotplane[triangles[i, (j + 1) % 3]]
-
-                # The line segment intersects with the cutting plane if this
-                # product is negative, meaning v0 and v1 have opposite signs.
-                if v0 * v1 <= 0:
-                    # These are integer point indices that identify the
-                    # edge of the triangle.
-                    p0 = triangles[i, j]
-                    p1 = triangles[i, (j + 1) % 3]
-
-                    node = (p0, p1)
-                    if p0 < p1:
-                        node = (p0, p1)
-                    else:
-                        node = (p1, p0)
-
-                    nodes.append(node)
-
-            if len(nodes) == 2:
-                graph.add_node(nodes[0])
-                graph.add_node(nodes[1])
-                graph.add_edge(nodes[0], nodes[1])
-
-        # Each connected component in the graph corresponds to a list of points
-        # that can become a polyline in the SVG output.
-        for component in nx.connected_components(graph):
-            output_path = []
-
-            subgraph = graph.subgraph(component).copy()
-
-            path_length = 0
-            longest_path = 0
-
-            # Find all shortest paths between pairs of points in the subgraph.
-            # Then find the longest shortest path, which we will use for the
-            # output.
-            all_shortest_paths = nx.shortest_path(subgraph)
-            for s in all_shortest_paths.keys():
-                for t in all_shortest_paths[s].keys():
-                    if len(all_shortest_paths[s][t]) > path_length:
-                        path_length = len(all_shortest_paths[s][t])
-                        longest_path = all_shortest_paths[s][t]
-
-            # Recall that each node in the graph corresponds to an
-            # edge of a triangle. Here is where we look back at the
-            # mesh and calculate the point of intersection with the
-            # cutting plane.
-            for node in longest_path:
-                p0 = points[node[0]]
-                p1 = points[node[1]]
-                pi = lp_intersect(p0, p1, headset_position, vector_normal)
-                output_path.append(pi.tolist())
-
-            paths.append(output_path)
+        # Edge j of each triangle goes from vertex j to vertex j+1. The edge
+        # intersects with the cutting plane if this product is negative,
+        # meaning the two dot products have opposite signs.
+        edge_start = triangles
+        edge_end = np.roll(triangles, -1, axis=1)
+        crossing = pdotplane[edge_start] * pdotplane[edge_end] <= 0
+
+        # Each triangle that crosses the plane should have two intersection
+        # points, which will be connected by a line segment in the map.
+        keep = np.count_nonzero(crossing, axis=1) == 2
+        edge_start = edge_start[keep][crossing[keep]].reshape(-1, 2)
+        edge_end = edge_end[keep][crossing[keep]].reshape(-1, 2)
+
+        # Each node represents an intersection point along the edge of a
+        # triangle, identified by the sorted pair of point indices, so that
+        # neighboring triangles share the node for their common edge.
+        edges = np.stack((np.minimum(edge_start, edge_end), np.maximum(edge_start, edge_end)), axis=-1).reshape(-1, 2)
+        if len(edges) == 0:
+            return []
+        nodes, segments = np.unique(edges, axis=0, return_inverse=True)
+        segments = segments.reshape(-1, 2)
+
+        # Recall that each node corresponds to an edge of a triangle. Here is
+        # where we look back at the mesh and calculate the point of
+        # intersection with the cutting plane.
+        node_points = lp_intersect(points[nodes[:, 0]], points[nodes[:, 1]], headset_position, vector_normal)
+
+        # Each chain of segments becomes a polyline in the SVG output.
+        paths = []
+        for chain in chain_segments(segments, len(nodes)):
+            paths.append(node_points[chain].tolist())
 
         return paths
 
@@ -9,19 +9,33 @@ passed location_id to look up the appropriate map.
 """
 import collections
 import os
+import threading
 import time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
 from server.resources.geometry import Vector3f
 
 from .datagrid import DataGrid
 from .floor import Floor
+from .tiledgrid import TiledDataGrid
 
 
 # Maximum time between consecutive user positions
 MAXIMUM_TIME_DIFFERENCE = 5
 
 
+# Precomputed search inputs for a location and layer. The grid holds the walls
+# with inferred doors cut out, and passable and cost are the arrays given to
+# the A* search. The walls array is kept so that the grid can be updated in
+# place when the floor grid changes. The other fields identify the walls file
+# and floor grid that it was built from.
+CostGrid = collections.namedtuple("CostGrid", ["walls_mtime", "floor_grid", "floor_version", "walls", "grid", "passable", "cost"])
+
+
 def point_to_tuple(p):
     if isinstance(p, Vector3f):
         return p.totuple()
@@ -32,59 +46,63 @@ def point_to_tuple(p):
 
 
 class Navigator:
-    def __init__(self, data_dir="."):
+    # Minimum time in seconds between writes of a floor grid
+    save_interval = 15
+
+    # Number of floor grid updates to remember for updating cost grids
+    max_floor_updates = 1024
+
+    def __init__(self, data_dir=".", save_pool=None):
         self.data_dir = data_dir
 
         self.floors = dict()
-        self.last_saved = collections.defaultdict(float)
+        self.floor_versions = collections.defaultdict(int)
 
-    def find_path(self, location, layer, start, end):
-        # Try to load a wall grid from one of the layers
-        wall_grid = None
-        if layer is not None:
-            layer_dir = os.path.join(self.data_dir, 'locations', location.id.hex, 'layers', '{:08x}'.format(layer.id))
-            npz_path = os.path.join(layer_dir, "walls.npz")
-            if os.path.exists(npz_path):
-                wall_grid = DataGrid.load(npz_path)
+        # Recent floor grid updates for each location as (version, bounds)
+        # pairs, where bounds is the range of cells that changed.
+        self.floor_updates = collections.defaultdict(lambda: collections.deque(maxlen=self.max_floor_updates))
+        self.last_saved = collections.defaultdict(float)
 
-        floor_grid = self.get_floor_grid(location.id)
+        # Floor grids are written to disk on a thread pool so that saving does
+        # not block the event loop. The lock protects floor grid updates and
+        # the persistence state below, which are shared with the pool.
+        self.save_pool = save_pool if save_pool is not None else ThreadPoolExecutor(max_workers=1)
+        self.save_lock = threading.Lock()
+        self.dirty_floors = set()
+        self.saving_floors = set()
+        self.save_due = dict()
+        self.save_futures = dict()
+        self.save_timers = dict()
+
+        # Persistence metrics, see dump_save_metrics
+        self.save_count = 0
+        self.coalesced_count = 0
+        self.last_save_seconds = 0.0
+        self.max_save_seconds = 0.0
+        self.total_save_seconds = 0.0
+
+        # Cached CostGrid for each (location_id, layer_id)
+        self.cost_grids = dict()
 
+    def find_path(self, location, layer, start, end):
         stuple = start.totuple()
         etuple = end.totuple()
 
-        # If we do not have walls or floors, we cannot navigate
-        if wall_grid is None and floor_grid is None:
-            return [start, end]
-
-        elif wall_grid is None and floor_grid is not None:
-            path = floor_grid.a_star(stuple, etuple, passable=DataGrid.ones_passable)
-
-        elif wall_grid is not None and floor_grid is None:
-            # Create an empty floor grid for this map
-            # with the same shape as the wall grid
-            floor_grid = DataGrid().resize_to_other(wall_grid)
-            self.maybe_save_floor_grid(location.id, floor_grid)
-
-            path = wall_grid.a_star(stuple, etuple, passable=DataGrid.zero_passable)
+        # Use the combined wall and floor grid if the layer has walls
+        cost_grid = self.get_cost_grid(location, layer)
+        if cost_grid is not None:
+            path = cost_grid.grid.a_star(stuple, etuple, cost=cost_grid.cost, passable=cost_grid.passable)
+            return self.path_to_3d(path, start, end)
 
-        else:
-            # Expand the floor grid to match the latest wall grid
-            floor_grid = floor_grid.resize_to_other(wall_grid)
-            self.maybe_save_floor_grid(location.id, floor_grid)
-
-            # Update the wall grid with information from the floor grid This
-            # effectively cuts holes in the walls where we have observed user
-            # paths (inferred doors).
-            wall_grid.data -= floor_grid.data
-
-            # Create a cost for unexplored cells. This lambda uses the
-            # floor_grid to return 1.0 for unexplored cells and 0.0 for
-            # explored cells.  This will be added to distances in the A* search
-            # to bias the search in favor of explored cells.
-            exploration_cost = lambda cell, value: 1.0 - floor_grid[cell]
+        # Without a wall grid, navigate on the floor grid alone
+        floor_grid = self.get_floor_grid(location.id)
+        if len(floor_grid.tiles) == 0:
+            return [start, end]
 
-            path = wall_grid.a_star(stuple, etuple, cost=exploration_cost, passable=DataGrid.zero_passable)
+        path = floor_grid.to_dense().a_star(stuple, etuple, passable=DataGrid.ones_passable)
+        return self.path_to_3d(path, start, end)
 
+    def path_to_3d(self, path, start, end):
         if path is None:
             return [start, end]
 
@@ -95,6 +113,104 @@ class Navigator:
 
         return path3d
 
+    def get_cost_grid(self, location, layer):
+        """
+        Get the combined wall, door, and exploration cost grid for a layer.
+
+        The grid is built once and kept in memory until the layer's walls.npz
+        file changes, so that a route request only needs to run the search.
+        Cells that changed in the location's floor grid since then are
+        updated in place.
+
+        Returns None if the layer does not have a wall grid.
+        """
+        if layer is None:
+            return None
+
+        key = (location.id, layer.id)
+        layer_dir = os.path.join(self.data_dir, 'locations', location.id.hex, 'layers', '{:08x}'.format(layer.id))
+        npz_path = os.path.join(layer_dir, "walls.npz")
+
+        try:
+            walls_mtime = os.stat(npz_path).st_mtime_ns
+        except FileNotFoundError:
+            self.cost_grids.pop(key, None)
+            return None
+
+        floor_grid = self.get_floor_grid(location.id)
+        floor_version = self.floor_versions[location.id]
+
+        cached = self.cost_grids.get(key)
+        if cached is not None and cached.walls_mtime == walls_mtime and cached.floor_grid is floor_grid:
+            if cached.floor_version == floor_version:
+                return cached
+
+            with self.save_lock:
+                cost_grid = self.update_cost_grid(cached, location.id)
+            if cost_grid is not None:
+                self.cost_grids[key] = cost_grid
+                return cost_grid
+
+        wall_grid = DataGrid.load(npz_path)
+        walls = wall_grid.data.copy()
+
+        # Get a dense view of the floor grid that matches the wall grid
+        floor_dense = floor_grid.resize_to_other(wall_grid)
+
+        # Update the wall grid with information from the floor grid This
+        # effectively cuts holes in the walls where we have observed user
+        # paths (inferred doors).
+        wall_grid.data -= floor_dense.data
+
+        # Create a cost for unexplored cells. This array uses the
+        # floor_grid to give 1.0 for unexplored cells and 0.0 for
+        # explored cells.  This will be added to distances in the A* search
+        # to bias the search in favor of explored cells.
+        exploration_cost = 1.0 - floor_dense.data
+
+        passable = DataGrid.zero_passable(None, wall_grid.data)
+
+        cost_grid = CostGrid(walls_mtime, floor_grid, floor_version, walls, wall_grid, passable, exploration_cost)
+        self.cost_grids[key] = cost_grid
+        return cost_grid
+
+    def update_cost_grid(self, cost_grid, location_id):
+        """
+        Update a cost grid in place with the floor grid cells that changed
+        since it was built or last updated.
+
+        The caller must hold save_lock. Returns the updated CostGrid, or None
+        if the updates are no longer known and the grid must be rebuilt.
+        """
+        floor_version = self.floor_versions[location_id]
+        updates = self.floor_updates[location_id]
+        if len(updates) == 0 or updates[0][0] > cost_grid.floor_version + 1:
+            return None
+
+        grid = cost_grid.grid
+        i0 = int(np.round(grid.top / grid.step + 0.5))
+        j0 = int(np.round(grid.left / grid.step + 0.5))
+
+        for version, (i, j, rows, columns) in updates:
+            if version <= cost_grid.floor_version:
+                continue
+
+            # Overlap of the changed cells and the wall grid.
+            top = max(i, i0)
+            bottom = min(i + rows, i0 + grid.H)
+            left = max(j, j0)
+            right = min(j + columns, j0 + grid.W)
+            if top >= bottom or left >= right:
+                continue
+
+            floor_dense = cost_grid.floor_grid.make_dense(top, left, bottom - top, right - left)
+            region = (slice(top - i0, bottom - i0), slice(left - j0, right - j0))
+            grid.data[region] = cost_grid.walls[region] - floor_dense.data
+            cost_grid.cost[region] = 1.0 - floor_dense.data
+            cost_grid.passable[region] = DataGrid.zero_passable(None, grid.data[region])
+
+        return cost_grid._replace(floor_version=floor_version)
+
     def get_floor_grid(self, location_id):
         # Check in-memory cache first
         if location_id in self.floors:
@@ -104,60 +220,170 @@ class Navigator:
         dname = os.path.join(self.data_dir, "navigator", location_id.hex)
         path = os.path.join(dname, "floor.npz")
         if os.path.exists(path):
-            grid = DataGrid.load(path)
+            grid = TiledDataGrid.load(path)
         else:
-            grid = DataGrid(width=10.0, height=10.0, left=-5.0, top=-5.0)
+            grid = TiledDataGrid()
 
         self.floors[location_id] = grid
         return grid
 
-    def maybe_save_floor_grid(self, location_id, floor_grid, interval=15):
+    def maybe_save_floor_grid(self, location_id, floor_grid, interval=None):
         """
         Save the floor grid if interval seconds have elapsed
 
         Setting interval to less than zero will force a save regardless of elapsed time.
+        The default interval is save_interval.
+
+        The grid is marked dirty and written in the background. Changes that
+        arrive while a write is due or in progress are coalesced into a
+        single write, and a timer makes sure that the write happens even if
+        no more changes arrive.
         """
-        # Set the cached grid
-        self.floors[location_id] = floor_grid
+        if interval is None:
+            interval = self.save_interval
 
-        now = time.time()
-        if now - self.last_saved[location_id] > interval:
-            dname = os.path.join(self.data_dir, "navigator", location_id.hex)
-            os.makedirs(dname, exist_ok=True)
+        with self.save_lock:
+            # Set the cached grid
+            self.floors[location_id] = floor_grid
+            self.dirty_floors.add(location_id)
 
-            floor_grid.save_image(os.path.join(dname, "floor.png"))
-            floor_grid.save(os.path.join(dname, "floor.npz"))
-            self.last_saved[location_id] = now
+            due = self.last_saved[location_id] + interval
+            self.save_due[location_id] = min(self.save_due.get(location_id, due), due)
 
-    def add_trace(self, location, trace):
-        floor_grid = self.get_floor_grid(location.id)
+            if location_id in self.saving_floors:
+                # The running worker will see the changes when it finishes.
+                self.coalesced_count += 1
+                return
 
-        layers = location.Layer.find(type="generated")
+            if time.time() < self.save_due[location_id]:
+                self.coalesced_count += 1
+                self.start_save_timer(location_id)
+                return
 
-        # Try to load a wall grid from one of the layers
-        wall_grid = None
-        for layer in layers:
-            if layer.type == "generated":
-                npz_path = os.path.join(os.path.dirname(layer.imagePath), "walls.npz")
-                if os.path.exists(npz_path):
-                    wall_grid = DataGrid.load(npz_path)
-                    break
+            self.saving_floors.add(location_id)
 
-        floor_grid = self.get_floor_grid(location.id)
+        self.save_futures[location_id] = self.save_pool.submit(self.save_floor_grid_worker, location_id)
+
+    def start_save_timer(self, location_id):
+        """
+        Start a timer for the next due write of a floor grid.
+
+        The caller must hold save_lock.
+        """
+        if location_id in self.save_timers:
+            return
+
+        delay = max(self.save_due[location_id] - time.time(), 0)
+        timer = threading.Timer(delay, self.on_save_timer, args=(location_id,))
+        timer.daemon = True
+        self.save_timers[location_id] = timer
+        timer.start()
+
+    def on_save_timer(self, location_id):
+        with self.save_lock:
+            self.save_timers.pop(location_id, None)
+            if location_id in self.saving_floors or location_id not in self.dirty_floors:
+                return
+            self.saving_floors.add(location_id)
+
+        self.save_futures[location_id] = self.save_pool.submit(self.save_floor_grid_worker, location_id)
+
+    def save_floor_grid_worker(self, location_id):
+        """
+        Write floor grid snapshots until there are no more changes due.
+        """
+        while True:
+            with self.save_lock:
+                if location_id not in self.dirty_floors:
+                    self.saving_floors.discard(location_id)
+                    return
+
+                # Changes that arrived during the last write are written when
+                # the save interval has passed.
+                if time.time() < self.save_due.get(location_id, 0):
+                    self.saving_floors.discard(location_id)
+                    self.start_save_timer(location_id)
+                    return
+
+                # The snapshot shares tiles with the floor grid, which copies
+                # them before they are modified, so it is safe to write it
+                # without holding the lock.
+                self.dirty_floors.discard(location_id)
+                self.save_due.pop(location_id, None)
+                self.last_saved[location_id] = time.time()
+                snapshot = self.floors[location_id].snapshot()
+
+            started = time.time()
+            self.write_floor_grid(location_id, snapshot)
+            elapsed = time.time() - started
+
+            with self.save_lock:
+                self.save_count += 1
+                self.last_save_seconds = elapsed
+                self.max_save_seconds = max(self.max_save_seconds, elapsed)
+                self.total_save_seconds += elapsed
+
+    def write_floor_grid(self, location_id, floor_grid):
+        """
+        Write the floor grid files, replacing the old files atomically.
+        """
+        dname = os.path.join(self.data_dir, "navigator", location_id.hex)
+        os.makedirs(dname, exist_ok=True)
+
+        for fname, save in [("floor.png", floor_grid.save_image), ("floor.npz", floor_grid.save)]:
+            base, ext = os.path.splitext(fname)
+            temp_path = os.path.join(dname, "{}.tmp-{}{}".format(base, os.getpid(), ext))
+            save(temp_path)
+            os.replace(temp_path, os.path.join(dname, fname))
+
+    def flush(self):
+        """
+        Save all modified floor grids now and wait for the writes to finish.
+        """
+        with self.save_lock:
+            location_ids = list(self.dirty_floors)
+
+            for timer in self.save_timers.values():
+                timer.cancel()
+            self.save_timers.clear()
 
-        # If possible, resize floor grid to match wall grid.
-        # We may have mapped the space but have a completely empty floor grid.
-        if wall_grid is not None:
-            floor_grid = floor_grid.resize_to_other(wall_grid)
+        for location_id in location_ids:
+            self.maybe_save_floor_grid(location_id, self.floors[location_id], interval=-1)
+
+        for future in list(self.save_futures.values()):
+            future.result()
+
+    def dump_save_metrics(self):
+        """
+        Get metrics about writing floor grids in the background.
+        """
+        with self.save_lock:
+            return {
+                "saves": self.save_count,
+                "coalesced_updates": self.coalesced_count,
+                "backlog": len(self.dirty_floors),
+                "saves_in_progress": len(self.saving_floors),
+                "last_save_seconds": self.last_save_seconds,
+                "max_save_seconds": self.max_save_seconds,
+                "mean_save_seconds": self.total_save_seconds / max(self.save_count, 1)
+            }
+
+    def add_trace(self, location, trace):
+        # The floor grid allocates tiles as needed, so the trace is kept even
+        # if it goes outside of the mapped area.
+        floor_grid = self.get_floor_grid(location.id)
 
         # Need to convert from list of dict to simple tuples
         points = []
         for point in trace:
             points.append(tuple(point['position'][k] for k in ['x', 'y', 'z']))
 
-        for i in range(len(points) - 1):
-            floor_grid.add_segment(points[i], points[i+1], vspread=1)
-
+        with self.save_lock:
+            self.floor_versions[location.id] += 1
+            version = self.floor_versions[location.id]
+            for i in range(len(points) - 1):
+                bounds = floor_grid.add_segment(points[i], points[i+1], vspread=1)
+                self.floor_updates[location.id].append((version, bounds))
         self.maybe_save_floor_grid(location.id, floor_grid, interval=-1)
 
     async def on_headset_updated(self, event, uri, *args, **kwargs):
@@ -181,13 +407,13 @@ class Navigator:
             return
 
         location_id = uuid.UUID(current['location_id'])
-        if location_id not in self.floors:
-            self.floors[location_id] = DataGrid(width=10.0, height=10.0, left=-5.0, top=-5.0)
-
         floor_grid = self.get_floor_grid(location_id)
 
         # TODO: Change to have multiple floors in a single location and differentiate between each using y position
-        floor_grid.add_segment(point_to_tuple(previous['position']), point_to_tuple(current['position']), vspread=1)
+        with self.save_lock:
+            bounds = floor_grid.add_segment(point_to_tuple(previous['position']), point_to_tuple(current['position']), vspread=1)
+            self.floor_versions[location_id] += 1
+            self.floor_updates[location_id].append((self.floor_versions[location_id], bounds))
 
         self.maybe_save_floor_grid(location_id, floor_grid)
 
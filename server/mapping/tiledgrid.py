@@ -0,0 +1,294 @@
+import numpy as np
+
+from .datagrid import DataGrid
+
+
+class TiledDataGrid:
+    """
+    Sparse grid that stores values in fixed-size tiles.
+
+    Tiles are kept in a dictionary keyed by tile coordinates and allocated on
+    the first write, so the grid grows with the area that has been written to
+    rather than its bounding box. Cells that have never been written to read
+    as zero.
+
+    Cells are laid out the same way as in DataGrid, with the origin centered
+    in a cell, so a dense view from to_dense or resize_to_other lines up with
+    DataGrid objects that use the same step size.
+
+    A snapshot shares its tiles with the grid it was taken from. The grid
+    copies a shared tile before its first write to it, so the snapshot can be
+    read, e.g. to save it from another thread, while the grid is updated.
+    """
+
+    def __init__(self, step=0.25, dtype=float, cell_shape=None, tile_size=64):
+        """
+        Create a tiled grid data structure.
+
+        step: size of grid cells in physical units.
+
+        dtype: data type to store, must be supported by numpy.
+
+        cell_shape: shape of data to store for each grid cell, must be a tuple
+        or None, as for DataGrid.
+
+        tile_size: number of cells along each side of a tile.
+        """
+        if cell_shape is not None and not isinstance(cell_shape, tuple):
+            raise Exception("Only a tuple or None are accepted for cell_shape argument")
+
+        self.step = step
+        self.dtype = np.dtype(dtype)
+        self.cell_shape = cell_shape
+        self.tile_size = tile_size
+
+        self.tiles = dict()
+
+        # Keys of tiles that are shared with a snapshot
+        self.shared = set()
+
+    # Cells hit by a line segment do not depend on the grid layout.
+    line = DataGrid.line
+
+    def __contains__(self, key):
+        """
+        Test if a cell has been allocated.
+        """
+        if isinstance(key, tuple) and len(key) == 2:
+            return self.cell_to_tile(key)[0] in self.tiles
+        elif len(key) == 3:
+            return self.cell_to_tile(self.xyz_to_index(key))[0] in self.tiles
+
+    def __getitem__(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2):
+            key = self.xyz_to_index(key)
+
+        tile_key, cell = self.cell_to_tile(key)
+        tile = self.tiles.get(tile_key)
+        if tile is None:
+            return np.zeros(self.cell_shape or (), dtype=self.dtype)[()]
+        return tile[cell]
+
+    def __setitem__(self, key, value):
+        if not (isinstance(key, tuple) and len(key) == 2):
+            key = self.xyz_to_index(key)
+
+        tile_key, cell = self.cell_to_tile(key)
+        self.get_tile(tile_key)[cell] = value
+
+    def __str__(self):
+        return f"TiledDataGrid(step={self.step}, tile_size={self.tile_size}, tiles={len(self.tiles)})"
+
+    @property
+    def shape(self):
+        shape = (self.tile_size, self.tile_size)
+        if self.cell_shape is not None:
+            shape += self.cell_shape
+        return shape
+
+    def cell_to_tile(self, cell):
+        """
+        Split a cell index into a tile key and the cell index within the tile.
+        """
+        ti, i = divmod(int(cell[0]), self.tile_size)
+        tj, j = divmod(int(cell[1]), self.tile_size)
+        return (ti, tj), (i, j)
+
+    def get_tile(self, tile_key):
+        """
+        Get a tile for writing, allocating it if it does not exist yet.
+        """
+        tile = self.tiles.get(tile_key)
+        if tile is None:
+            tile = np.zeros(self.shape, dtype=self.dtype)
+            self.tiles[tile_key] = tile
+        elif tile_key in self.shared:
+            tile = tile.copy()
+            self.tiles[tile_key] = tile
+            self.shared.discard(tile_key)
+        return tile
+
+    def snapshot(self):
+        """
+        Make a copy of the grid that shares tiles until they are written.
+        """
+        copy = TiledDataGrid(step=self.step, dtype=self.dtype, cell_shape=self.cell_shape, tile_size=self.tile_size)
+        copy.tiles = dict(self.tiles)
+        copy.shared = set(self.tiles.keys())
+        self.shared = set(self.tiles.keys())
+        return copy
+
+    def index_to_xz(self, p):
+        # Cell (0, 0) is centered on the origin.
+        q = np.array(p) * self.step
+        return (q[1], q[0])
+
+    def xyz_to_index(self, p):
+        q = np.array([p[-1], p[0]]) / self.step + 0.5
+        return tuple(np.floor(q).astype(int))
+
+    def add_segment(self, a, b, vspread=0):
+        """
+        Add a line segment to the grid, allocating any tiles that it crosses.
+
+        Returns the range of cells that were written to as (first row, first
+        column, rows, columns).
+        """
+        zz, xx, weights = self.line(a, b, vspread=vspread)
+
+        zi = np.floor(zz / self.step + 0.5).astype(int)
+        xi = np.floor(xx / self.step + 0.5).astype(int)
+
+        bounds = (int(zi.min()), int(xi.min()), int(zi.max() - zi.min()) + 1, int(xi.max() - xi.min()) + 1)
+
+        tile_i, zi = np.divmod(zi, self.tile_size)
+        tile_j, xi = np.divmod(xi, self.tile_size)
+
+        tile_keys, inverse = np.unique(np.column_stack((tile_i, tile_j)), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for k, tile_key in enumerate(tile_keys):
+            sel = (inverse == k)
+            tile = self.get_tile(tuple(int(x) for x in tile_key))
+            np.maximum.at(tile, (zi[sel], xi[sel]), weights[sel])
+
+        return bounds
+
+    def check_segment(self, a, b):
+        zz, xx, _ = self.line(a, b, vspread=0)
+
+        zi = np.floor(zz / self.step + 0.5).astype(int)
+        xi = np.floor(xx / self.step + 0.5).astype(int)
+
+        return min(self[(i, j)] for i, j in zip(zi, xi))
+
+    def bounds(self):
+        """
+        Get the range of allocated cells as (first row, first column, rows,
+        columns), or None if the grid is empty.
+        """
+        if len(self.tiles) == 0:
+            return None
+
+        keys = np.array(list(self.tiles.keys()))
+        lower = keys.min(axis=0) * self.tile_size
+        upper = (keys.max(axis=0) + 1) * self.tile_size
+        return lower[0], lower[1], upper[0] - lower[0], upper[1] - lower[1]
+
+    def make_dense(self, i0, j0, H, W):
+        """
+        Copy the region starting at cell (i0, j0) with H rows and W columns
+        into a new DataGrid.
+        """
+        grid = DataGrid(step=self.step, dtype=self.dtype, cell_shape=self.cell_shape)
+        grid.top = (i0 - 0.5) * self.step
+        grid.left = (j0 - 0.5) * self.step
+        grid.bottom = grid.top + H * self.step
+        grid.right = grid.left + W * self.step
+        grid.H = H
+        grid.W = W
+
+        shape = (H, W)
+        if self.cell_shape is not None:
+            shape += self.cell_shape
+        grid.data = np.zeros(shape, dtype=self.dtype)
+
+        T = self.tile_size
+        for (ti, tj), tile in self.tiles.items():
+            # Overlap of the tile and the region in grid cell indices.
+            top = max(ti * T, i0)
+            bottom = min((ti + 1) * T, i0 + H)
+            left = max(tj * T, j0)
+            right = min((tj + 1) * T, j0 + W)
+            if top >= bottom or left >= right:
+                continue
+
+            grid.data[top-i0:bottom-i0, left-j0:right-j0] = tile[top-ti*T:bottom-ti*T, left-tj*T:right-tj*T]
+
+        return grid
+
+    def to_dense(self):
+        """
+        Create a DataGrid covering all of the allocated tiles, e.g. for A*
+        search.
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            bounds = (0, 0, self.tile_size, self.tile_size)
+        return self.make_dense(*bounds)
+
+    def resize_to_other(self, other):
+        """
+        Create a DataGrid with the values from this grid and the geometry of
+        another DataGrid.
+
+        Only the tiles that overlap the other grid are copied. Step size
+        should be equal for this operation to make any sense.
+        """
+        i0 = int(np.round(other.top / self.step + 0.5))
+        j0 = int(np.round(other.left / self.step + 0.5))
+        return self.make_dense(i0, j0, other.H, other.W)
+
+    def save(self, path):
+        """
+        Save the grid to a numpy npz file
+        """
+        keys = np.array(list(self.tiles.keys()), dtype=int).reshape(-1, 2)
+        if len(self.tiles) > 0:
+            tiles = np.stack(list(self.tiles.values()))
+        else:
+            tiles = np.zeros((0,) + self.shape, dtype=self.dtype)
+        geometry = np.array([self.step, self.tile_size])
+        np.savez(path, tiles=tiles, tile_keys=keys, tile_geometry=geometry)
+
+    def save_image(self, path):
+        self.to_dense().save_image(path)
+
+    @classmethod
+    def from_dense(cls, dense, tile_size=64):
+        """
+        Create a tiled grid from a DataGrid.
+
+        Only tiles that contain non-zero values are allocated.
+        """
+        cell_shape = dense.data.shape[2:] or None
+        grid = cls(step=dense.step, dtype=dense.data.dtype, cell_shape=cell_shape, tile_size=tile_size)
+
+        i0 = int(np.round(dense.top / dense.step + 0.5))
+        j0 = int(np.round(dense.left / dense.step + 0.5))
+
+        T = tile_size
+        for ti in range(i0 // T, (i0 + dense.H - 1) // T + 1):
+            for tj in range(j0 // T, (j0 + dense.W - 1) // T + 1):
+                top = max(ti * T, i0)
+                bottom = min((ti + 1) * T, i0 + dense.H)
+                left = max(tj * T, j0)
+                right = min((tj + 1) * T, j0 + dense.W)
+
+                values = dense.data[top-i0:bottom-i0, left-j0:right-j0]
+                if np.any(values):
+                    tile = grid.get_tile((ti, tj))
+                    tile[top-ti*T:bottom-ti*T, left-tj*T:right-tj*T] = values
+
+        return grid
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load grid object from a numpy npz file
+
+        Files saved by DataGrid are converted to a tiled grid.
+        """
+        npz = np.load(path)
+
+        if 'tiles' not in npz:
+            return cls.from_dense(DataGrid.from_npz(npz))
+
+        tiles = npz['tiles']
+        step, tile_size = npz['tile_geometry']
+
+        cell_shape = tiles.shape[3:] or None
+        grid = cls(step=step, dtype=tiles.dtype, cell_shape=cell_shape, tile_size=int(tile_size))
+        for key, tile in zip(npz['tile_keys'], tiles):
+            grid.tiles[(int(key[0]), int(key[1]))] = tile
+
+        return grid
@@ -0,0 +1,376 @@
+import collections
+
+import numpy as np
+import trimesh
+
+
+class MeshArena:
+    """
+    Combined vertex and face buffer for a collection of surfaces.
+
+    Each surface occupies a slot, which is a contiguous range of vertices and
+    faces in the shared buffers. Appending a surface copies only that surface
+    into the end of the buffers, which grow geometrically. Removing a surface
+    leaves a tombstone, i.e. its faces are excluded from the combined mesh, but
+    the space is not reclaimed until the buffers are compacted. Compaction runs
+    automatically once the fraction of dead faces exceeds compaction_threshold.
+
+    Face indices in the combined mesh can be mapped back to slots and local
+    face indices through the face_slot and face_local arrays.
+    """
+
+    compaction_threshold = 0.25
+
+    # Maximum number of cached meshes of slot subsets.
+    max_cached_submeshes = 8
+
+    def __init__(self):
+        self.vertices = np.zeros((0, 3), dtype=float)
+        self.faces = np.zeros((0, 3), dtype=int)
+        self.vertex_count = 0
+        self.face_count = 0
+
+        # Slot index and slot-local face index for each face in the buffer.
+        # Faces belonging to removed slots have face_slot set to -1.
+        self.face_slot = np.zeros(0, dtype=int)
+        self.face_local = np.zeros(0, dtype=int)
+
+        # Slot table, one entry per slot including removed slots.
+        self.slot_keys = []
+        self.slot_vertex_start = []
+        self.slot_vertex_count = []
+        self.slot_face_start = []
+        self.slot_face_count = []
+        self.slot_alive = []
+
+        # Map from key to live slot index.
+        self.slots = dict()
+
+        self.dead_faces = 0
+
+        self._mesh = None
+        self._live_faces = None
+        self._submeshes = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # Cached objects are rebuilt on demand, and only the used part of the
+        # buffers needs to be saved.
+        state['_mesh'] = None
+        state['_live_faces'] = None
+        state['_submeshes'] = None
+        state['vertices'] = self.vertices[:self.vertex_count].copy()
+        state['faces'] = self.faces[:self.face_count].copy()
+        state['face_slot'] = self.face_slot[:self.face_count].copy()
+        state['face_local'] = self.face_local[:self.face_count].copy()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._submeshes = collections.OrderedDict()
+
+    def _reserve(self, vertex_count, face_count):
+        """
+        Make sure the buffers can hold at least the given number of vertices
+        and faces, growing them geometrically if necessary.
+        """
+        if vertex_count > len(self.vertices):
+            capacity = max(vertex_count, 2 * len(self.vertices), 1024)
+            vertices = np.zeros((capacity, 3), dtype=float)
+            vertices[:self.vertex_count] = self.vertices[:self.vertex_count]
+            self.vertices = vertices
+
+        if face_count > len(self.faces):
+            capacity = max(face_count, 2 * len(self.faces), 1024)
+
+            faces = np.zeros((capacity, 3), dtype=int)
+            faces[:self.face_count] = self.faces[:self.face_count]
+            self.faces = faces
+
+            face_slot = np.full(capacity, -1, dtype=int)
+            face_slot[:self.face_count] = self.face_slot[:self.face_count]
+            self.face_slot = face_slot
+
+            face_local = np.zeros(capacity, dtype=int)
+            face_local[:self.face_count] = self.face_local[:self.face_count]
+            self.face_local = face_local
+
+    def _invalidate(self):
+        self._mesh = None
+        self._live_faces = None
+        self._submeshes.clear()
+
+    def append(self, key, vertices, faces):
+        """
+        Append a surface to the end of the buffers.
+
+        The key must not already be in use. Returns the new slot index.
+        """
+        if key in self.slots:
+            raise KeyError("Key {} is already in the arena".format(key))
+
+        nv = len(vertices)
+        nf = len(faces)
+        self._reserve(self.vertex_count + nv, self.face_count + nf)
+
+        v0 = self.vertex_count
+        f0 = self.face_count
+        slot = len(self.slot_keys)
+
+        self.vertices[v0:v0+nv] = vertices
+        self.faces[f0:f0+nf] = np.asarray(faces, dtype=int) + v0
+        self.face_slot[f0:f0+nf] = slot
+        self.face_local[f0:f0+nf] = np.arange(nf)
+
+        self.vertex_count += nv
+        self.face_count += nf
+
+        self.slot_keys.append(key)
+        self.slot_vertex_start.append(v0)
+        self.slot_vertex_count.append(nv)
+        self.slot_face_start.append(f0)
+        self.slot_face_count.append(nf)
+        self.slot_alive.append(True)
+        self.slots[key] = slot
+
+        self._invalidate()
+        return slot
+
+    def remove(self, key):
+        """
+        Remove a surface by marking its slot as dead.
+        """
+        slot = self.slots.pop(key)
+        self.slot_alive[slot] = False
+
+        f0 = self.slot_face_start[slot]
+        nf = self.slot_face_count[slot]
+        self.face_slot[f0:f0+nf] = -1
+        self.dead_faces += nf
+
+        self._invalidate()
+        self.maybe_compact()
+
+    def replace(self, key, vertices, faces):
+        """
+        Replace a surface or add it if the key is not in use.
+
+        Returns the new slot index.
+        """
+        if key in self.slots:
+            self.remove(key)
+        return self.append(key, vertices, faces)
+
+    def maybe_compact(self):
+        if self.face_count > 0 and self.dead_faces > self.compaction_threshold * self.face_count:
+            self.compact()
+
+    def compact(self):
+        """
+        Rebuild the buffers without dead slots.
+
+        Live slots keep their relative order but are renumbered.
+        """
+        live = [i for i, alive in enumerate(self.slot_alive) if alive]
+
+        nv = sum(self.slot_vertex_count[i] for i in live)
+        nf = sum(self.slot_face_count[i] for i in live)
+
+        vertices = np.zeros((nv, 3), dtype=float)
+        faces = np.zeros((nf, 3), dtype=int)
+        face_slot = np.zeros(nf, dtype=int)
+        face_local = np.zeros(nf, dtype=int)
+
+        slot_vertex_start = []
+        slot_face_start = []
+
+        v0 = 0
+        f0 = 0
+        for new_slot, old_slot in enumerate(live):
+            ov = self.slot_vertex_start[old_slot]
+            of = self.slot_face_start[old_slot]
+            sv = self.slot_vertex_count[old_slot]
+            sf = self.slot_face_count[old_slot]
+
+            vertices[v0:v0+sv] = self.vertices[ov:ov+sv]
+            faces[f0:f0+sf] = self.faces[of:of+sf] - ov + v0
+            face_slot[f0:f0+sf] = new_slot
+            face_local[f0:f0+sf] = self.face_local[of:of+sf]
+
+            slot_vertex_start.append(v0)
+            slot_face_start.append(f0)
+
+            v0 += sv
+            f0 += sf
+
+        self.vertices = vertices
+        self.faces = faces
+        self.face_slot = face_slot
+        self.face_local = face_local
+        self.vertex_count = nv
+        self.face_count = nf
+
+        self.slot_keys = [self.slot_keys[i] for i in live]
+        self.slot_vertex_start = slot_vertex_start
+        self.slot_vertex_count = [self.slot_vertex_count[i] for i in live]
+        self.slot_face_start = slot_face_start
+        self.slot_face_count = [self.slot_face_count[i] for i in live]
+        self.slot_alive = [True] * len(live)
+        self.slots = {key: i for i, key in enumerate(self.slot_keys)}
+
+        self.dead_faces = 0
+        self._invalidate()
+
+    def keys(self):
+        """
+        List the keys of live slots in buffer order.
+        """
+        return [key for key, alive in zip(self.slot_keys, self.slot_alive) if alive]
+
+    def live_faces(self):
+        """
+        Get indices of the buffer faces that belong to live slots.
+
+        These are exactly the faces of the combined mesh, in the same order.
+        """
+        if self._live_faces is None:
+            if self.dead_faces == 0:
+                self._live_faces = np.arange(self.face_count)
+            else:
+                self._live_faces = np.flatnonzero(self.face_slot[:self.face_count] >= 0)
+        return self._live_faces
+
+    def vertex_range(self, key):
+        slot = self.slots[key]
+        start = self.slot_vertex_start[slot]
+        return start, start + self.slot_vertex_count[slot]
+
+    def vertex_ranges(self):
+        """
+        Iterate over (key, start, end) vertex ranges of live slots.
+        """
+        for slot, key in enumerate(self.slot_keys):
+            if self.slot_alive[slot]:
+                start = self.slot_vertex_start[slot]
+                yield key, start, start + self.slot_vertex_count[slot]
+
+    def vertex_slots(self, vertices):
+        """
+        Find the slot index for each of an array of buffer vertex indices.
+        """
+        starts = np.asarray(self.slot_vertex_start, dtype=int)
+        return np.searchsorted(starts, vertices, side='right') - 1
+
+    def face_object_indices(self):
+        """
+        Get the index into keys() of the surface owning each combined mesh face.
+        """
+        ordinal = np.cumsum(self.slot_alive, dtype=int) - 1
+        return ordinal[self.face_slot[self.live_faces()]]
+
+    def face_local_indices(self):
+        """
+        Get the surface-local face index for each combined mesh face.
+        """
+        return self.face_local[self.live_faces()]
+
+    @property
+    def mesh(self):
+        """
+        Combined mesh of all live slots.
+
+        The mesh references the vertex buffer without copying, and it is
+        cached until the next modification so that derived data such as the
+        ray intersector can be reused.
+        """
+        if self._mesh is None:
+            if self.dead_faces == 0:
+                faces = self.faces[:self.face_count]
+            else:
+                faces = self.faces[self.live_faces()]
+            self._mesh = trimesh.Trimesh(vertices=self.vertices[:self.vertex_count], faces=faces, process=False, validate=False)
+        return self._mesh
+
+    def submesh(self, keys):
+        """
+        Mesh of a subset of the live slots.
+
+        The mesh references the vertex buffer, so its vertex indices are the
+        same as in the combined mesh. Meshes are cached for the most recently
+        used subsets until the next modification, so that repeated queries
+        against the same subset reuse the ray intersector.
+
+        Returns the mesh and the buffer index of each of its faces.
+        """
+        keys = frozenset(keys)
+        if len(keys) == len(self.slots):
+            return self.mesh, self.live_faces()
+
+        cached = self._submeshes.get(keys)
+        if cached is not None:
+            self._submeshes.move_to_end(keys)
+            return cached
+
+        slots = sorted(self.slots[key] for key in keys)
+        if len(slots) > 0:
+            face_index = np.concatenate([np.arange(self.slot_face_start[slot], self.slot_face_start[slot] + self.slot_face_count[slot])
+                    for slot in slots])
+        else:
+            face_index = np.zeros(0, dtype=int)
+
+        mesh = trimesh.Trimesh(vertices=self.vertices[:self.vertex_count], faces=self.faces[face_index], process=False, validate=False)
+
+        self._submeshes[keys] = (mesh, face_index)
+        while len(self._submeshes) > self.max_cached_submeshes:
+            self._submeshes.popitem(last=False)
+
+        return mesh, face_index
+
+    @classmethod
+    def from_buffers(cls, keys, vertices, faces, vertex_counts, face_counts):
+        """
+        Create an arena directly from packed buffers without copying them.
+
+        The buffers must contain the slots back to back in the order given by
+        keys, and the faces must index into the combined vertex buffer. This
+        is the layout produced by compact().
+        """
+        arena = cls()
+
+        vertex_counts = np.asarray(vertex_counts, dtype=int)
+        face_counts = np.asarray(face_counts, dtype=int)
+        vertex_starts = np.concatenate(([0], np.cumsum(vertex_counts)[:-1])).astype(int)
+        face_starts = np.concatenate(([0], np.cumsum(face_counts)[:-1])).astype(int)
+
+        arena.vertices = vertices
+        arena.faces = faces
+        arena.vertex_count = len(vertices)
+        arena.face_count = len(faces)
+
+        arena.face_slot = np.repeat(np.arange(len(keys)), face_counts)
+        arena.face_local = np.arange(len(faces)) - np.repeat(face_starts, face_counts)
+
+        arena.slot_keys = list(keys)
+        arena.slot_vertex_start = vertex_starts.tolist()
+        arena.slot_vertex_count = vertex_counts.tolist()
+        arena.slot_face_start = face_starts.tolist()
+        arena.slot_face_count = face_counts.tolist()
+        arena.slot_alive = [True] * len(keys)
+        arena.slots = {key: i for i, key in enumerate(keys)}
+
+        return arena
+
+    @classmethod
+    def from_meshes(cls, meshes, keys):
+        arena = cls()
+        arena._reserve(sum(len(m.vertices) for m in meshes), sum(len(m.faces) for m in meshes))
+        for key, mesh in zip(keys, meshes):
+            arena.append(key, mesh.vertices, mesh.faces)
+        return arena
@@ -1,14 +1,72 @@
+import heapq
+import itertools
 import os
 import pickle
 
-import networkx as nx
 import numpy as np
 import trimesh
 
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
 
 walkable_threshold = 0.5
 
 
+def walkable_edges(mesh):
+    """
+    Find pairs of adjacent faces which are both walkable.
+
+    Returns an (E, 2) array of face indices.
+    """
+    adjacency = mesh.face_adjacency.reshape(-1, 2)
+    walkable = mesh.face_normals[:, 1] >= walkable_threshold
+    mask = walkable[adjacency[:, 0]] & walkable[adjacency[:, 1]]
+    return adjacency[mask]
+
+
+def label_components(num_faces, edges):
+    """
+    Label connected components of faces joined by an (E, 2) array of edges.
+
+    Returns a list of face index arrays, one per component, and an array of
+    length N, where N is the number of faces, and the value is the
+    component ID.
+    """
+    if num_faces == 0:
+        return [], np.zeros(0, dtype=int)
+
+    graph = coo_matrix((np.ones(len(edges), dtype=bool), (edges[:, 0], edges[:, 1])), shape=(num_faces, num_faces))
+    num_components, component_id = connected_components(graph, directed=False)
+
+    # Group the faces by component, keeping them in ascending order.
+    order = np.argsort(component_id, kind='stable')
+    counts = np.bincount(component_id, minlength=num_components)
+    components = np.split(order, np.cumsum(counts)[:-1])
+
+    return components, component_id
+
+
+def build_csr(num_nodes, edges):
+    """
+    Build a compressed sparse row (CSR) adjacency structure for an undirected graph.
+
+    Returns (indptr, indices, edge_index), where the neighbors of node i are
+    indices[indptr[i]:indptr[i+1]], and edge_index gives the row in edges for
+    each of those entries.
+    """
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    edge_ids = np.tile(np.arange(len(edges)), 2)
+
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(num_nodes + 1, dtype=int)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_nodes))
+
+    return indptr, cols[order], edge_ids[order]
+
+
 class Chunk:
     """
     Map Chunk
@@ -27,11 +85,33 @@ class Chunk:
         self.id = _id
 
         self.mesh = trimesh.Trimesh()
-        self.neighbors = nx.Graph()
+
+        # Graph of walkable adjacent faces. The edges are stored as an (E, 2)
+        # array with the weights and observed hit counts in parallel arrays,
+        # and the CSR arrays index the edges by face.
+        self.edges = np.zeros((0, 2), dtype=int)
+        self.edge_weights = np.zeros(0)
+        self.edge_hits = np.zeros(0, dtype=int)
+        self.indptr = np.zeros(1, dtype=int)
+        self.indices = np.zeros(0, dtype=int)
+        self.edge_index = np.zeros(0, dtype=int)
 
         self.components = []
         self.component_id = []
 
+    def __setstate__(self, state):
+        neighbors = state.pop('neighbors', None)
+        self.__dict__.update(state)
+
+        # Chunks cached before the CSR graph was introduced have a networkx
+        # graph instead, so rebuild the graph and carry over the hit counts.
+        if neighbors is not None:
+            self.set_neighbors(self.mesh)
+            for a, b, hits in neighbors.edges.data("hits", default=0):
+                edge = self.find_edge(a, b)
+                if edge >= 0:
+                    self.edge_hits[edge] = hits
+
     def compute_iou(self, other, verbose=False):
         """
         Compute intersection over union (IOU) between two chunks.
@@ -73,6 +153,80 @@ class Chunk:
         point_b = self.mesh.triangles_center[face2]
         return np.linalg.norm(point_a - point_b)
 
+    def degree(self, face):
+        if face < 0 or face >= len(self.indptr) - 1:
+            return 0
+        return self.indptr[face+1] - self.indptr[face]
+
+    def find_edge(self, face1, face2):
+        """
+        Find the index of the edge between two faces or -1 if they are not
+        adjacent walkable faces.
+        """
+        if self.degree(face1) == 0:
+            return -1
+        start = self.indptr[face1]
+        end = self.indptr[face1+1]
+        i = start + np.searchsorted(self.indices[start:end], face2)
+        if i < end and self.indices[i] == face2:
+            return self.edge_index[i]
+        return -1
+
+    def find_face_path(self, face1, face2):
+        """
+        Find a shortest path between two faces over walkable adjacent faces
+        using A* search.
+
+        Returns the lists of faces and edges along the path, or (None, None)
+        if there is no path.
+        """
+        if self.degree(face1) == 0 or self.degree(face2) == 0:
+            return None, None
+
+        centers = self.mesh.triangles_center
+        goal = centers[face2]
+
+        # The counter breaks ties between equal priorities without comparing nodes.
+        counter = itertools.count()
+        queue = [(0.0, next(counter), face1)]
+        g_score = {face1: 0.0}
+        came_from = {face1: (None, None)}
+        closed = set()
+
+        while len(queue) > 0:
+            _, _, current = heapq.heappop(queue)
+
+            if current == face2:
+                faces = [current]
+                edges = []
+                while came_from[current][0] is not None:
+                    current, edge = came_from[current]
+                    faces.append(current)
+                    edges.append(edge)
+                return faces[::-1], edges[::-1]
+
+            if current in closed:
+                continue
+            closed.add(current)
+
+            start = self.indptr[current]
+            end = self.indptr[current+1]
+            neighbors = self.indices[start:end]
+            edges = self.edge_index[start:end]
+
+            tentative = g_score[current] + self.edge_weights[edges]
+            heuristic = np.linalg.norm(centers[neighbors] - goal, axis=1)
+
+            for neighbor, edge, g, h in zip(neighbors.tolist(), edges.tolist(), tentative.tolist(), heuristic.tolist()):
+                if neighbor in closed:
+                    continue
+                if g < g_score.get(neighbor, np.inf):
+                    g_score[neighbor] = g
+                    came_from[neighbor] = (current, edge)
+                    heapq.heappush(queue, (g + h, next(counter), neighbor))
+
+        return None, None
+
     def find_boundary_faces(self, face):
         """
         Find the boundary faces of a component given one face on that component.
@@ -122,24 +276,19 @@ class Chunk:
     def observed_transition(self, face1, face2):
         # If the two faces are adjacent, update the hit count, and we are done.
         # This should be a common condition.
-        if self.neighbors.has_edge(face1, face2):
-            hits = self.neighbors.edges[face1, face2].get("hits", 0) + 1
-            self.neighbors.edges[face1, face2]['hits'] = hits
+        edge = self.find_edge(face1, face2)
+        if edge >= 0:
+            self.edge_hits[edge] += 1
 
         # If they belong to the same chunk, we can try to find a path among
         # adjacent faces that connects them and label that as walkable. This
         # is a bit risky, as it might cross obstacles. We could add some
         # intersection detection here to be more careful.
-        try:
-            path = nx.astar_path(self.neighbors, face1, face2, heuristic=self.face_distance)
-        except nx.NodeNotFound:
-            return
-        except nx.NetworkXNoPath:
+        path, edges = self.find_face_path(face1, face2)
+        if path is None:
             return
 
-        for i in range(len(path) - 1):
-            hits = self.neighbors.edges[path[i], path[i+1]].get("hits", 0) + 1
-            self.neighbors.edges[path[i], path[i+1]]['hits'] = hits
+        np.add.at(self.edge_hits, edges, 1)
 
     def save(self, path):
         with open(path, "wb") as output:
@@ -149,11 +298,16 @@ class Chunk:
         self.mesh = mesh
 
         self.components, self.component_id = self.split_mesh(mesh)
+        self.set_neighbors(mesh)
+
+    def set_neighbors(self, mesh):
+        self.edges = walkable_edges(mesh)
+
+        centers = mesh.triangles_center
+        self.edge_weights = np.linalg.norm(centers[self.edges[:, 0]] - centers[self.edges[:, 1]], axis=1)
+        self.edge_hits = np.zeros(len(self.edges), dtype=int)
 
-        self.neighbors = nx.Graph()
-        for a, b in mesh.face_adjacency:
-            if mesh.face_normals[a, 1] >= walkable_threshold and mesh.face_normals[b, 1] >= walkable_threshold:
-                self.neighbors.add_edge(a, b, hits=0, weight=self.face_distance(a, b))
+        self.indptr, self.indices, self.edge_index = build_csr(len(mesh.faces), self.edges)
 
     @classmethod
     def load_from_cache(cls, path):
@@ -192,23 +346,10 @@ class Chunk:
         """
         Split mesh into connected components (bodies) by face adjacency.
 
-        Returns an array of length N, where N is the number of faces,
-        and the value is the the body ID.
+        Returns a list of face index arrays, one per component, and an array
+        of length N, where N is the number of faces, and the value is the
+        component ID.
         """
-        edges = []
-        for a, b in mesh.face_adjacency:
-            if mesh.face_normals[a, 1] >= walkable_threshold and mesh.face_normals[b, 1] >= walkable_threshold:
-                edges.append([a, b])
-
-        components = trimesh.graph.connected_components(
-                edges=edges,
-                nodes=np.arange(len(mesh.faces)),
-                min_len=1,
-                engine='networkx')
-
-        component_id = np.zeros(len(mesh.faces), dtype=int)
-
-        for i, component in enumerate(components):
-            component_id[component] = i
-
-        return components, component_id
+        if len(mesh.faces) == 0:
+            return [], np.zeros(0, dtype=int)
+        return label_components(len(mesh.faces), walkable_edges(mesh))
@@ -0,0 +1,154 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from .objfile import has_vertex_colors, surface_version
+
+
+GLB_MAGIC = 0x46546C67
+GLB_VERSION = 2
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+GLTF_FLOAT = 5126
+GLTF_UNSIGNED_BYTE = 5121
+GLTF_UNSIGNED_INT = 5125
+GLTF_ARRAY_BUFFER = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+GLTF_TRIANGLES = 4
+
+
+def pad4(length):
+    return (4 - length % 4) % 4
+
+
+class GlbPartCache:
+    """
+    Cache of binary glTF buffer data for the surfaces of a model.
+
+    Each surface is stored once as arrays in the layout of the GLB binary
+    chunk (float32 positions, uint32 indices, and uint8 RGBA colors), keyed
+    by the surface key and the same version as the OBJ fragments. Assembling
+    the model GLB file then only writes the JSON description and copies the
+    cached buffers, so the cost of preparing an export follows the size of
+    the changed surfaces.
+    """
+    def __init__(self, dir_path, include_color=False, transform=None):
+        self.dir_path = dir_path
+        self.include_color = include_color
+        self.transform = transform
+
+    def part(self, key, mesh):
+        """
+        Get the (positions, indices, colors) arrays for a surface, where
+        colors is None if the surface is exported without colors.
+        """
+        version = surface_version(mesh, self.include_color)
+        path = os.path.join(self.dir_path, "{}-{}.npz".format(key, version))
+
+        if os.path.exists(path):
+            with np.load(path) as data:
+                colors = data['colors'] if 'colors' in data else None
+                return os.path.basename(path), (data['positions'], data['indices'], colors)
+
+        vertices = np.asarray(mesh.vertices, dtype=float)
+        if self.transform is not None:
+            vertices = vertices @ self.transform[:3, :3].T + self.transform[:3, 3]
+
+        arrays = dict(
+            positions=vertices.astype(np.float32),
+            indices=np.asarray(mesh.faces, dtype=np.uint32).reshape(-1)
+        )
+        if self.include_color and has_vertex_colors(mesh):
+            arrays['colors'] = np.asarray(mesh.visual.vertex_colors, dtype=np.uint8)
+
+        temp_path = "{}.tmp-{}.npz".format(path, os.getpid())
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+        return os.path.basename(path), (arrays['positions'], arrays['indices'], arrays.get('colors'))
+
+    def assemble(self, meshes, output_path):
+        """
+        Write a GLB file for a list of (key, mesh) pairs.
+
+        Each surface is a mesh node named by its key. The output is written
+        under a temporary name and renamed into place. Parts which are no
+        longer used are removed.
+        """
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        used = set()
+        nodes = []
+        gltf_meshes = []
+        accessors = []
+        buffer_views = []
+        chunks = []
+        offset = 0
+
+        def add_view(array, target, component_type, gltf_type, **extra):
+            nonlocal offset
+            data = np.ascontiguousarray(array).tobytes()
+            buffer_views.append(dict(buffer=0, byteOffset=offset, byteLength=len(data), target=target))
+            accessor = dict(bufferView=len(buffer_views)-1, componentType=component_type, count=len(array), type=gltf_type)
+            accessor.update(extra)
+            accessors.append(accessor)
+
+            chunks.append(data)
+            chunks.append(b"\x00" * pad4(len(data)))
+            offset += len(data) + pad4(len(data))
+            return len(accessors) - 1
+
+        for key, mesh in meshes:
+            if len(mesh.faces) == 0:
+                continue
+
+            fname, (positions, indices, colors) = self.part(key, mesh)
+            used.add(fname)
+
+            attributes = dict(POSITION=add_view(positions, GLTF_ARRAY_BUFFER, GLTF_FLOAT, "VEC3",
+                min=positions.min(axis=0).tolist(), max=positions.max(axis=0).tolist()))
+            if colors is not None:
+                attributes['COLOR_0'] = add_view(colors, GLTF_ARRAY_BUFFER, GLTF_UNSIGNED_BYTE, "VEC4", normalized=True)
+            index_accessor = add_view(indices, GLTF_ELEMENT_ARRAY_BUFFER, GLTF_UNSIGNED_INT, "SCALAR")
+
+            gltf_meshes.append(dict(name=key, primitives=[dict(attributes=attributes, indices=index_accessor, mode=GLTF_TRIANGLES)]))
+            nodes.append(dict(name=key, mesh=len(gltf_meshes)-1))
+
+        gltf = dict(
+            asset=dict(version="2.0", generator="easyvizar-edge"),
+            scene=0,
+            scenes=[dict(nodes=list(range(len(nodes))))],
+            nodes=nodes,
+            meshes=gltf_meshes,
+            accessors=accessors,
+            bufferViews=buffer_views,
+            buffers=[dict(byteLength=offset)]
+        )
+        if len(nodes) == 0:
+            for name in ["nodes", "meshes", "accessors", "bufferViews", "buffers"]:
+                del gltf[name]
+
+        text = json.dumps(gltf, separators=(",", ":")).encode()
+        text += b" " * pad4(len(text))
+
+        length = 12 + 8 + len(text)
+        if offset > 0:
+            length += 8 + offset
+
+        temp_path = "{}.tmp-{}".format(output_path, os.getpid())
+        with open(temp_path, "wb") as output:
+            output.write(struct.pack("<III", GLB_MAGIC, GLB_VERSION, length))
+            output.write(struct.pack("<II", len(text), GLB_CHUNK_JSON))
+            output.write(text)
+            if offset > 0:
+                output.write(struct.pack("<II", offset, GLB_CHUNK_BIN))
+                for data in chunks:
+                    output.write(data)
+        os.replace(temp_path, output_path)
+
+        for fname in os.listdir(self.dir_path):
+            if fname not in used:
+                os.remove(os.path.join(self.dir_path, fname))
@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import trimesh
+
+from .objfile import has_vertex_colors, surface_version
+
+
+# Grid cell size (meters) for the first level of detail. Each following
+# level doubles the cell size. Level zero is the full resolution model.
+LOD_BASE_CELL_SIZE = 0.1
+
+
+def lod_cell_size(level):
+    return LOD_BASE_CELL_SIZE * 2 ** (level - 1)
+
+
+def cluster_vertices(vertices, faces, cell_size, vertex_colors=None):
+    """
+    Simplify a mesh by vertex clustering.
+
+    Vertices are grouped by the cell of a regular grid that they fall in,
+    and each group is replaced by its mean position and mean color. Faces
+    that collapse to a line or point are removed, as are duplicate faces.
+
+    Returns (vertices, faces, vertex colors), where vertex colors is None if
+    none were given.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    faces = np.asarray(faces, dtype=int).reshape(-1, 3)
+
+    cells = np.floor(vertices / cell_size).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    def cluster_mean(values):
+        sums = np.column_stack([np.bincount(inverse, weights=values[:, i], minlength=len(counts)) for i in range(values.shape[1])])
+        return sums / counts[:, np.newaxis]
+
+    new_faces = inverse[faces]
+
+    # Drop degenerate faces, and then faces with the same vertices in any
+    # order, keeping the first of each.
+    keep = (new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2]) & (new_faces[:, 0] != new_faces[:, 2])
+    new_faces = new_faces[keep]
+    _, first = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(first)]
+
+    # Only keep the clusters that are still used by some face.
+    used = np.unique(new_faces)
+    remap = np.full(len(counts), -1, dtype=int)
+    remap[used] = np.arange(len(used))
+
+    new_vertices = cluster_mean(vertices)[used]
+    new_colors = None
+    if vertex_colors is not None:
+        colors = np.asarray(vertex_colors, dtype=float)
+        new_colors = np.round(cluster_mean(colors)[used]).astype(np.uint8)
+
+    return new_vertices, remap[new_faces].reshape(-1, 3), new_colors
+
+
+def simplify_surface(mesh, level, include_color=False):
+    """
+    Make a simplified copy of a surface for a level of detail.
+    """
+    colors = None
+    if include_color and has_vertex_colors(mesh):
+        colors = mesh.visual.vertex_colors
+
+    vertices, faces, colors = cluster_vertices(mesh.vertices, mesh.faces, lod_cell_size(level), colors)
+    return make_lod_mesh(mesh, vertices, faces, colors)
+
+
+def make_lod_mesh(mesh, vertices, faces, colors):
+    simplified = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_colors=colors, process=False, validate=False)
+    simplified.metadata['name'] = mesh.metadata.get('name')
+    simplified.metadata['mtime'] = mesh.metadata.get('mtime')
+
+    # Simplified colors only change with the colors of the surface, so the
+    # color checksum of the surface can stand in for them.
+    if colors is not None and 'color_version' in mesh.metadata:
+        simplified.metadata['color_version'] = mesh.metadata['color_version']
+    return simplified
+
+
+class LodCache:
+    """
+    Cache of simplified surfaces on disk.
+
+    Entries are keyed by surface key, surface version, and level, so a
+    surface is only simplified again after it is modified or recolored.
+    Entries are written under a temporary name and renamed into place.
+    """
+    def __init__(self, dir_path, include_color=False):
+        self.dir_path = dir_path
+        self.include_color = include_color
+
+    def get(self, key, mesh, level):
+        version = surface_version(mesh, self.include_color)
+        path = os.path.join(self.dir_path, "{}-{}-{}.npz".format(key, version, level))
+
+        if os.path.exists(path):
+            with np.load(path) as data:
+                colors = data['colors'] if 'colors' in data else None
+                return make_lod_mesh(mesh, data['vertices'], data['faces'], colors)
+
+        simplified = simplify_surface(mesh, level, self.include_color)
+
+        arrays = dict(vertices=simplified.vertices, faces=simplified.faces)
+        if has_vertex_colors(simplified):
+            arrays['colors'] = simplified.visual.vertex_colors
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        temp_path = "{}.tmp-{}.npz".format(path, os.getpid())
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+        return simplified
+
+    def prune(self, level, meshes):
+        """
+        Remove entries for a level that are not for one of the given
+        (key, mesh) pairs, i.e. old versions and removed surfaces.
+        """
+        if not os.path.isdir(self.dir_path):
+            return
+
+        used = set("{}-{}-{}.npz".format(key, surface_version(mesh, self.include_color), level) for key, mesh in meshes)
+        suffix = "-{}.npz".format(level)
+        for fname in os.listdir(self.dir_path):
+            if fname.endswith(suffix) and fname not in used:
+                os.remove(os.path.join(self.dir_path, fname))
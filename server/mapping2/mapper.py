@@ -1,16 +1,19 @@
 import asyncio
 import datetime
+import json
 import os
 import sys
 import tempfile
 import time
 import uuid
+import zlib
 
 import sqlalchemy as sa
 
 from server.layer.models import Layer, LayerSchema
 from server.location.models import Location
 from server.mapping.obj_file import ObjFileMaker
+from server.mapping2.objfile import surface_version
 from server.mapping2.scene import LocationModel, MeshColorSource
 from server.models.device_poses import DevicePose
 from server.models.surfaces import Surface
@@ -18,7 +21,7 @@ from server.models.photo_records import PhotoRecord
 from server.models.tracking_sessions import TrackingSession
 from server.surface.models import SurfaceSchema
 
-from .navmesh import NavigationMesh
+from .navmesh import NavigationMesh, NavigationMeshCache
 from .soup import LayerConfig, MeshSoup
 
 
@@ -29,6 +32,130 @@ surface_schema = SurfaceSchema()
 # Trimesh is faster but does not break out the individual mesh fragments.
 use_trimesh_obj_export = True
 
+# Number of worker processes for parsing surface files when the model is
+# built from scratch. Set to None to load surfaces serially.
+surface_loading_workers = min(4, os.cpu_count() or 1)
+
+# Number of worker processes for projecting photos onto the model. Photos are
+# applied in batches of a few per worker, so that the time limit on modeling
+# tasks is still checked regularly. Set to None to apply photos serially.
+color_projection_workers = min(4, os.cpu_count() or 1)
+color_projection_batch_size = 4 * (color_projection_workers or 1)
+
+# Levels of detail to export in addition to the full resolution model. Each
+# level doubles the grid cell size used to simplify the surfaces. Every level
+# is written as OBJ and GLB for both the plain and colored models, so only
+# one simplified level is exported by default.
+model_lod_levels = [1]
+
+# Memory budget for navigation meshes kept in memory for path queries.
+navmesh_cache_max_bytes = 256 * 1024 * 1024
+
+
+def model_file_paths(location_dir, name, lod=None):
+    """
+    List the OBJ and GLB files written by export_model, or only those for
+    one level of detail if lod is set.
+    """
+    levels = [0] + model_lod_levels if lod is None else [lod]
+
+    paths = []
+    for lod in levels:
+        suffix = "-lod{}".format(lod) if lod > 0 else ""
+        base_path = os.path.join(location_dir, name + suffix)
+        paths.extend([base_path + ".obj", base_path + ".glb"])
+    return paths
+
+
+def model_inputs_version(scene, include_color=False):
+    """
+    Compute a version string for the surfaces that make up an exported
+    model, which changes when a surface is added, removed, modified, or
+    recolored.
+    """
+    checksum = 0
+    for key in scene.arena.keys():
+        version = surface_version(scene.scene.geometry[key], include_color)
+        checksum = zlib.crc32("{} {}\n".format(key, version).encode(), checksum)
+    return "{:08x}".format(checksum)
+
+
+def export_model(scene, location_dir, name, include_color=False, cache_dir=None, updated_surfaces=None):
+    """
+    Export the model as OBJ and GLB files at full resolution and at each of
+    the levels of detail, e.g. model.obj and model-lod1.obj.
+
+    If cache_dir is set, per-surface OBJ fragments, GLB parts, and simplified
+    surfaces are cached there, so only changed surfaces are processed again.
+    The version of the surfaces used for each level is also recorded there,
+    and levels whose files were written from the same surfaces are skipped.
+
+    If updated_surfaces is given and empty, and all of the files exist, the
+    files are left as they are.
+
+    Returns True if any of the files were written.
+    """
+    if updated_surfaces is not None and len(updated_surfaces) == 0 and \
+            all(os.path.exists(path) for path in model_file_paths(location_dir, name)):
+        return False
+
+    remove_stale_levels(location_dir, name)
+
+    exported = dict()
+    exported_path = None
+    version = None
+    if cache_dir is not None:
+        exported_path = os.path.join(cache_dir, "{}_exports.json".format(name))
+        if os.path.exists(exported_path):
+            with open(exported_path, "r") as source:
+                exported = json.load(source)
+        version = model_inputs_version(scene, include_color)
+
+    written = False
+    for lod in [0] + model_lod_levels:
+        suffix = "-lod{}".format(lod) if lod > 0 else ""
+
+        if version is not None and exported.get(str(lod)) == version and \
+                all(os.path.exists(path) for path in model_file_paths(location_dir, name, lod)):
+            continue
+
+        fragment_dir = None
+        part_dir = None
+        lod_dir = None
+        if cache_dir is not None:
+            fragment_dir = os.path.join(cache_dir, "{}{}_fragments".format(name, suffix))
+            part_dir = os.path.join(cache_dir, "{}{}_glb_parts".format(name, suffix))
+            lod_dir = os.path.join(cache_dir, "{}_lod".format(name))
+
+        base_path = os.path.join(location_dir, name + suffix)
+        scene.export_obj(base_path + ".obj", include_color=include_color, fragment_dir=fragment_dir, lod=lod, lod_dir=lod_dir)
+        scene.export_glb(base_path + ".glb", include_color=include_color, lod=lod, lod_dir=lod_dir, part_dir=part_dir)
+        written = True
+
+        if exported_path is not None:
+            exported[str(lod)] = version
+            temp_path = "{}.tmp-{}".format(exported_path, os.getpid())
+            with open(temp_path, "w") as output:
+                json.dump(exported, output)
+            os.replace(temp_path, exported_path)
+
+    return written
+
+
+def remove_stale_levels(location_dir, name):
+    """
+    Remove model files for levels of detail that are no longer exported, so
+    that they are not served in place of the full resolution model.
+    """
+    if not os.path.isdir(location_dir):
+        return
+
+    current = set(os.path.basename(path) for path in model_file_paths(location_dir, name))
+    prefix = "{}-lod".format(name)
+    for fname in os.listdir(location_dir):
+        if fname.startswith(prefix) and fname.endswith((".obj", ".glb")) and fname not in current:
+            os.remove(os.path.join(location_dir, fname))
+
 
 def get_location_dir(data_dir, location_id):
     return os.path.join(data_dir, "locations", location_id.hex)
@@ -39,9 +166,10 @@ def get_layer_dir(data_dir, location_id, layer_id):
 
 
 class MappingTaskResult:
-    def __init__(self, soup, excluded=None, last_source=None, updated_surfaces=None, unfinished_sources=None):
+    def __init__(self, soup, excluded=None, last_source=None, updated_surfaces=None, unfinished_sources=None, model_version=None):
         self.bounding_box = soup.get_bounding_box()
         self.last_source = last_source
+        self.model_version = model_version
 
         if excluded is None:
             self.excluded = set()
@@ -74,26 +202,32 @@ class MappingTask:
     def run(self):
         start = time.time()
 
+        store_dir = os.path.join(self.location_dir, "model_store")
         scene_file = os.path.join(self.location_dir, "model.pickle")
         model_obj = os.path.join(self.location_dir, "model.obj")
 
-        if os.path.exists(scene_file):
+        if os.path.exists(store_dir):
+            print("Load scene from {}".format(store_dir))
+            scene = LocationModel.from_store(store_dir)
+            updated_surfaces = scene.update_from_directory(self.mesh_dir)
+        elif os.path.exists(scene_file):
             print("Load scene from {}".format(scene_file))
             scene = LocationModel.from_pickle(scene_file)
-            scene.update_from_directory(self.mesh_dir)
+            updated_surfaces = scene.update_from_directory(self.mesh_dir)
         elif os.path.exists(model_obj):
             print("Load scene from {}".format(model_obj))
             scene = LocationModel.from_obj(model_obj)
-            scene.update_from_directory(self.mesh_dir)
+            updated_surfaces = scene.update_from_directory(self.mesh_dir)
         else:
             print("Load scene from {}".format(self.mesh_dir))
-            scene = LocationModel.from_directory(self.mesh_dir)
+            scene = LocationModel.from_directory(self.mesh_dir, workers=surface_loading_workers)
+            updated_surfaces = set(scene.surface_ids)
 
         if self.layer_configs is not None:
             scene.infer_walls(self.layer_configs)
 
-        scene.export_obj(model_obj)
-        scene.save(scene_file)
+        export_model(scene, self.location_dir, "model", cache_dir=self.cache_dir, updated_surfaces=updated_surfaces)
+        scene.save_store(store_dir)
 
 #        if self.traces is not None:
 #            for times, points in self.traces:
@@ -110,8 +244,9 @@ class MappingTask:
 
 
 class ModelingTask:
-    def __init__(self, mesh_dir, cache_dir=None, exclude_chunks=set(), layer_configs=None, location_dir=None, navmesh_path=None, color_sources=None, traces=None):
+    def __init__(self, mesh_dir, cache_dir=None, exclude_chunks=set(), layer_configs=None, location_dir=None, navmesh_path=None, color_sources=None, traces=None, model_version=0):
         self.location_dir = location_dir
+        self.model_version = model_version
         self.mesh_dir = mesh_dir
         self.navmesh_path = navmesh_path
 
@@ -126,13 +261,18 @@ class ModelingTask:
     def run(self):
         start = time.time()
 
+        store_dir = os.path.join(self.location_dir, "colored_store")
         scene_file = os.path.join(self.location_dir, "colored.pickle")
         model_obj = os.path.join(self.location_dir, "model.obj")
-        colored_obj = os.path.join(self.location_dir, "colored.obj")
         colored_surfaces_dir = os.path.join(self.location_dir, "colored_surfaces")
+        surface_versions_file = os.path.join(self.location_dir, "surface_versions.json")
 
         updated_surfaces = set()
-        if os.path.exists(scene_file):
+        if os.path.exists(store_dir):
+            print("Load scene from {}".format(store_dir))
+            scene = LocationModel.from_store(store_dir)
+            updated_surfaces = scene.update_from_directory(self.mesh_dir)
+        elif os.path.exists(scene_file):
             print("Load scene from {}".format(scene_file))
             scene = LocationModel.from_pickle(scene_file)
             updated_surfaces = scene.update_from_directory(self.mesh_dir)
@@ -142,32 +282,53 @@ class ModelingTask:
             updated_surfaces = scene.update_from_directory(self.mesh_dir)
         else:
             print("Load scene from {}".format(self.mesh_dir))
-            scene = LocationModel.from_directory(self.mesh_dir)
+            scene = LocationModel.from_directory(self.mesh_dir, workers=surface_loading_workers)
             updated_surfaces = set(scene.surface_ids)
 
         last_source = None
+        model_version = None
         unfinished_sources = set(self.color_sources)
         if self.color_sources is not None:
+            pending = []
             for source in self.color_sources:
-                if source not in scene.color_sources:
-                    colored_surfaces = scene.apply_color_source(source)
-                    updated_surfaces.update(colored_surfaces)
-                    last_source = source
-
-                unfinished_sources.remove(source)
+                if source in scene.color_sources:
+                    unfinished_sources.remove(source)
+                else:
+                    pending.append(source)
+
+            for i in range(0, len(pending), color_projection_batch_size):
+                batch = pending[i:i+color_projection_batch_size]
+                colored_surfaces = scene.apply_color_sources(batch, workers=color_projection_workers)
+                updated_surfaces.update(colored_surfaces)
+                last_source = batch[-1]
+
+                unfinished_sources.difference_update(batch)
                 if time.time() - start > self.max_run_time:
                     break
 
-            scene.export_obj(colored_obj, include_color=True)
-            scene.save(scene_file)
+            export_model(scene, self.location_dir, "colored", include_color=True, cache_dir=self.cache_dir, updated_surfaces=updated_surfaces)
+
+            # Record the changed surfaces, so that clients can download only
+            # those instead of the full model. If nothing changed, the model
+            # version stays the same.
+            if len(updated_surfaces) > 0 or scene.tracked_since is None:
+                model_version = scene.record_changes(updated_surfaces, self.model_version)
+            else:
+                model_version = max(scene.version, self.model_version)
+            scene.save_store(store_dir)
 
         os.makedirs(colored_surfaces_dir, exist_ok=True)
         for surface_id in updated_surfaces:
             scene.export_surface_obj(surface_id, colored_surfaces_dir, include_color=True)
 
+        # Write the change versions after the surface files they refer to.
+        if model_version is not None:
+            scene.export_surface_versions(surface_versions_file)
+
         duration = time.time() - start
         print("ModelingTask completed in {:.3f} seconds ending on source {} with {} unfinished".format(duration, last_source, len(unfinished_sources)))
-        result = MappingTaskResult(scene, last_source=last_source, updated_surfaces=updated_surfaces, unfinished_sources=unfinished_sources)
+        result = MappingTaskResult(scene, last_source=last_source, updated_surfaces=updated_surfaces,
+                unfinished_sources=unfinished_sources, model_version=model_version)
         return result
 
 
@@ -178,20 +339,53 @@ class Mapper:
 
         self.current_app = current_app
 
+        self.navmesh_cache = NavigationMeshCache(max_bytes=navmesh_cache_max_bytes)
+
     def find_path(self, location_id, start, end):
+        """
+        Find a path between two points.
+
+        This blocks while the navigation mesh is loaded and searched, so it
+        should be called from a worker thread rather than the event loop.
+        """
         location_dir = get_location_dir(self.data_dir, location_id)
         navmesh_path = os.path.join(location_dir, "navmesh.pickle")
-        if not os.path.exists(navmesh_path):
-            return [start, end]
 
         try:
-            navmesh = NavigationMesh.load(navmesh_path)
+            navmesh = self.navmesh_cache.get(navmesh_path)
+            if navmesh is None:
+                return [start, end]
+
             path = navmesh.find_path(start, end)
             return path.tolist()
 
         except:
             return [start, end]
 
+    def find_paths(self, location_id, starts, end):
+        """
+        Find paths from several starting points to a common destination.
+
+        Paths are found by walking a shortest path tree toward the destination,
+        which is computed once and cached with the navigation mesh, so it is
+        reused until the map changes. Like find_path, this blocks and should
+        be called from a worker thread.
+        """
+        location_dir = get_location_dir(self.data_dir, location_id)
+        navmesh_path = os.path.join(location_dir, "navmesh.pickle")
+
+        try:
+            navmesh = self.navmesh_cache.get(navmesh_path)
+            if navmesh is None:
+                return [[start, end] for start in starts]
+
+            paths = navmesh.find_paths_to(starts, end)
+
+        except:
+            return [[start, end] for start in starts]
+
+        return [[start, end] if path is None else path.tolist() for path in paths]
+
     async def find_photos(self, location_id, last_color_source_id=None):
         sources = []
 
@@ -307,14 +501,20 @@ class Mapper:
             os.makedirs(cache_dir, exist_ok=True)
 
         return ModelingTask(mesh_dir, cache_dir=cache_dir,
-                location_dir=location_dir, color_sources=photos)
+                location_dir=location_dir, color_sources=photos,
+                model_version=location.model_version)
 
     async def finish_model_update(self, location_id, result):
         async with self.current_app.session_maker() as session:
             location = await session.get(Location, location_id)
             if result.last_source is not None:
                 location.last_color_source_id = result.last_source.id
-            location.model_version += 1
+            # The modeling task records surface changes under the version it
+            # returns, which is always newer than the version it started from.
+            if result.model_version is not None:
+                location.model_version = max(location.model_version, result.model_version)
+            else:
+                location.model_version += 1
             await session.commit()
 
     async def try_start_map_update(self, location_id):
@@ -382,14 +582,41 @@ class Mapper:
         await self.try_start_map_update(location_id)
 
 
+def benchmark_surface_loading(mesh_dir, workers):
+    start = time.time()
+    serial = LocationModel.from_directory(mesh_dir)
+    serial_time = time.time() - start
+
+    start = time.time()
+    parallel = LocationModel.from_directory(mesh_dir, workers=workers)
+    parallel_time = time.time() - start
+
+    print("Serial loading: {} surfaces in {:.3f} seconds".format(len(serial.surface_ids), serial_time))
+    print("Parallel loading ({} workers): {} surfaces in {:.3f} seconds".format(workers, len(parallel.surface_ids), parallel_time))
+
+    if serial.surface_ids != parallel.surface_ids:
+        print("Warning: serial and parallel loading kept different surfaces")
+
+
 if __name__=="__main__":
-    if len(sys.argv) < 2:
-        print("Usage: {} <surfaces directory> [cache_dir]".format(sys.argv[0]))
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if len(args) < 1:
+        print("Usage: {} [--benchmark-loading] [--workers=N] <surfaces directory> [cache_dir]".format(sys.argv[0]))
         sys.exit(1)
 
-    if len(sys.argv) >= 3:
-        cache_dir = sys.argv[2]
+    workers = surface_loading_workers
+    for arg in sys.argv[1:]:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+
+    if "--benchmark-loading" in sys.argv:
+        benchmark_surface_loading(args[0], workers)
+        sys.exit(0)
+
+    if len(args) >= 2:
+        cache_dir = args[1]
     else:
         cache_dir = None
 
-    soup = MeshSoup.from_directory(sys.argv[1], cache_dir=cache_dir)
+    soup = MeshSoup.from_directory(args[0], cache_dir=cache_dir)
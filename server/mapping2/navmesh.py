@@ -1,5 +1,8 @@
+import collections
+import os
 import pickle
 import sys
+import threading
 
 import networkx as nx
 import numpy as np
@@ -18,11 +21,31 @@ class NavigationMesh:
 
     down = np.array([0, -1, 0])
 
+    # Maximum number of shortest path trees to keep for batch route queries.
+    max_route_trees = 16
+
     def __init__(self, mesh=None, graph=None, component_ids=None):
         self.mesh = mesh
         self.graph = graph
         self.component_ids = component_ids
 
+        self._init_route_trees()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_route_trees']
+        del state['_route_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_route_trees()
+
+    def _init_route_trees(self):
+        # Map from destination component to shortest path tree, in order of use.
+        self._route_trees = collections.OrderedDict()
+        self._route_lock = threading.Lock()
+
     def component_distance(self, comp1, comp2, *args):
         """
         Compute distance between two components.
@@ -65,7 +88,50 @@ class NavigationMesh:
         location, index_ray, index_tri = self.mesh.ray.intersects_location(ray_origins=[point], ray_directions=[self.down], multiple_hits=False)
         if len(index_tri) == 0:
             return None, None
-        return index_tri[0], location
+        return index_tri[0], location[0]
+
+    def find_components(self, points):
+        """
+        Find the components immediately below several points at once.
+
+        Returns a list of (component index, intersection point) pairs, which
+        are (None, None) for points with nothing below them.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        directions = np.tile(self.down, (len(points), 1))
+        location, index_ray, index_tri = self.mesh.ray.intersects_location(ray_origins=points, ray_directions=directions, multiple_hits=False)
+
+        result = [(None, None)] * len(points)
+        for i, face, point in zip(index_ray, index_tri, location):
+            result[i] = (self.component_ids[face], point)
+        return result
+
+    def get_route_tree(self, destination):
+        """
+        Get the shortest path tree toward a destination component.
+
+        The tree maps each component that can reach the destination to the
+        next component on a shortest path. Trees are cached, so routing many
+        starting points to the same destination costs one graph search.
+        """
+        with self._route_lock:
+            tree = self._route_trees.get(destination)
+            if tree is not None:
+                self._route_trees.move_to_end(destination)
+                return tree
+
+        # The graph is undirected, so a search outward from the destination
+        # gives shortest paths toward it.
+        pred, dist = nx.dijkstra_predecessor_and_distance(self.graph, destination)
+        tree = {node: parents[0] for node, parents in pred.items() if len(parents) > 0}
+        tree[destination] = None
+
+        with self._route_lock:
+            self._route_trees[destination] = tree
+            while len(self._route_trees) > self.max_route_trees:
+                self._route_trees.popitem(last=False)
+
+        return tree
 
     def find_path(self, start, end):
         """
@@ -85,6 +151,36 @@ class NavigationMesh:
         if path is None:
             path = []
 
+        return self.path_vertices(path, start_floor_point, end_floor_point)
+
+    def find_paths_to(self, starts, end):
+        """
+        Find walkable paths from several starting points to one destination.
+
+        Returns a list with an array of path vertices for each starting point,
+        or None where no path was found.
+        """
+        j, end_floor_point = self.find_component(end)
+        if j is None:
+            raise Exception("No component found below ending point")
+
+        tree = self.get_route_tree(j)
+
+        paths = []
+        for i, start_floor_point in self.find_components(starts):
+            if i is None or i not in tree:
+                paths.append(None)
+                continue
+
+            path = [i]
+            while tree[path[-1]] is not None:
+                path.append(tree[path[-1]])
+
+            paths.append(self.path_vertices(path, start_floor_point, end_floor_point))
+
+        return paths
+
+    def path_vertices(self, path, start_floor_point, end_floor_point):
         vertices = [start_floor_point]
 
         # Skip the first and last vertices in the path. They are the centers of
@@ -98,9 +194,41 @@ class NavigationMesh:
 
         return np.array(vertices)
 
+    def prepare(self):
+        """
+        Build the derived data used by path queries ahead of time.
+
+        This includes the ray intersector acceleration structure, which is
+        otherwise built on the first query.
+        """
+        if self.mesh is not None and len(self.mesh.faces) > 0:
+            self.mesh.triangles_center
+            self.mesh.ray.intersects_any(ray_origins=[self.mesh.centroid], ray_directions=[self.down])
+
+    def estimate_size(self):
+        """
+        Estimate the memory used by the navigation mesh in bytes.
+        """
+        size = 0
+        if self.mesh is not None:
+            size += self.mesh.vertices.nbytes + self.mesh.faces.nbytes
+
+            # The ray intersector keeps its own copy of the triangles.
+            size += len(self.mesh.faces) * 9 * 8
+        if self.component_ids is not None:
+            size += np.asarray(self.component_ids).nbytes
+        if self.graph is not None:
+            # Rough allowance for the networkx dictionaries.
+            size += 500 * (self.graph.number_of_nodes() + self.graph.number_of_edges())
+        return size
+
     def save(self, path):
-        with open(path, "wb") as output:
+        # Write to a temporary file and move it into place, so that readers
+        # never load a partially written file.
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(temp_path, "wb") as output:
             pickle.dump(self, output)
+        os.replace(temp_path, path)
 
     def show(self):
         # Choose a random color for each component in the mesh and color the
@@ -136,6 +264,72 @@ class NavigationMesh:
             return pickle.load(source)
 
 
+class NavigationMeshCache:
+    """
+    In-memory cache of navigation meshes loaded from pickle files.
+
+    An entry is reloaded when the modified time of its file changes. The
+    least recently used entries are evicted when the estimated total size
+    exceeds max_bytes, but the most recent entry is always kept. Loaded
+    meshes are prepared for queries before they are added to the cache.
+
+    The cache may be used from multiple threads.
+    """
+
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+        # Map from path to (mtime, navigation mesh, estimated size).
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        """
+        Get the navigation mesh stored at path or None if it does not exist.
+        """
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            self.discard(path)
+            return None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(path)
+                return entry[1]
+
+        # Load outside of the lock so that queries for other locations are
+        # not held up. Two threads may occasionally load the same file.
+        navmesh = NavigationMesh.load(path)
+        navmesh.prepare()
+        size = navmesh.estimate_size()
+
+        with self.lock:
+            self._discard(path)
+            self.entries[path] = (mtime, navmesh, size)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                self._discard(oldest)
+
+        return navmesh
+
+    def discard(self, path):
+        with self.lock:
+            self._discard(path)
+
+    def _discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: {} <navmesh.pickle file>".format(sys.argv[0]))
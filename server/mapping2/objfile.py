@@ -0,0 +1,144 @@
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from trimesh import util
+
+
+def has_vertex_colors(mesh):
+    return mesh.visual.kind in ["vertex", "face"] and len(mesh.visual.vertex_colors) > 0
+
+
+def color_version(mesh):
+    """
+    Get a checksum of the vertex colors of a surface.
+
+    The checksum is kept in the mesh metadata, so that it is computed once
+    for all of the exports of a surface. Code that changes the colors of a
+    surface must remove it from the metadata.
+    """
+    checksum = mesh.metadata.get('color_version')
+    if checksum is None:
+        checksum = zlib.crc32(np.ascontiguousarray(mesh.visual.vertex_colors[:, 0:3]))
+        mesh.metadata['color_version'] = checksum
+    return checksum
+
+
+def surface_version(mesh, include_color=False):
+    """
+    Compute a version string for a surface, which changes when the surface
+    is modified or, if include_color is set, when it is recolored.
+    """
+    checksum = zlib.crc32("{!r} {} {}".format(mesh.metadata.get('mtime'), len(mesh.vertices), len(mesh.faces)).encode())
+    if include_color and has_vertex_colors(mesh):
+        checksum = zlib.crc32(color_version(mesh).to_bytes(4, "little"), checksum)
+    return "{:08x}".format(checksum)
+
+
+class ObjFragmentCache:
+    """
+    Cache of OBJ text fragments for the surfaces of a model.
+
+    Each surface is written once as a vertex text fragment keyed by the
+    surface key and a version computed from its mtime and colors. OBJ face
+    indices refer to all vertices in the file, so face text fragments are
+    also keyed by the vertex offset of the surface. Changing a surface only
+    formats the text for that surface again, and the surfaces before it
+    reuse their fragments as they are. Face text is formatted again for the
+    surfaces after it only if their vertex offsets moved.
+    """
+    def __init__(self, dir_path, include_color=False, digits=3, transform=None):
+        self.dir_path = dir_path
+        self.include_color = include_color
+        self.digits = digits
+        self.transform = transform
+
+    def version(self, mesh):
+        """
+        Compute a version string that changes when the exported text would.
+        """
+        return surface_version(mesh, self.include_color)
+
+    def has_color(self, mesh):
+        return self.include_color and has_vertex_colors(mesh)
+
+    def prepare_mesh(self, mesh):
+        if self.transform is not None:
+            mesh = mesh.copy()
+            mesh.apply_transform(self.transform)
+        return mesh
+
+    def write_fragment(self, path, text):
+        """
+        Write a fragment under a temporary name and rename it into place, so
+        that a partially written fragment is never used.
+        """
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(temp_path, "w") as output:
+            output.write(text)
+        os.replace(temp_path, path)
+
+    def vertex_fragment(self, key, mesh, version):
+        path = os.path.join(self.dir_path, "{}-{}.v".format(key, version))
+        if os.path.exists(path):
+            return path
+
+        mesh = self.prepare_mesh(mesh)
+        if self.has_color(mesh):
+            blob = np.column_stack((mesh.vertices, mesh.visual.vertex_colors[:, 0:3] / 255.0))
+        else:
+            blob = mesh.vertices
+
+        text = "o {}\nv {}\n".format(key, util.array_to_string(blob, col_delim=" ", row_delim="\nv ", digits=self.digits))
+        self.write_fragment(path, text)
+        return path
+
+    def face_fragment(self, key, mesh, version, offset):
+        path = os.path.join(self.dir_path, "{}-{}-{}.f".format(key, version, offset))
+        if os.path.exists(path):
+            return path
+
+        # OBJ face indices are one-based and refer to all vertices in the
+        # file, so they depend on the surfaces that come before this one.
+        faces = np.asarray(mesh.faces, dtype=np.int64) + (offset + 1)
+
+        text = "f {}\n\n".format(util.array_to_string(faces, col_delim=" ", row_delim="\nf "))
+        self.write_fragment(path, text)
+        return path
+
+    def assemble(self, meshes, output_path):
+        """
+        Write an OBJ file for a list of (key, mesh) pairs.
+
+        The output is written under a temporary name and renamed into place,
+        so readers never observe a partially written file. Fragments which
+        are no longer used are removed.
+        """
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        used = set()
+        temp_path = "{}.tmp-{}".format(output_path, os.getpid())
+        with open(temp_path, "wb") as output:
+            offset = 0
+            for key, mesh in meshes:
+                if len(mesh.faces) == 0:
+                    continue
+
+                version = self.version(mesh)
+
+                vertex_path = self.vertex_fragment(key, mesh, version)
+                face_path = self.face_fragment(key, mesh, version, offset)
+                for path in [vertex_path, face_path]:
+                    with open(path, "rb") as source:
+                        shutil.copyfileobj(source, output)
+                    used.add(os.path.basename(path))
+
+                offset += len(mesh.vertices)
+
+        os.replace(temp_path, output_path)
+
+        for fname in os.listdir(self.dir_path):
+            if fname not in used:
+                os.remove(os.path.join(self.dir_path, fname))
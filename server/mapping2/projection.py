@@ -0,0 +1,200 @@
+import numpy as np
+import trimesh
+
+
+def cull_surfaces(color_source, keys, bounds, right_handed=True):
+    """
+    Find the surfaces whose bounding boxes intersect the view frustum of a
+    color source.
+
+    This is conservative, i.e. it may include some surfaces which are not
+    actually in view, but it never excludes a surface that is.
+    """
+    if len(keys) == 0:
+        return []
+
+    position, normals = color_source.compute_frustum(right_handed)
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 2, 3)
+
+    # For each plane, test the box corner furthest along the plane normal.
+    # The box is outside if that corner is behind any of the planes.
+    corners = np.where(normals[np.newaxis, :, :] >= 0, bounds[:, 1:2, :], bounds[:, 0:1, :])
+    distances = np.sum((corners - position) * normals[np.newaxis, :, :], axis=2)
+    in_view = np.all(distances >= 0, axis=1)
+
+    return [key for key, x in zip(keys, in_view) if x]
+
+
+def project_color_source(mesh, color_source, right_handed=True, max_distances=None):
+    """
+    Project the pixels of a color source onto a mesh.
+
+    Each ray that hits the mesh contributes its pixel color to the three
+    vertices of the triangle it hit, weighted by the barycentric coordinates
+    of the hit point. If max_distances is given, rays that hit the mesh
+    further away than their entry in it are ignored, e.g. because they are
+    blocked by other geometry.
+
+    Returns the indices of the vertices that received any contribution and,
+    for each of those, the sum of weighted colors and the sum of weights.
+    Also returns the index and hit distance of each ray that was used, and
+    the first vertex of the face that it hit.
+    """
+    origins, directions, colors = color_source.generate_rays(right_handed)
+
+    points, index_ray, index_tri = mesh.ray.intersects_location(origins, directions, multiple_hits=False)
+
+    distances = np.linalg.norm(points - origins[index_ray], axis=1).astype(np.float32)
+    if max_distances is not None:
+        keep = distances <= max_distances[index_ray]
+        points = points[keep]
+        index_ray = index_ray[keep]
+        index_tri = index_tri[keep]
+        distances = distances[keep]
+
+    if len(points) == 0:
+        hits = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=int))
+        return np.zeros(0, dtype=int), np.zeros((0, 3)), np.zeros(0), hits
+
+    # Triangle vertex indices, vertex positions, and pixel color for each
+    # ray that hit the mesh.
+    hit_faces = mesh.faces[index_tri]
+    hit_triangle_vertices = mesh.vertices[hit_faces]
+    ray_colors = colors[index_ray, 0:3]
+
+    # Compute barycentric coordinates for each ray's collision point.
+    barycentric = trimesh.triangles.points_to_barycentric(hit_triangle_vertices, points)
+
+    # Accumulate color and weight contributions from each ray onto the
+    # three vertices of the triangle that it hit. Rays frequently share
+    # vertices, so this needs to be an unbuffered scatter-add.
+    num_vertices = len(mesh.vertices)
+    hit_vertices = hit_faces.reshape(-1)
+    weighted_color = barycentric[:, :, np.newaxis] * ray_colors[:, np.newaxis, :]
+
+    acc_weight = np.bincount(hit_vertices, weights=barycentric.reshape(-1), minlength=num_vertices)
+    acc_color = np.zeros((num_vertices, 3))
+    np.add.at(acc_color, hit_vertices, weighted_color.reshape(-1, 3))
+
+    touched = np.flatnonzero(acc_weight > 0)
+    hits = (index_ray.astype(np.int32), distances, hit_faces[:, 0])
+    return touched, acc_color[touched], acc_weight[touched], hits
+
+
+def group_hits(arena, hits):
+    """
+    Group ray hits by the surface that they hit.
+
+    Returns a dictionary from surface key to the ray indices and hit
+    distances for that surface.
+    """
+    index_ray, distances, vertices = hits
+
+    slots = arena.vertex_slots(vertices)
+    order = np.argsort(slots, kind='stable')
+    unique, starts = np.unique(slots[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    result = dict()
+    for slot, start, end in zip(unique, starts, ends):
+        result[arena.slot_keys[slot]] = (index_ray[order[start:end]], distances[order[start:end]])
+    return result
+
+
+def project_color_sources(arena, surface_bounds, sources, right_handed=True):
+    """
+    Project several color sources onto the surfaces in an arena and sum
+    their contributions.
+
+    This is a module-level function so that it can run in a worker process.
+    The sources argument is a list of (color source, excluded keys) pairs.
+    Surfaces with excluded keys still block rays, but they do not receive
+    contributions from that source, e.g. because they already have them.
+
+    Returns the indices of the vertices that received any contribution, the
+    sums of weighted colors and weights for those vertices, a list with the
+    set of keys of the surfaces which received contributions from each
+    source, and a list with the ray hits of each source grouped by surface.
+    """
+    keys = arena.keys()
+    bounds = np.array([surface_bounds[key] for key in keys]).reshape(-1, 2, 3)
+
+    num_vertices = arena.vertex_count
+    color_sums = np.zeros((num_vertices, 3))
+    weights = np.zeros(num_vertices)
+
+    affected = []
+    hits = []
+    for color_source, excluded in sources:
+        try:
+            visible = cull_surfaces(color_source, keys, bounds, right_handed)
+            if len(visible) == 0:
+                affected.append(set())
+                hits.append(dict())
+                continue
+
+            # The submesh shares its vertices with the arena.
+            mesh, _ = arena.submesh(visible)
+            vertices, source_sums, source_weights, source_hits = project_color_source(mesh, color_source, right_handed)
+        except:
+            affected.append(set())
+            hits.append(dict())
+            continue
+
+        hits.append(group_hits(arena, source_hits))
+
+        slots = arena.vertex_slots(vertices)
+        if len(excluded) > 0:
+            keep = ~np.isin(slots, [arena.slots[key] for key in excluded if key in arena.slots])
+            vertices = vertices[keep]
+            source_sums = source_sums[keep]
+            source_weights = source_weights[keep]
+            slots = slots[keep]
+
+        color_sums[vertices] += source_sums
+        weights[vertices] += source_weights
+        affected.append(set(arena.slot_keys[slot] for slot in np.unique(slots)))
+
+    touched = np.flatnonzero(weights > 0)
+    return touched, color_sums[touched], weights[touched], affected, hits
+
+
+def reproject_color_sources(arena, keys, sources, right_handed=True):
+    """
+    Project color sources onto a subset of the surfaces in an arena.
+
+    This is used to color surfaces which replaced others, without casting
+    rays against the rest of the model. The sources argument is a list of
+    (color source, occlusion) pairs, where occlusion is the distance to the
+    nearest hit on any other surface for each ray of that source, or
+    infinity. Rays that hit the given surfaces beyond that distance are
+    blocked by the other surfaces.
+
+    Returns results in the same format as project_color_sources.
+    """
+    num_vertices = arena.vertex_count
+    color_sums = np.zeros((num_vertices, 3))
+    weights = np.zeros(num_vertices)
+
+    mesh, _ = arena.submesh(keys)
+
+    affected = []
+    hits = []
+    for color_source, occlusion in sources:
+        try:
+            vertices, source_sums, source_weights, source_hits = project_color_source(mesh, color_source,
+                    right_handed, max_distances=occlusion)
+        except:
+            affected.append(set())
+            hits.append(dict())
+            continue
+
+        color_sums[vertices] += source_sums
+        weights[vertices] += source_weights
+
+        source_hits = group_hits(arena, source_hits)
+        affected.append(set(source_hits.keys()))
+        hits.append(source_hits)
+
+    touched = np.flatnonzero(weights > 0)
+    return touched, color_sums[touched], weights[touched], affected, hits
@@ -1,8 +1,12 @@
+import itertools
+import json
 import os
 import pickle
+import shutil
 import time
 import uuid
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from urllib.request import urlopen
 
@@ -12,16 +16,30 @@ import trimesh
 
 from PIL import Image
 
+from .arena import MeshArena
+from .glbfile import GlbPartCache
+from .lod import LodCache, simplify_surface
+from .objfile import ObjFragmentCache
+from .projection import cull_surfaces, project_color_sources, reproject_color_sources
+from .slicer import slice_heights
+from .soup import LayerConfig
+from .spatial import BoundingBoxIndex
+
 DISPLAY = os.environ.get("DISPLAY")
 
 
 hand_change_transform = np.diag([-1, 1, 1, 1])
 
-
-class LayerConfig:
-    def __init__(self, height=0, svg_output=None):
-        self.height = height
-        self.svg_output = svg_output
+# Version of the array-based model store format written by
+# LocationModel.save_store. Increment when the layout changes, so that older
+# readers refuse stores with data that they would drop. Stores from older
+# versions can still be loaded, and the missing data is computed again.
+#
+# 1: surfaces, vertex colors, and color sources
+# 2: adds wall cross-sections, color accumulators, cached color ray hits,
+#    and surface change versions
+MODEL_STORE_VERSION = 2
+MIN_MODEL_STORE_VERSION = 1
 
 
 def normalized_uuid(x):
@@ -31,6 +49,64 @@ def normalized_uuid(x):
         return x
 
 
+def read_surface_arrays(path, right_handed=True):
+    """
+    Parse a surface file and convert it to the model coordinate system.
+
+    This is a module-level function so that it can run in a worker process,
+    and it returns plain arrays, which are cheap to send back to the parent.
+
+    Returns (vertices, faces, vertex_colors, mtime) or None if the file does
+    not contain a usable mesh. The vertex colors are None unless the file
+    defines them.
+    """
+    ext = os.path.splitext(str(path))[1]
+
+    surface = trimesh.load(path)
+    if not isinstance(surface, trimesh.Trimesh) or len(surface.faces) == 0:
+        return None
+
+    if right_handed and ext == ".ply":
+        # Assume PLY files are provided in Unity (left-handed) coordinate system.
+        # Convert to RH coordinates.
+        surface.apply_transform(hand_change_transform)
+        trimesh.repair.fix_winding(surface)
+
+    vertex_colors = None
+    if surface.visual.kind == "vertex":
+        vertex_colors = np.asarray(surface.visual.vertex_colors)
+
+    # Save the mtime of the surface file, so we can detect updated files.
+    mtime = os.path.getmtime(path)
+
+    return np.asarray(surface.vertices), np.asarray(surface.faces), vertex_colors, mtime
+
+
+def compute_ray_directions(width, height, focal, focal_relative=True, dtype=np.float64):
+    """
+    Compute unrotated camera ray directions for every pixel of an image.
+
+    The result has shape (height * width, 3) in row-major pixel order, with
+    the x component increasing to the right, the y component increasing
+    upward, and the z component fixed at one.
+    """
+    fx, fy = focal
+    if focal_relative:
+        fx *= width
+        fy *= height
+    cx = 0.5 * width
+    cy = 0.5 * height
+
+    xs = (np.arange(width, dtype=dtype) - dtype(cx)) / dtype(fx)
+    ys = (dtype(cy) - np.arange(height, dtype=dtype)) / dtype(fy)
+
+    directions = np.ones((height, width, 3), dtype=dtype)
+    directions[:, :, 0] = xs[np.newaxis, :]
+    directions[:, :, 1] = ys[:, np.newaxis]
+
+    return directions.reshape(-1, 3)
+
+
 class MeshColorSource():
     def __init__(self, id, image_path, focal, position, rotation, focal_relative=True):
         self.id = id
@@ -49,12 +125,72 @@ class MeshColorSource():
     def __repr__(self):
         return "MeshColorSource({})".format(self.image_path)
 
-    def generate_rays(self, right_handed=False):
+    def load_image(self):
+        if self.image_path.startswith("http"):
+            image = Image.open(urlopen(self.image_path))
+        else:
+            image = Image.open(self.image_path)
+        return np.array(image)
+
+    def get_image_size(self):
+        """
+        Get the (width, height) of the image without decoding it.
+        """
         if self.image_path.startswith("http"):
             image = Image.open(urlopen(self.image_path))
         else:
             image = Image.open(self.image_path)
-        image = np.array(image)
+        return image.size
+
+    def compute_frustum(self, right_handed=False, image_size=None):
+        """
+        Compute the planes bounding the camera view.
+
+        Returns the camera position and a (5, 3) array of inward-facing
+        normals for planes through the camera position: the four sides of the
+        view and the image plane. A point p is in view if the dot product of
+        every normal with (p - position) is non-negative.
+
+        With relative focal lengths, the image size is not needed. Otherwise
+        it is read from the image file unless provided.
+        """
+        fx, fy = self.focal
+        if not self.focal_relative:
+            width, height = image_size if image_size is not None else self.get_image_size()
+            fx /= width
+            fy /= height
+
+        position = np.asarray(self.position, dtype=float)
+        rotation = np.asarray(self.rotation, dtype=float)
+        if right_handed:
+            position = position * [-1, 1, 1]
+            rotation = np.matmul(hand_change_transform[0:3, 0:3], rotation)
+
+        # Ray directions at the image corners, in counter-clockwise order.
+        half_x = 0.5 / fx
+        half_y = 0.5 / fy
+        corners = np.array([[-half_x, -half_y, 1], [half_x, -half_y, 1], [half_x, half_y, 1], [-half_x, half_y, 1]])
+        corners = np.matmul(corners, rotation.T)
+        forward = rotation[:, 2]
+
+        normals = np.cross(corners, np.roll(corners, -1, axis=0))
+
+        # The rotation may be improper after the change of handedness, so
+        # orient the side planes toward the view direction explicitly.
+        normals[np.dot(normals, forward) < 0] *= -1
+
+        return position, np.vstack((normals, forward))
+
+    def generate_rays(self, right_handed=False, dtype=np.float64):
+        """
+        Generate one ray for each pixel in the image.
+
+        Returns arrays of ray origins, ray directions, and pixel colors in
+        row-major pixel order. Passing dtype=np.float32 halves the memory
+        used by the origin and direction arrays.
+        """
+        image = self.load_image()
+        height, width = image.shape[0:2]
 
         position = self.position
         rotation = self.rotation
@@ -62,25 +198,13 @@ class MeshColorSource():
             position = position * [-1, 1, 1]
             rotation = np.matmul(hand_change_transform[0:3, 0:3], rotation)
 
-        fx, fy = self.focal
-        if self.focal_relative:
-            fx *= image.shape[1]
-            fy *= image.shape[0]
-        cx = 0.5 * image.shape[1]
-        cy = 0.5 * image.shape[0]
-
-        directions = np.ones((image.shape[0] * image.shape[1], 3))
-        i = 0
-        for y in range(image.shape[0]):
-            for x in range(image.shape[1]):
-                directions[i, 0] = (x - cx) / fx
-                directions[i, 1] = (cy - y) / fy
-                i += 1
+        directions = compute_ray_directions(width, height, self.focal, self.focal_relative, dtype=dtype)
 
         # Rotate the direction vectors according to camera orientation.
-        directions = np.matmul(directions, rotation.T)
+        directions = np.matmul(directions, np.asarray(rotation, dtype=dtype).T)
 
         # The origin for each array is the camera position, so just repeat it N times.
+        position = np.asarray(position, dtype=dtype)
         origins = np.repeat(position[np.newaxis, :], directions.shape[0], axis=0)
 
         colors = image[:, :, 0:3].reshape(-1, 3)
@@ -96,32 +220,87 @@ class LocationModel():
 
     def __init__(self):
         self.scene = trimesh.Scene()
-        self.combined_mesh = trimesh.Trimesh()
-        self.face_object_indices = np.array([], dtype=int)
-        self.face_local_indices = np.array([], dtype=int)
-        self.surface_ids = []
+
+        # Combined vertex and face buffer with one slot per surface,
+        # keyed by the same names as the scene geometry.
+        self.arena = MeshArena()
+
+        # Spatial index of surface bounding boxes for overlap queries.
+        self.surface_index = BoundingBoxIndex()
+
+        # Cached wall cross-sections, map from (surface key, layer height)
+        # to (surface mtime, (N, 2, 3) array of line segments).
+        self.wall_slices = dict()
 
         self.right_handed = True
 
         self.color_sources = set()
 
-        self.mtime = time.time()
+        # Per-surface color accumulators, map from surface key to the sums of
+        # weighted colors (N, 3) and weights (N,) from all color sources.
+        self.color_accumulators = dict()
+
+        # Cached ray hits for each color source, map from color source to a
+        # map from surface key to the ray indices and hit distances.
+        self.color_hits = dict()
+
+        # Model version of the last recorded change, the version when change
+        # tracking started, and maps from surface key to the model version
+        # when the surface was last changed or removed.
+        self.version = 0
+        self.tracked_since = None
+        self.surface_versions = dict()
+        self.removed_surfaces = dict()
 
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['combined_mesh']
-        # TODO del any fields we do not want saved
-        return state
+        self.mtime = time.time()
 
     def __setstate__(self, state):
+        # Models saved before the arena was introduced have the combined mesh
+        # bookkeeping as separate fields, which are now derived from the arena.
+        for key in ['surface_ids', 'face_object_indices', 'face_local_indices', 'vertex_offsets']:
+            state.pop(key, None)
+
         self.__dict__.update(state)
 
-        meshes = []
-        for i, obj in enumerate(self.scene.dump()):
-            meshes.append(obj)
+        if 'arena' not in state:
+            meshes = self.scene.dump()
+            self.arena = MeshArena.from_meshes(meshes, [obj.metadata['name'] for obj in meshes])
+
+        if 'surface_index' not in state:
+            self.surface_index = BoundingBoxIndex()
+            for key, mesh in self.scene.geometry.items():
+                self.surface_index.insert(key, mesh.bounds)
+
+        if 'wall_slices' not in state:
+            self.wall_slices = dict()
+
+        if 'color_accumulators' not in state:
+            self.color_accumulators = dict()
+
+        if 'color_hits' not in state:
+            self.color_hits = dict()
+
+        if 'surface_versions' not in state:
+            self.version = 0
+            self.tracked_since = None
+            self.surface_versions = dict()
+            self.removed_surfaces = dict()
 
-        self.combined_mesh = trimesh.util.concatenate(meshes)
-        # TODO recalculate any fields that were not saved
+    @property
+    def combined_mesh(self):
+        return self.arena.mesh
+
+    @property
+    def surface_ids(self):
+        return [normalized_uuid(key) for key in self.arena.keys()]
+
+    @property
+    def face_object_indices(self):
+        return self.arena.face_object_indices()
+
+    @property
+    def face_local_indices(self):
+        return self.arena.face_local_indices()
 
     def apply_color(self, source_id, image_path, focal, position, rotation, focal_relative=True):
         color_source = MeshColorSource(source_id, image_path, focal, position, rotation, focal_relative)
@@ -133,78 +312,180 @@ class LocationModel():
 
         Returns a set of surface IDs which have been modified.
         """
-        affected_surfaces = set()
-
         # Avoid redoing an image unless requested to reapply
         if not should_reapply and color_source in self.color_sources:
-            return affected_surfaces
+            return set()
 
         self.color_sources.add(color_source)
 
-        try:
-            origins, directions, colors = color_source.generate_rays(self.right_handed)
-        except:
-            return affected_surfaces
-
-        # Ray cast against the environment mesh.
-        points, index_ray, index_tri = self.combined_mesh.ray.intersects_location(origins, directions, multiple_hits=False)
-        if len(points) == 0:
-            return affected_surfaces
-
-        # Hit triangle vertices and color for each ray.
-        hit_triangle_vertices = np.zeros((len(index_ray), 3, 3))
-        ray_colors = np.zeros((len(index_ray), 3))
-
-        # For each ray, find the triangle that was hit in the combined mesh.
-        # Record the triangle vertices and pixel color.
-        for i, ray in enumerate(index_ray):
-            tri = index_tri[i]
-            global_face_vertices = self.combined_mesh.faces[tri]
-            hit_triangle_vertices[i, 0:3, 0:3] = self.combined_mesh.vertices[global_face_vertices, :]
-            ray_colors[i, 0:3] = colors[ray, 0:3]
-
-        # Accumulators for color and weight contributions from each ray.
-        acc_color = np.zeros((len(self.combined_mesh.vertices), 3))
-        acc_weight = np.zeros(len(self.combined_mesh.vertices))
-
-        # Compute barycentric coordinates for each ray's collision point.
-        barycentric = trimesh.triangles.points_to_barycentric(hit_triangle_vertices, points)
-
-        for d in range(3):
-            weighted_color = barycentric[:, [d]] * ray_colors
-
-            for i, tri in enumerate(index_tri):
-                acc_color[self.combined_mesh.faces[tri][d], 0:3] += weighted_color[i, :]
-                acc_weight[self.combined_mesh.faces[tri][d]] += barycentric[i, d]
-
-        surface_index = 0
-        surface_id = self.surface_ids[surface_index]
-        submesh = self.scene.geometry[str(surface_id)]
-        local_vertex_index = 0
-
-        # Iterate over the vertices in the combined mesh, map them back to the
-        # scene mesh, and apply color to the scene mesh.
-        for i in range(acc_color.shape[0]):
-            if local_vertex_index >= len(submesh.vertices):
-                surface_index += 1
-                surface_id = self.surface_ids[surface_index]
-                submesh = self.scene.geometry[str(surface_id)]
-                local_vertex_index = 0
-
-            # Color vertices where we had at least one hit and avoid small divisor.
-            if acc_weight[i] > 0.33:
-                submesh.visual.vertex_colors[local_vertex_index][0:3] = acc_color[i] / acc_weight[i]
-
-                # Maintain a set of MeshColorSource objects that affected each surface.
-                # Then, when a surface is replaced, we can reapply only the images that should affect it.
-                submesh.metadata['color_sources'].add(color_source)
-
-                affected_surfaces.add(surface_id)
-
-            local_vertex_index += 1
+        result = project_color_sources(self.arena, self.surface_index.bounds,
+                [(color_source, self.find_colored_surfaces(color_source))], self.right_handed)
+        return self.apply_color_contributions(result, [color_source])
+
+    def apply_color_sources(self, color_sources, workers=None):
+        """
+        Apply colors from several color sources to our meshes.
+
+        If workers is greater than one, the sources are divided among a pool
+        of worker processes. Color contributions are sums of weighted colors
+        and weights, so the partial sums from each worker are added together
+        and applied once. The result is the same as applying the sources one
+        at a time.
+
+        Returns a set of surface IDs which have been modified.
+        """
+        color_sources = [x for x in color_sources if x not in self.color_sources]
+        if len(color_sources) == 0:
+            return set()
+
+        self.color_sources.update(color_sources)
+
+        sources = [(x, self.find_colored_surfaces(x)) for x in color_sources]
+
+        if workers is None or workers <= 1 or len(sources) == 1:
+            result = project_color_sources(self.arena, self.surface_index.bounds, sources, self.right_handed)
+            return self.apply_color_contributions(result, color_sources)
+
+        workers = min(workers, len(sources))
+        shards = [sources[i::workers] for i in range(workers)]
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(project_color_sources, itertools.repeat(self.arena),
+                    itertools.repeat(self.surface_index.bounds), shards, itertools.repeat(self.right_handed)))
+
+        # Sum the partial contributions from all of the workers.
+        vertices = np.concatenate([x[0] for x in results])
+        touched, inverse = np.unique(vertices, return_inverse=True)
+        color_sums = np.zeros((len(touched), 3))
+        np.add.at(color_sums, inverse, np.concatenate([x[1] for x in results]))
+        weights = np.bincount(inverse, weights=np.concatenate([x[2] for x in results]), minlength=len(touched))
+
+        # Put the per-source results back in the original order of sources.
+        affected = [None] * len(sources)
+        hits = [None] * len(sources)
+        for i, result in enumerate(results):
+            affected[i::workers] = result[3]
+            hits[i::workers] = result[4]
+
+        return self.apply_color_contributions((touched, color_sums, weights, affected, hits), [x for x, _ in sources])
+
+    def reproject_color_sources(self, color_sources, keys):
+        """
+        Apply colors from color sources to replacement surfaces.
+
+        Sources with cached ray hits are only projected onto the given
+        surfaces, using the cached hit distances on the other surfaces to
+        find rays that are blocked. The colors of other surfaces are left as
+        they are. Sources without cached hits are reapplied to the whole
+        model.
+
+        Returns a set of surface IDs which have been modified.
+        """
+        keys = [key for key in keys if key in self.arena]
+        if len(keys) == 0:
+            return set()
+
+        affected_surfaces = set()
+
+        sources = []
+        for source in color_sources:
+            cached = self.color_hits.get(source)
+            if cached is None:
+                affected_surfaces.update(self.apply_color_source(source, should_reapply=True))
+                continue
+
+            bounds = [self.surface_index.bounds[key] for key in keys]
+            try:
+                if len(cull_surfaces(source, keys, bounds, self.right_handed)) == 0:
+                    continue
+                width, height = source.get_image_size()
+            except:
+                continue
+
+            occlusion = np.full(width * height, np.inf, dtype=np.float32)
+            for key, (rays, distances) in cached.items():
+                if key not in keys:
+                    occlusion[rays] = distances
+            sources.append((source, occlusion))
+
+        if len(sources) > 0:
+            result = reproject_color_sources(self.arena, keys, sources, self.right_handed)
+            affected_surfaces.update(self.apply_color_contributions(result, [x for x, _ in sources]))
 
         return affected_surfaces
 
+    def find_colored_surfaces(self, color_source):
+        """
+        Find the keys of surfaces which already have contributions from a
+        color source, so that they are not counted twice.
+        """
+        return set(key for key, surface in self.scene.geometry.items() if color_source in surface.metadata['color_sources'])
+
+    def get_color_accumulator(self, key):
+        if key not in self.color_accumulators:
+            num_vertices = len(self.scene.geometry[key].vertices)
+            self.color_accumulators[key] = (np.zeros((num_vertices, 3)), np.zeros(num_vertices))
+        return self.color_accumulators[key]
+
+    def apply_color_contributions(self, result, color_sources):
+        """
+        Add color contributions to the surface accumulators and update the
+        vertex colors of the affected surfaces.
+
+        The result is in the format returned by project_color_sources, with
+        vertex indices into the arena buffer.
+
+        Returns a set of surface IDs which have been modified.
+        """
+        affected_surfaces = set()
+
+        touched, color_sums, weights, affected, hits = result
+
+        # Maintain a set of MeshColorSource objects that affected each surface.
+        # Then, when a surface is replaced, we can reapply only the images that should affect it.
+        for color_source, keys in zip(color_sources, affected):
+            for key in keys:
+                self.scene.geometry[key].metadata['color_sources'].add(color_source)
+
+        # Keep the ray hits, so that replacement surfaces can be colored
+        # without casting rays against the rest of the model.
+        for color_source, source_hits in zip(color_sources, hits):
+            self.color_hits.setdefault(color_source, dict()).update(source_hits)
+
+        # Map the touched vertices back to the scene meshes using the arena
+        # vertex ranges. The touched vertex indices are sorted.
+        for key, start, end in self.arena.vertex_ranges():
+            i = np.searchsorted(touched, start)
+            j = np.searchsorted(touched, end)
+            if i == j:
+                continue
+
+            local = touched[i:j] - start
+            acc_color, acc_weight = self.get_color_accumulator(key)
+            acc_color[local] += color_sums[i:j]
+            acc_weight[local] += weights[i:j]
+
+            # Color vertices where we had enough total weight to avoid a small divisor.
+            local = local[acc_weight[local] > 0.33]
+            if len(local) == 0:
+                continue
+
+            submesh = self.scene.geometry[key]
+            submesh.visual.vertex_colors[local, 0:3] = acc_color[local] / acc_weight[local, np.newaxis]
+            submesh.metadata.pop('color_version', None)
+
+            affected_surfaces.add(normalized_uuid(key))
+
+        return affected_surfaces
+
+    def find_visible_surfaces(self, color_source):
+        """
+        Find the surfaces whose bounding boxes intersect the view frustum of
+        a color source.
+        """
+        keys = self.arena.keys()
+        bounds = [self.surface_index.bounds[key] for key in keys]
+        return cull_surfaces(color_source, keys, bounds, self.right_handed)
+
     def compute_max_iou(self, mesh):
         """
         Compute intersection-over-union (IOU) between given mesh and existing
@@ -212,51 +493,157 @@ class LocationModel():
 
         Returns (max IOU, mesh name)
         """
-        N = len(self.scene.geometry)
-        if N == 0:
-            return 0, None
-
-        # Extract the upper and lower bounds for all of our current meshes
-        # TODO: these arrays could be cached if it is determined to save time
-        lower_bounds = np.zeros((N, 3))
-        upper_bounds = np.zeros((N, 3))
-        volume = np.zeros((N, ))
-        names = list()
-        for i, obj in enumerate(self.scene.dump()):
-            bbox = obj.bounding_box
-            lower_bounds[i, :] = bbox.bounds[0, :]
-            upper_bounds[i, :] = bbox.bounds[1, :]
-            volume[i] = bbox.volume
-            names.append(obj.metadata['name'])
-
-        # Find the intersection with the given mesh
-        given_bbox = mesh.bounding_box
-        inter_lower = np.maximum(given_bbox.bounds[0, :], lower_bounds)
-        inter_upper = np.minimum(given_bbox.bounds[1, :], upper_bounds)
-
-        inter_volume = np.product(inter_upper - inter_lower, axis=1)
-
-        # If the upper bound ended up less than the lower bound in any
-        # dimension, it means there is no overlap, so the intersection volume
-        # is zero in those cases.
-        inter_volume[np.any(inter_upper < inter_lower, axis=1)] = 0
-
-        union_volume = given_bbox.volume + volume - inter_volume
-        iou = inter_volume / union_volume
-
-        i = np.argmax(iou)
-        return iou[i], names[i]
-
-    def export_obj(self, path, include_color=False):
+        return self.surface_index.compute_max_iou(mesh.bounds)
+
+    def get_lod_surfaces(self, level, include_color=False, cache_dir=None):
+        """
+        Get the surfaces simplified for a level of detail.
+
+        Level zero is the full resolution. If cache_dir is set, simplified
+        surfaces are cached there per surface version.
+
+        Returns a list of (key, mesh) pairs.
+        """
+        surfaces = [(key, self.scene.geometry[key]) for key in self.arena.keys()]
+        if level <= 0:
+            return surfaces
+
+        if cache_dir is None:
+            return [(key, simplify_surface(mesh, level, include_color)) for key, mesh in surfaces]
+
+        cache = LodCache(cache_dir, include_color=include_color)
+        result = [(key, cache.get(key, mesh, level)) for key, mesh in surfaces]
+        cache.prune(level, surfaces)
+        return result
+
+    def export_obj(self, path, include_color=False, fragment_dir=None, lod=0, lod_dir=None):
+        """
+        Export the model as an OBJ file.
+
+        If fragment_dir is set, the vertex and face text for each surface is
+        cached there, and only changed surfaces are formatted again. The file
+        is written under a temporary name and renamed into place either way.
+
+        If lod is greater than zero, the surfaces are simplified for that
+        level of detail, and cached in lod_dir if it is set.
+        """
+        surfaces = self.get_lod_surfaces(lod, include_color, lod_dir)
+
         # For OBJ file format, right handed coordinate system is expected.
         # Default is using RH in trimesh, so no change would be needed to import/export.
-        if self.right_handed:
+        if fragment_dir is not None:
+            transform = None if self.right_handed else hand_change_transform
+            cache = ObjFragmentCache(fragment_dir, include_color=include_color, digits=3, transform=transform)
+            cache.assemble(surfaces, path)
+            return
+
+        if lod <= 0:
             scene = self.scene
         else:
-            scene = self.scene.copy()
+            scene = trimesh.Scene()
+            for key, mesh in surfaces:
+                scene.add_geometry(mesh, node_name=key, geom_name=key)
+
+        if not self.right_handed:
+            scene = scene.copy()
             scene.apply_transform(hand_change_transform)
 
-        scene.export(file_obj=path, file_type="obj", digits=3, include_color=include_color, include_normals=False, include_texture=False)
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        scene.export(file_obj=temp_path, file_type="obj", digits=3, include_color=include_color, include_normals=False, include_texture=False)
+        os.replace(temp_path, path)
+
+    def record_changes(self, updated_surfaces, base_version=0):
+        """
+        Record a new model version in which the given surfaces were added,
+        modified, or recolored.
+
+        Surfaces which were recorded before but are no longer in the model are
+        recorded as removed. The new version is greater than both the last
+        recorded version and base_version.
+
+        Returns the new version.
+        """
+        self.version = max(self.version, base_version) + 1
+        if self.tracked_since is None:
+            self.tracked_since = self.version
+
+        current = set(self.arena.keys())
+        updated = set(str(normalized_uuid(x)) for x in updated_surfaces)
+
+        for key in current:
+            if key in updated or key not in self.surface_versions:
+                self.surface_versions[key] = self.version
+                self.removed_surfaces.pop(key, None)
+
+        for key in list(self.surface_versions.keys()):
+            if key not in current:
+                del self.surface_versions[key]
+                self.removed_surfaces[key] = self.version
+
+        return self.version
+
+    def export_surface_versions(self, path):
+        """
+        Write the surface change versions to a JSON file.
+
+        The file is written under a temporary name and renamed into place.
+        """
+        data = {
+            "version": self.version,
+            "tracked_since": self.tracked_since,
+            "surfaces": self.surface_versions,
+            "removed": self.removed_surfaces,
+        }
+
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(temp_path, "w") as output:
+            json.dump(data, output)
+        os.replace(temp_path, path)
+
+    def export_glb(self, path, include_color=False, lod=0, lod_dir=None, part_dir=None):
+        """
+        Export the model as a binary glTF (GLB) file.
+
+        Each surface is a mesh node named by its surface ID, with indexed
+        float32 positions and, if include_color is set, uint8 vertex colors.
+        The file is written under a temporary name and renamed into place.
+        The lod and lod_dir arguments are the same as for export_obj.
+
+        If part_dir is set, the buffer data for each surface is cached there,
+        and only changed surfaces are prepared again.
+        """
+        surfaces = self.get_lod_surfaces(lod, include_color, lod_dir)
+
+        if part_dir is not None:
+            # glTF uses a right handed coordinate system like OBJ.
+            transform = None if self.right_handed else hand_change_transform
+            cache = GlbPartCache(part_dir, include_color=include_color, transform=transform)
+            cache.assemble(surfaces, path)
+            return
+
+        scene = trimesh.Scene()
+        for key, surface in surfaces:
+            if len(surface.faces) == 0:
+                continue
+
+            # Make a bare copy, since the color sources in the surface
+            # metadata cannot be stored in the glTF extras.
+            mesh = trimesh.Trimesh(vertices=surface.vertices, faces=surface.faces, process=False, validate=False)
+            if include_color and surface.visual.kind in ["vertex", "face"]:
+                mesh.visual.vertex_colors = surface.visual.vertex_colors
+
+            # glTF uses a right handed coordinate system like OBJ.
+            if not self.right_handed:
+                mesh.apply_transform(hand_change_transform)
+
+            scene.add_geometry(mesh, node_name=key, geom_name=key)
+
+        data = trimesh.exchange.gltf.export_glb(scene, include_normals=False)
+
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(temp_path, "wb") as output:
+            output.write(data)
+        os.replace(temp_path, path)
 
     def export_surface_obj(self, surface_id, dir_path, include_color=False):
         surface_id = normalized_uuid(surface_id)
@@ -276,12 +663,13 @@ class LocationModel():
         else:
             header = "v x y z"
 
-        mesh.export(file_obj=path, file_type="obj", digits=3, include_color=include_color, include_normals=False, include_texture=False, header=header)
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        mesh.export(file_obj=temp_path, file_type="obj", digits=3, include_color=include_color, include_normals=False, include_texture=False, header=header)
+        os.replace(temp_path, path)
         return path
 
     def get_bounding_box(self):
-        lower = np.min(self.combined_mesh.vertices, axis=0)
-        upper = np.max(self.combined_mesh.vertices, axis=0)
+        lower, upper = self.combined_mesh.bounds
         size = upper - lower
 
         if self.right_handed:
@@ -300,23 +688,90 @@ class LocationModel():
     def has_color(self):
         return len(self.color_sources) > 0
 
+    def update_wall_slices(self, heights):
+        """
+        Make sure the cached cross-sections of every surface are current for
+        the given heights.
+
+        Surfaces which are new or have been replaced are sliced together at
+        all of the heights in one pass over their faces.
+        """
+        heights = sorted(set(float(x) for x in heights))
+
+        stale = []
+        for key in self.arena.keys():
+            mtime = self.scene.geometry[key].metadata['mtime']
+            for height in heights:
+                cached = self.wall_slices.get((key, height))
+                if cached is None or cached[0] != mtime:
+                    stale.append(key)
+                    break
+
+        if len(stale) == 0 or len(heights) == 0:
+            return
+
+        slots = [self.arena.slots[key] for key in stale]
+        face_counts = [self.arena.slot_face_count[slot] for slot in slots]
+        face_index = np.concatenate([np.arange(self.arena.slot_face_start[slot], self.arena.slot_face_start[slot] + count)
+                for slot, count in zip(slots, face_counts)])
+        face_group = np.repeat(np.arange(len(stale)), face_counts)
+
+        vertices = self.arena.vertices[:self.arena.vertex_count]
+        walls, wall_faces = slice_heights(vertices, self.arena.faces[face_index], heights, return_faces=True)
+
+        # Segments come out in face order, so they are already grouped by surface.
+        for height, segments, segment_faces in zip(heights, walls, wall_faces):
+            splits = np.searchsorted(face_group[segment_faces], np.arange(1, len(stale)))
+            for key, part in zip(stale, np.split(segments, splits)):
+                mtime = self.scene.geometry[key].metadata['mtime']
+                self.wall_slices[(key, height)] = (mtime, part)
+
+    def get_wall_segments(self, height):
+        """
+        Intersect the surfaces with a horizontal plane at the given height.
+
+        The cross-section of each surface is cached, so only surfaces which
+        are new or have been replaced since the last call are sliced again.
+
+        Returns an (N, 2, 3) array of line segments.
+        """
+        height = float(height)
+        self.update_wall_slices([height])
+
+        segments = [self.wall_slices[(key, height)][1] for key in self.arena.keys()]
+        if len(segments) == 0:
+            return np.zeros((0, 2, 3))
+        return np.concatenate(segments)
+
+    def prune_wall_slices(self, heights):
+        """
+        Remove cached cross-sections for surfaces or heights no longer in use.
+        """
+        heights = set(float(x) for x in heights)
+        for key, height in list(self.wall_slices.keys()):
+            if key not in self.arena or height not in heights:
+                del self.wall_slices[(key, height)]
+
     def infer_walls(self, layers):
-        lower = np.min(self.combined_mesh.vertices, axis=0)
-        upper = np.max(self.combined_mesh.vertices, axis=0)
+        lower, upper = self.combined_mesh.bounds
+
+        # Slice the surfaces for every layer at once. A layer in slices mode
+        # has a stack of planes at offsets from its reference height.
+        layer_heights = []
+        for layer in layers:
+            if layer.slices is None:
+                layer_heights.append([float(layer.height)])
+            else:
+                layer_heights.append([float(layer.height + level) for level in layer.slices])
+
+        all_heights = [height for heights in layer_heights for height in heights]
+        self.prune_wall_slices(all_heights)
+        self.update_wall_slices(all_heights)
 
         paths = []
-        for i, layer in enumerate(layers):
-            # this is essentially the inner loop of trimesh.intersections.mesh_multiplane,
-            # but their implementation includes some transformations that we do not need
-            #
-            # Also, the dot product is greatly simplified because we know we are intersecting
-            # with horizontal planes. The dot product with the plane normal [0, 1, 0] simply
-            # extracts the Y values from the vertices.
-            origin = np.array([0, layer.height, 0])
-            dots = self.combined_mesh.vertices[:, 1] - layer.height
-
-            walls = trimesh.intersections.mesh_plane(self.combined_mesh, self.up, origin, cached_dots=dots)
-            path = trimesh.load_path(walls)
+        for layer, heights in zip(layers, layer_heights):
+            slices = [self.get_wall_segments(height) for height in heights]
+            path = trimesh.load_path(np.concatenate(slices))
             paths.append(path)
 
             if layer.svg_output is not None:
@@ -338,46 +793,63 @@ class LocationModel():
                 transform_group = dwg.g(id="transform", transform="matrix({} 0 0 -1 {} {})".format(x_scale, x_offset, lower[2] + upper[2]))
                 dwg.add(transform_group)
 
-                wall_group = dwg.g(id="walls", fill="none", stroke='black', stroke_width=0.1)
-                transform_group.add(wall_group)
-
-                for entity in path.entities:
-                    if len(entity.points) == 2:
-                        a, b = entity.points
-                        line = dwg.line(start=path.vertices[a, [0, 2]], end=path.vertices[b, [0, 2]])
-                    else:
-                        line = dwg.polyline(points=[path.vertices[x, [0, 2]] for x in entity.points])
-                    wall_group.add(line)
+                if layer.slices is None:
+                    self.draw_walls(dwg, transform_group, path, "walls", "black")
+                else:
+                    # Floor is white, and each slice going up is
+                    # progressively darker, ending with black.
+                    step_size = int(256 / len(slices))
+                    for i, walls in enumerate(slices):
+                        color = "rgb({0:d},{0:d},{0:d})".format(256-(i+1)*step_size)
+                        self.draw_walls(dwg, transform_group, trimesh.load_path(walls), "walls-{}".format(i), color)
 
                 dwg.save(pretty=True)
 
         return paths
 
+    def draw_walls(self, dwg, parent, path, group_id, color):
+        wall_group = dwg.g(id=group_id, fill="none", stroke=color, stroke_width=0.1)
+        parent.add(wall_group)
+
+        for entity in path.entities:
+            if len(entity.points) == 2:
+                a, b = entity.points
+                line = dwg.line(start=path.vertices[a, [0, 2]], end=path.vertices[b, [0, 2]])
+            else:
+                line = dwg.polyline(points=[path.vertices[x, [0, 2]] for x in entity.points])
+            wall_group.add(line)
+
     def load_surface(self, path):
+        arrays = read_surface_arrays(path, self.right_handed)
+        return self.make_surface(path, arrays)
+
+    def make_surface(self, path, arrays):
+        """
+        Create a surface mesh from the output of read_surface_arrays.
+
+        Returns (surface, surface ID), where surface is None if the file did
+        not contain a usable mesh.
+        """
         fname = os.path.basename(path)
         surface_id, ext = os.path.splitext(fname)
         surface_id = normalized_uuid(surface_id)
 
-        surface = trimesh.load(path)
-        if isinstance(surface, trimesh.Trimesh) and len(surface.faces) > 0:
-            if self.right_handed and ext == ".ply":
-                # Assume PLY files are provided in Unity (left-handed) coordinate system.
-                # Convert to RH coordinates.
-                surface.apply_transform(hand_change_transform)
-                trimesh.repair.fix_winding(surface)
+        if arrays is None:
+            return None, surface_id
 
-            surface.metadata['color_sources'] = set()
+        vertices, faces, vertex_colors, mtime = arrays
+        surface = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_colors=vertex_colors, process=False)
 
-            # Set the mesh name to be the surface ID.
-            # This will be preserved if the mesh is exported as OBJ.
-            surface.metadata['name'] = str(surface_id)
+        surface.metadata['color_sources'] = set()
 
-            # Save the mtime of the surface PLY file, so we can detect updated files.
-            surface.metadata['mtime'] = os.path.getmtime(path)
+        # Set the mesh name to be the surface ID.
+        # This will be preserved if the mesh is exported as OBJ.
+        surface.metadata['name'] = str(surface_id)
 
-            return surface, surface_id
+        # Save the mtime of the surface PLY file, so we can detect updated files.
+        surface.metadata['mtime'] = mtime
 
-        return None, surface_id
+        return surface, surface_id
 
     def append_surface(self, surface):
         """
@@ -387,17 +859,8 @@ class LocationModel():
         called Scene object.
         """
         self.scene.add_geometry(surface)
-
-        surface_id = normalized_uuid(surface.metadata['name'])
-        self.surface_ids.append(surface_id)
-
-        foi = np.array([len(self.surface_ids)-1] * len(surface.faces), dtype=int)
-        self.face_object_indices = np.concatenate((self.face_object_indices, foi))
-
-        fli = np.array(range(len(surface.faces)), dtype=int)
-        self.face_local_indices = np.concatenate((self.face_local_indices, fli))
-
-        self.combined_mesh = trimesh.util.concatenate(self.combined_mesh, surface)
+        self.arena.append(surface.metadata['name'], surface.vertices, surface.faces)
+        self.surface_index.insert(surface.metadata['name'], surface.bounds)
 
     def replace_surface(self, surface_id, surface):
         """
@@ -414,24 +877,13 @@ class LocationModel():
         if key in self.scene.geometry:
             used_color_sources = self.scene.geometry[key].metadata['color_sources']
             self.scene.delete_geometry(key)
+            self.arena.remove(key)
+            self.surface_index.remove(key)
+            self.color_accumulators.pop(key, None)
+            for source_hits in self.color_hits.values():
+                source_hits.pop(key, None)
 
-        self.scene.add_geometry(surface)
-
-        surface_ids = []
-        face_object_indices = []
-        face_local_indices = []
-        meshes = []
-
-        for i, obj in enumerate(self.scene.dump()):
-            surface_ids.append(normalized_uuid(obj.metadata['name']))
-            face_object_indices.extend([i] * len(obj.faces))
-            face_local_indices.extend(list(range(len(obj.faces))))
-            meshes.append(obj)
-
-        self.combined_mesh = trimesh.util.concatenate(meshes)
-        self.surface_ids = surface_ids
-        self.face_object_indices = np.array(face_object_indices, dtype=int)
-        self.face_local_indices = np.array(face_local_indices, dtype=int)
+        self.append_surface(surface)
 
         return used_color_sources
 
@@ -444,6 +896,125 @@ class LocationModel():
         with open(path, "wb") as output:
             pickle.dump(self, output)
 
+    def save_store(self, dir_path):
+        """
+        Save the model as a directory of flat numpy arrays.
+
+        Vertices, faces, and vertex colors for all surfaces are stored back to
+        back with per-surface counts, so that they can be memory-mapped on
+        load. Scalar fields and color source descriptions go in a JSON
+        manifest. The directory is written under a temporary name and renamed
+        into place, so readers never observe a partially written store.
+        """
+        # Make sure the buffers are packed with no dead slots.
+        if len(self.arena) != len(self.arena.slot_keys):
+            self.arena.compact()
+
+        keys = self.arena.keys()
+        surfaces = [self.scene.geometry[key] for key in keys]
+
+        vertex_colors = np.zeros((self.arena.vertex_count, 4), dtype=np.uint8)
+        color_sums = np.zeros((self.arena.vertex_count, 3))
+        color_weights = np.zeros(self.arena.vertex_count)
+        for key, start, end in self.arena.vertex_ranges():
+            vertex_colors[start:end] = self.scene.geometry[key].visual.vertex_colors
+            if key in self.color_accumulators:
+                color_sums[start:end], color_weights[start:end] = self.color_accumulators[key]
+
+        # Flatten the color sources into one table, and then record the set
+        # of sources for each surface as a list of indices into the table.
+        sources = set(self.color_sources)
+        sources.update(self.color_hits.keys())
+        for surface in surfaces:
+            sources.update(surface.metadata['color_sources'])
+        sources = list(sources)
+        source_index = {source: i for i, source in enumerate(sources)}
+
+        # Save the cached ray hits as (source, surface, count) groups, with
+        # the ray indices and distances of all groups back to back.
+        key_index = {key: i for i, key in enumerate(keys)}
+        hit_groups = []
+        hit_rays = []
+        hit_distances = []
+        for source, source_hits in self.color_hits.items():
+            for key, (rays, distances) in source_hits.items():
+                if key in key_index:
+                    hit_groups.append((source_index[source], key_index[key], len(rays)))
+                    hit_rays.append(rays)
+                    hit_distances.append(distances)
+
+        surface_sources = [[source_index[x] for x in surface.metadata['color_sources']] for surface in surfaces]
+        surface_source_counts = [len(x) for x in surface_sources]
+
+        # Save the cached wall cross-sections which are still valid. The count
+        # is -1 for surfaces that have not been sliced at a height.
+        wall_heights = sorted(set(height for _, height in self.wall_slices.keys()))
+        wall_segment_counts = np.full((len(keys), len(wall_heights)), -1, dtype=int)
+        wall_segments = []
+        for i, (key, surface) in enumerate(zip(keys, surfaces)):
+            for j, height in enumerate(wall_heights):
+                cached = self.wall_slices.get((key, height))
+                if cached is not None and cached[0] == surface.metadata['mtime']:
+                    wall_segment_counts[i, j] = len(cached[1])
+                    wall_segments.append(cached[1])
+
+        arrays = {
+            "vertices": self.arena.vertices[:self.arena.vertex_count],
+            "faces": self.arena.faces[:self.arena.face_count],
+            "vertex_colors": vertex_colors,
+            "color_sums": color_sums,
+            "color_weights": color_weights,
+            "vertex_counts": np.array(self.arena.slot_vertex_count, dtype=int),
+            "face_counts": np.array(self.arena.slot_face_count, dtype=int),
+            "surface_mtimes": np.array([surface.metadata['mtime'] for surface in surfaces], dtype=float),
+            "surface_bounds": np.array([self.surface_index.bounds[key] for key in keys], dtype=float).reshape(-1, 2, 3),
+            "surface_source_counts": np.array(surface_source_counts, dtype=int),
+            "surface_source_indices": np.array([j for x in surface_sources for j in x], dtype=int),
+            "source_focal": np.array([x.focal for x in sources], dtype=float).reshape(-1, 2),
+            "source_position": np.array([x.position for x in sources], dtype=float).reshape(-1, 3),
+            "source_rotation": np.array([x.rotation for x in sources], dtype=float).reshape(-1, 3, 3),
+            "source_focal_relative": np.array([x.focal_relative for x in sources], dtype=bool),
+            "wall_segment_counts": wall_segment_counts,
+            "wall_segments": np.concatenate(wall_segments) if wall_segments else np.zeros((0, 2, 3)),
+            "surface_versions": np.array([self.surface_versions.get(key, -1) for key in keys], dtype=int),
+            "hit_groups": np.array(hit_groups, dtype=int).reshape(-1, 3),
+            "hit_rays": np.concatenate(hit_rays) if hit_rays else np.zeros(0, dtype=np.int32),
+            "hit_distances": np.concatenate(hit_distances) if hit_distances else np.zeros(0, dtype=np.float32),
+        }
+
+        manifest = {
+            "version": MODEL_STORE_VERSION,
+            "mtime": self.mtime,
+            "right_handed": self.right_handed,
+            "surface_keys": keys,
+            "source_ids": [x.id for x in sources],
+            "source_paths": [x.image_path for x in sources],
+            "model_sources": [source_index[x] for x in self.color_sources],
+            "wall_heights": wall_heights,
+            "model_version": self.version,
+            "tracked_since": self.tracked_since,
+            "removed_surfaces": self.removed_surfaces,
+        }
+
+        dir_path = str(dir_path).rstrip(os.sep)
+        temp_path = "{}.tmp-{}".format(dir_path, os.getpid())
+        old_path = "{}.old-{}".format(dir_path, os.getpid())
+
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_path, name + ".npy"), array)
+
+        # Write the manifest last, since its presence marks a complete store.
+        with open(os.path.join(temp_path, "manifest.json"), "w") as output:
+            json.dump(manifest, output)
+
+        if os.path.exists(dir_path):
+            os.rename(dir_path, old_path)
+        os.rename(temp_path, dir_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
     def show(self):
         scene = self.scene.copy()
 
@@ -456,8 +1027,7 @@ class LocationModel():
         print(scene)
         print("Right handed: {}".format(self.right_handed))
 
-        lower = np.min(self.combined_mesh.vertices, axis=0)
-        upper = np.max(self.combined_mesh.vertices, axis=0)
+        lower, upper = self.combined_mesh.bounds
         print("Bounds: {} to {}".format(lower, upper))
 
         print("Cameras:")
@@ -493,6 +1063,7 @@ class LocationModel():
             path = Path(dir_path)
 
         used_color_sources = set()
+        replacement_keys = set()
         updated_model_mtime = self.mtime
         for path in sorted(path.iterdir(), key=os.path.getmtime, reverse=True):
             fname = os.path.basename(path)
@@ -530,7 +1101,9 @@ class LocationModel():
                         # with IOU > threshold and replace them all
                         print("Surface {} replaces {}".format(surface_id, overlapping_surface_id))
                         updated_surfaces.add(surface_id)
-                        used_color_sources = self.replace_surface(overlapping_surface_id, surface)
+                        used_color_sources.update(self.replace_surface(overlapping_surface_id, surface))
+                        replacement_keys.discard(overlapping_surface_id)
+                        replacement_keys.add(str(surface_id))
                     else:
                         print("Surface {} is redundant".format(surface_id))
 
@@ -540,35 +1113,51 @@ class LocationModel():
                 updated_surfaces.add(surface_id)
 
                 surface, _ = self.load_surface(path)
-                used_color_sources = self.replace_surface(surface_id, surface)
+                used_color_sources.update(self.replace_surface(surface_id, surface))
+                replacement_keys.add(str(surface_id))
 
         # Update the model modified time to exclude all processed surfaces in future updates.
         self.mtime = updated_model_mtime
 
         if len(used_color_sources) > 0:
             print("Change requires {} color sources be reapplied".format(len(used_color_sources)))
-            for source in used_color_sources:
-                recolored_surfaces = self.apply_color_source(source, should_reapply=True)
-                updated_surfaces.update(recolored_surfaces)
+            recolored_surfaces = self.reproject_color_sources(used_color_sources, replacement_keys)
+            updated_surfaces.update(recolored_surfaces)
 
         return updated_surfaces
 
     @classmethod
-    def from_directory(cls, dir_path):
+    def from_directory(cls, dir_path, workers=None):
         """
         Load scene from a directory containing PLY files.
+
+        If workers is greater than one, surface files are parsed and
+        transformed in a pool of worker processes. The results are still
+        consumed in order of modified time, newest first, so the choice of
+        surfaces to prune is the same as with serial loading.
         """
         model = LocationModel()
 
-        if isinstance(dir_path, str):
-            path = Path(dir_path)
+        paths = sorted(Path(dir_path).iterdir(), key=os.path.getmtime, reverse=True)
 
-        for path in sorted(path.iterdir(), key=os.path.getmtime, reverse=True):
-            surface, surface_id = model.load_surface(path)
-            if surface is not None:
-                iou, _ = model.compute_max_iou(surface)
-                if iou < cls.surface_pruning_threshold:
-                    model.append_surface(surface)
+        if workers is not None and workers > 1:
+            pool = ProcessPoolExecutor(workers)
+            chunksize = max(1, len(paths) // (4 * workers))
+            loaded = pool.map(read_surface_arrays, paths, itertools.repeat(model.right_handed), chunksize=chunksize)
+        else:
+            pool = None
+            loaded = (read_surface_arrays(path, model.right_handed) for path in paths)
+
+        try:
+            for path, arrays in zip(paths, loaded):
+                surface, surface_id = model.make_surface(path, arrays)
+                if surface is not None:
+                    iou, _ = model.compute_max_iou(surface)
+                    if iou < cls.surface_pruning_threshold:
+                        model.append_surface(surface)
+        finally:
+            if pool is not None:
+                pool.shutdown()
 
         return model
 
@@ -601,6 +1190,128 @@ class LocationModel():
 
         return model
 
+    @classmethod
+    def from_store(cls, dir_path):
+        """
+        Load scene from a directory written by save_store.
+
+        The large arrays are memory-mapped copy-on-write, so pages are only
+        read as they are accessed, and modifications stay in memory. The
+        per-surface meshes are views into the same buffers.
+        """
+        with open(os.path.join(dir_path, "manifest.json"), "r") as source:
+            manifest = json.load(source)
+
+        version = manifest.get("version")
+        if not isinstance(version, int) or not (MIN_MODEL_STORE_VERSION <= version <= MODEL_STORE_VERSION):
+            raise Exception("Unsupported model store version: {}".format(manifest.get("version")))
+
+        def load(name, mmap_mode=None):
+            return np.load(os.path.join(dir_path, name + ".npy"), mmap_mode=mmap_mode)
+
+        vertices = load("vertices", mmap_mode="c")
+        faces = load("faces", mmap_mode="c")
+        vertex_colors = load("vertex_colors", mmap_mode="c")
+
+        keys = manifest['surface_keys']
+        vertex_counts = load("vertex_counts")
+        face_counts = load("face_counts")
+        surface_mtimes = load("surface_mtimes")
+        surface_bounds = load("surface_bounds")
+
+        source_focal = load("source_focal")
+        source_position = load("source_position")
+        source_rotation = load("source_rotation")
+        source_focal_relative = load("source_focal_relative")
+
+        sources = []
+        for i, (source_id, path) in enumerate(zip(manifest['source_ids'], manifest['source_paths'])):
+            sources.append(MeshColorSource(source_id, path, tuple(source_focal[i]), source_position[i],
+                    source_rotation[i], bool(source_focal_relative[i])))
+
+        surface_source_counts = load("surface_source_counts")
+        surface_source_indices = load("surface_source_indices")
+        surface_source_starts = np.concatenate(([0], np.cumsum(surface_source_counts)))
+
+        model = LocationModel()
+        model.mtime = manifest['mtime']
+        model.right_handed = manifest['right_handed']
+        model.color_sources = set(sources[i] for i in manifest['model_sources'])
+        model.arena = MeshArena.from_buffers(keys, vertices, faces, vertex_counts, face_counts)
+
+        for i, (key, start, end) in enumerate(model.arena.vertex_ranges()):
+            f0 = model.arena.slot_face_start[i]
+            f1 = f0 + model.arena.slot_face_count[i]
+
+            source_indices = surface_source_indices[surface_source_starts[i]:surface_source_starts[i+1]]
+
+            # Only surfaces that received color from some source have
+            # meaningful vertex colors. Leaving the others unset matches the
+            # state of surfaces loaded from PLY files.
+            colors = None
+            if len(source_indices) > 0:
+                colors = vertex_colors[start:end]
+
+            surface = trimesh.Trimesh(vertices=vertices[start:end], faces=faces[f0:f1] - start,
+                    vertex_colors=colors, process=False, validate=False)
+            surface.metadata['name'] = key
+            surface.metadata['mtime'] = float(surface_mtimes[i])
+            surface.metadata['color_sources'] = set(sources[j] for j in source_indices)
+            model.scene.add_geometry(surface)
+
+        model.surface_index = BoundingBoxIndex.from_bounds(keys, surface_bounds)
+
+        # Stores written before wall cross-sections were cached do not have
+        # them, and they will be computed again when needed.
+        wall_heights = manifest.get('wall_heights', [])
+        if len(wall_heights) > 0:
+            wall_segment_counts = load("wall_segment_counts")
+            wall_segments = load("wall_segments")
+
+            offset = 0
+            for i, key in enumerate(keys):
+                for j, height in enumerate(wall_heights):
+                    count = wall_segment_counts[i, j]
+                    if count >= 0:
+                        model.wall_slices[(key, height)] = (float(surface_mtimes[i]), wall_segments[offset:offset+count])
+                        offset += count
+
+        # Stores written before color accumulators were kept do not have
+        # them. New color sources will then replace the existing colors.
+        if os.path.exists(os.path.join(dir_path, "color_weights.npy")):
+            color_sums = load("color_sums")
+            color_weights = load("color_weights")
+            for key, start, end in model.arena.vertex_ranges():
+                if np.any(color_weights[start:end] > 0):
+                    model.color_accumulators[key] = (color_sums[start:end].copy(), color_weights[start:end].copy())
+
+        # Surface change versions are also optional, and a version of -1 means
+        # the surface was added before changes were recorded.
+        if "model_version" in manifest:
+            model.version = manifest['model_version']
+            model.tracked_since = manifest['tracked_since']
+            model.removed_surfaces = dict(manifest['removed_surfaces'])
+
+            surface_versions = load("surface_versions")
+            for key, version in zip(keys, surface_versions):
+                if version >= 0:
+                    model.surface_versions[key] = int(version)
+
+        # The cached ray hits are also optional. Sources without them are
+        # reapplied to the whole model when one of their surfaces is replaced.
+        if os.path.exists(os.path.join(dir_path, "hit_groups.npy")):
+            hit_groups = load("hit_groups")
+            hit_rays = load("hit_rays", mmap_mode="c")
+            hit_distances = load("hit_distances", mmap_mode="c")
+
+            offset = 0
+            for source_i, surface_i, count in hit_groups:
+                source_hits = model.color_hits.setdefault(sources[source_i], dict())
+                source_hits[keys[surface_i]] = (hit_rays[offset:offset+count], hit_distances[offset:offset+count])
+                offset += count
+
+        return model
+
     @classmethod
     def from_pickle(cls, pickle_path):
         """
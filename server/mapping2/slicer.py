@@ -0,0 +1,141 @@
+import numpy as np
+
+from trimesh import tol
+
+
+# Codes for the sorted vertex signs of a face, as in trimesh.intersections.
+# Only these cases produce a line segment on the plane.
+CODE_BASIC = (4, 12)
+CODE_ONE_VERTEX = 8
+CODE_ONE_EDGE = 16
+
+
+def interpolate_edges(vertices, a, b, heights):
+    """
+    Find the points where edges (a, b) cross the given heights.
+    """
+    pa = vertices[a]
+    pb = vertices[b]
+    t = (heights - pa[:, 1]) / (pb[:, 1] - pa[:, 1])
+    return pa + t[:, np.newaxis] * (pb - pa)
+
+
+def slice_heights(vertices, faces, heights, return_faces=False):
+    """
+    Intersect a triangle mesh with several horizontal planes at once.
+
+    This produces the same segments as calling trimesh.intersections.mesh_plane
+    with the normal [0, 1, 0] once per height, but it only makes one pass over
+    the faces. The vertical range of each face is compared against the sorted
+    heights to find the (face, height) pairs that could intersect, and all of
+    the pairs are then handled together.
+
+    Returns a list with an (N, 2, 3) array of segments for each height, in the
+    order of the heights argument. If return_faces is set, also returns a list
+    of arrays with the face index of each segment.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    faces = np.asarray(faces, dtype=int)
+    heights = np.asarray(heights, dtype=float).reshape(-1)
+
+    if len(faces) == 0:
+        result_lines = [np.zeros((0, 2, 3)) for _ in heights]
+        result_faces = [np.zeros(0, dtype=int) for _ in heights]
+        if return_faces:
+            return result_lines, result_faces
+        return result_lines
+
+    order = np.argsort(heights, kind='stable')
+    sorted_heights = heights[order]
+
+    # A face can only cross the planes within its own vertical range.
+    ys = vertices[faces, 1]
+    lo = np.searchsorted(sorted_heights, ys.min(axis=1) - tol.merge, side='left')
+    hi = np.searchsorted(sorted_heights, ys.max(axis=1) + tol.merge, side='right')
+    counts = hi - lo
+
+    # Expand into one row per candidate (face, height) pair.
+    pair_face = np.repeat(np.arange(len(faces)), counts)
+    pair_starts = np.cumsum(counts) - counts
+    pair_level = np.repeat(lo - pair_starts, counts) + np.arange(len(pair_face))
+    pair_height = sorted_heights[pair_level]
+
+    pair_vertices = faces[pair_face]
+    dots = ys[pair_face] - pair_height[:, np.newaxis]
+
+    signs = np.zeros(dots.shape, dtype=np.int8)
+    signs[dots < -tol.merge] = -1
+    signs[dots > tol.merge] = 1
+
+    signs_sorted = np.sort(signs, axis=1)
+    coded = 14 + (signs_sorted[:, 0] << 3) + (signs_sorted[:, 1] << 2) + (signs_sorted[:, 2] << 1)
+
+    lines = np.zeros((len(pair_face), 2, 3))
+    rows = np.arange(len(pair_face))
+
+    # One vertex on one side of the plane and two on the other. Both
+    # segment endpoints lie on the edges leaving the unique vertex.
+    basic = np.isin(coded, CODE_BASIC)
+    if np.any(basic):
+        s = signs[basic]
+        unique = np.argmax(s == -np.sum(s, axis=1, keepdims=True), axis=1)
+        fv = pair_vertices[basic]
+        r = rows[:len(fv)]
+        a = fv[r, unique]
+        b = fv[r, (unique + 1) % 3]
+        c = fv[r, (unique + 2) % 3]
+        lines[basic, 0] = interpolate_edges(vertices, a, b, pair_height[basic])
+        lines[basic, 1] = interpolate_edges(vertices, a, c, pair_height[basic])
+
+    # One vertex on the plane and the other two on different sides.
+    one_vertex = coded == CODE_ONE_VERTEX
+    if np.any(one_vertex):
+        s = signs[one_vertex]
+        on = np.argmax(s == 0, axis=1)
+        fv = pair_vertices[one_vertex]
+        r = rows[:len(fv)]
+        a = fv[r, (on + 1) % 3]
+        b = fv[r, (on + 2) % 3]
+
+        # Keep the off-plane vertices in face order like mesh_plane does.
+        swap = on == 1
+        a[swap], b[swap] = b[swap], a[swap].copy()
+
+        lines[one_vertex, 0] = vertices[fv[r, on]]
+        lines[one_vertex, 1] = interpolate_edges(vertices, a, b, pair_height[one_vertex])
+
+    # One edge fully on the plane and the last vertex above it. Faces with
+    # the last vertex below are skipped, so that regions co-planar with the
+    # plane do not produce duplicate boundaries.
+    one_edge = coded == CODE_ONE_EDGE
+    if np.any(one_edge):
+        s = signs[one_edge]
+        off = np.argmax(s != 0, axis=1)
+        fv = pair_vertices[one_edge]
+        r = rows[:len(fv)]
+        a = np.where(off == 0, fv[r, 1], fv[r, 0])
+        b = np.where(off == 2, fv[r, 1], fv[r, 2])
+        lines[one_edge, 0] = vertices[a]
+        lines[one_edge, 1] = vertices[b]
+
+    hits = basic | one_vertex | one_edge
+    hit_level = pair_level[hits]
+    hit_lines = lines[hits]
+    hit_faces = pair_face[hits]
+
+    # Group the segments by height. Pairs are ordered by face, and the
+    # stable sort keeps that order within each height.
+    by_level = np.argsort(hit_level, kind='stable')
+    splits = np.searchsorted(hit_level[by_level], np.arange(1, len(heights)))
+    sorted_lines = np.split(hit_lines[by_level], splits)
+    sorted_faces = np.split(hit_faces[by_level], splits)
+
+    result_lines = [None] * len(heights)
+    result_faces = [None] * len(heights)
+    for level, i in enumerate(order):
+        result_lines[i] = sorted_lines[level]
+        result_faces[i] = sorted_faces[level]
+
+    if return_faces:
+        return result_lines, result_faces
+    return result_lines
@@ -10,9 +10,12 @@ import numpy as np
 import svgwrite
 import trimesh
 
-from .chunk import Chunk
+from scipy.spatial import cKDTree
+
+from .chunk import Chunk, label_components, walkable_edges
 from .navmesh import NavigationMesh
 from .link import LinkEndpoint
+from .spatial import BoundingBoxIndex
 
 
 walkable_threshold = 0.5
@@ -25,10 +28,14 @@ iou_pruning_threshold = 0.6
 
 
 class LayerConfig:
-    def __init__(self, height=0, svg_output=None):
+    def __init__(self, height=0, svg_output=None, slices=None):
         self.height = height
         self.svg_output = svg_output
 
+        # Optional list of offsets from the reference height for drawing a
+        # stack of cross-sections, e.g. to visualize several floors at once.
+        self.slices = slices
+
 
 def logistic(x):
     return 1 / (1 + np.exp(-x))
@@ -114,6 +121,12 @@ class MeshSoup:
         # array, length is number of faces in mesh, maps from global index into chunk index
         self.local_id = []
 
+        # array, length is number of chunks plus one, index of the first face of each chunk
+        self.chunk_offsets = np.zeros(1, dtype=int)
+
+        # array, length is number of faces in mesh, component ID local to the chunk
+        self.face_component = np.zeros(0, dtype=int)
+
         self.links = []
 
         self.lower = None
@@ -129,6 +142,9 @@ class MeshSoup:
 
         self.component_graph = nx.Graph()
 
+        # Map from body ID to (boundary edges, KD-tree of edge midpoints).
+        self.boundary_trees = dict()
+
     def create_navigation_mesh(self):
         graph = nx.Graph()
 
@@ -170,11 +186,20 @@ class MeshSoup:
         mesh = self.mesh.submesh([keep_faces], append=True)
         return NavigationMesh(mesh, graph, component_ids)
 
+    def index_chunks(self):
+        """
+        Compute the per-face lookup tables after the chunks have been loaded.
+        """
+        face_counts = [len(chunk.mesh.faces) for chunk in self.chunks]
+        self.chunk_offsets = np.concatenate(([0], np.cumsum(face_counts))).astype(int)
+
+        if len(self.chunks) > 0:
+            self.face_component = np.concatenate([np.asarray(chunk.component_id, dtype=int) for chunk in self.chunks])
+        else:
+            self.face_component = np.zeros(0, dtype=int)
+
     def face_local_to_global_index(self, chunk_index, face_index):
-        offset = 0
-        for i in range(chunk_index):
-            offset += len(self.chunks[i].mesh.faces)
-        return offset + face_index
+        return self.chunk_offsets[chunk_index] + face_index
 
     def observed_transition(self, face1, face2, sample1=None, sample2=None):
         lface1 = self.local_id[face1]
@@ -196,6 +221,33 @@ class MeshSoup:
         if chunk1 != chunk2 or comp1 != comp2:
             self.component_graph.add_edge((chunk1_index, comp1), (chunk2_index, comp2))
 
+    def observed_transitions(self, faces1, faces2):
+        """
+        Update the component graph from many observed face transitions.
+
+        This is equivalent to calling observed_transition for each pair, but
+        the transitions are reduced to unique component pairs first.
+        """
+        faces1 = np.asarray(faces1, dtype=int)
+        faces2 = np.asarray(faces2, dtype=int)
+
+        chunks1 = self.chunk_id[faces1]
+        chunks2 = self.chunk_id[faces2]
+        comps1 = self.face_component[faces1]
+        comps2 = self.face_component[faces2]
+
+        # Only movements between components / bodies change the graph.
+        moved = (chunks1 != chunks2) | (comps1 != comps2)
+        nodes1 = np.column_stack((chunks1[moved], comps1[moved]))
+        nodes2 = np.column_stack((chunks2[moved], comps2[moved]))
+
+        # The graph is undirected, so put each pair in a canonical order.
+        first = (nodes1[:, 0] < nodes2[:, 0]) | ((nodes1[:, 0] == nodes2[:, 0]) & (nodes1[:, 1] < nodes2[:, 1]))
+        pairs = np.where(first[:, np.newaxis], np.hstack((nodes1, nodes2)), np.hstack((nodes2, nodes1)))
+        pairs = np.unique(pairs, axis=0)
+
+        self.component_graph.add_edges_from(((a, b), (c, d)) for a, b, c, d in pairs.tolist())
+
     def add_trace(self, times, points, apply_cylinder=False):
         """
         Annotate the mesh using a trace (user position history).
@@ -203,9 +255,8 @@ class MeshSoup:
         This updates the set of visited faces and walkability information based
         on transitions observed in the trace.
         """
-        down = np.array([0, -1, 0])
-
-        directions = np.tile(down, [len(points), 1])
+        points = np.asarray(points, dtype=float)
+        directions = np.tile(self.down, [len(points), 1])
 
         locations, index_ray, index_tri = self.mesh.ray.intersects_location(ray_origins=points, ray_directions=directions, multiple_hits=False)
 
@@ -215,46 +266,26 @@ class MeshSoup:
         # Even though the trace was in chronological order, for some reason
         # intersects_location returns them in a different order.
         sorted_rays = np.argsort(index_ray)
+        faces = index_tri[sorted_rays]
+        hits = locations[sorted_rays]
 
-        for i in range(len(sorted_rays) - 1):
-            # These are indices into (locations, index_ray, index_tri).
-            u = sorted_rays[i]
-            v = sorted_rays[i+1]
-
-            # Visited faces in the mesh.
-            face1 = index_tri[u]
-            face2 = index_tri[v]
-
-            # Check if the two points are in the same mesh face.
-            if face1 == face2:
-                continue
-
-            # Intersection points with the mesh.
-            hit1 = locations[u]
-            hit2 = locations[v]
-
-            # Check if the distance between the two points is great.
-            dist = np.linalg.norm(hit1 - hit2)
-            if dist > max_connection_distance:
-                #print("Skipping edge of distance {}".format(dist))
-                continue
-
-            self.observed_transition(face1, face2, points[i], points[i+1])
+        # Consider transitions between consecutive hits, skipping pairs in the
+        # same mesh face or too far apart to be a direct movement.
+        dist = np.linalg.norm(hits[1:] - hits[:-1], axis=1)
+        keep = (faces[1:] != faces[:-1]) & (dist <= max_connection_distance)
+        self.observed_transitions(faces[:-1][keep], faces[1:][keep])
 
         # Move a human-sized cylinder along the path and add any touched faces.
         # This helps improve fill holes in the walkable mesh, but it might also
-        # do weird things like fall through the floor. It also slows things
-        # down a bit.
-        if apply_cylinder:
+        # do weird things like fall through the floor. All of the rays are cast
+        # in a single batch.
+        if apply_cylinder and len(points) > 0:
             theta = np.linspace(0, np.pi, 12)
-            directions = np.tile(down, [len(theta), 1])
-            for i in range(len(points)):
-                cylinder = np.zeros((12, 3))
-                cylinder[:, 0] = points[i, 0] + cylinder_radius * np.cos(theta)
-                cylinder[:, 1] = points[i, 1]
-                cylinder[:, 2] = points[i, 2] + cylinder_radius * np.sin(theta)
-                locations, index_ray, index_tri = self.mesh.ray.intersects_location(ray_origins=cylinder, ray_directions=directions, multiple_hits=False)
-                self.touched.update(index_tri)
+            offsets = np.column_stack((cylinder_radius * np.cos(theta), np.zeros(len(theta)), cylinder_radius * np.sin(theta)))
+            cylinders = (points[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 3)
+            directions = np.tile(self.down, [len(cylinders), 1])
+            locations, index_ray, index_tri = self.mesh.ray.intersects_location(ray_origins=cylinders, ray_directions=directions, multiple_hits=False)
+            self.touched.update(index_tri)
 
     def export_obj(self, path):
         # Negate x-axis to convert handedness. Unity-based OBJ loader are
@@ -363,45 +394,81 @@ class MeshSoup:
         boundary_edges = self.mesh.edges_unique[sel]
         return boundary_edges
 
+    def get_boundary_tree(self, body_id):
+        """
+        Get the boundary edges of a body and a KD-tree of their midpoints.
+
+        The result is cached, since linking bodies queries the same boundaries
+        repeatedly. The tree is None if the body has no boundary.
+        """
+        if body_id not in self.boundary_trees:
+            boundary = self.find_boundary_edges(body_id)
+            if len(boundary) == 0:
+                tree = None
+            else:
+                midpoints = 0.5 * (self.mesh.vertices[boundary[:, 0]] + self.mesh.vertices[boundary[:, 1]])
+                tree = cKDTree(midpoints)
+            self.boundary_trees[body_id] = (boundary, tree)
+        return self.boundary_trees[body_id]
+
     def closest_points_on_boundary(self, source, target):
         """
         Find the set of points on the target mesh's boundary that are closest
         to one or more of the points in the source mesh's boundary.
         """
-        closest_indices = set()
-        closest_points = set()
-        closest_dist = np.inf
-
-        source_boundary = self.find_boundary_edges(source)
+        source_boundary, _ = self.get_boundary_tree(source)
         if len(source_boundary) == 0:
-            return closest_dist, []
+            return np.inf, []
 
-        target_boundary = self.find_boundary_edges(target)
-        if len(target_boundary) == 0:
-            return closest_dist, []
+        # Anytime the midpoint of a target boundary edge is selected as the
+        # closest point, we take both of the endpoints for that edge.
+        target_boundary, target_tree = self.get_boundary_tree(target)
+        if target_tree is None:
+            return np.inf, []
 
-        # Take the midpoint on each of the boundary edges.
-        # Anytime this midpoint is selected as the closest point,
-        # add both the associated endpoints for that edge.
-        target_vertices = 0.5 * (self.mesh.vertices[target_boundary[:, 0]] + self.mesh.vertices[target_boundary[:, 1]])
+        # For each source boundary point, find the closest target boundary point.
+        distances, closest = target_tree.query(self.mesh.vertices[source_boundary[:, 0]])
 
-        # For each source boundary point, find the closest target boundary point
-        # and add that to the set.
-        for i in range(len(source_boundary)):
-            v = self.mesh.vertices[source_boundary[i, 0], :]
+        edges = target_boundary[np.unique(closest), :]
+        return np.min(distances), edges
 
-            # distance between source point i and all of the target boundary points
-            distances = np.linalg.norm(v - target_vertices, axis=1)
-
-            min_ind = np.argmin(distances)
-            closest_indices.add(min_ind)
-            closest_points.add(target_boundary[min_ind, 0])
-            closest_points.add(target_boundary[min_ind, 1])
-            if distances[min_ind] < closest_dist:
-                closest_dist = distances[min_ind]
+    def find_boundary_links(self, max_distance=max_connection_distance):
+        """
+        Find candidate links between all pairs of bodies with boundaries
+        within max_distance of each other.
 
-        edges = target_boundary[list(closest_indices), :]
-        return closest_dist, edges
+        Returns a list of (source body, target body, distance, target edges)
+        tuples in the format of closest_points_on_boundary.
+        """
+        bodies = []
+        points = []
+        for body_id in range(len(self.components)):
+            boundary, tree = self.get_boundary_tree(body_id)
+            if tree is not None:
+                bodies.append(np.full(len(boundary), body_id))
+                points.append(self.mesh.vertices[boundary[:, 0]])
+
+        if len(bodies) == 0:
+            return []
+
+        bodies = np.concatenate(bodies)
+        points = np.concatenate(points)
+
+        # Pairs of boundary points from different bodies that are close
+        # enough identify the pairs of bodies worth examining in detail.
+        pairs = cKDTree(points).query_pairs(max_distance, output_type='ndarray')
+        body_pairs = np.column_stack((bodies[pairs[:, 0]], bodies[pairs[:, 1]]))
+        body_pairs = body_pairs[body_pairs[:, 0] != body_pairs[:, 1]]
+        body_pairs = np.unique(np.sort(body_pairs, axis=1), axis=0)
+
+        links = []
+        for a, b in body_pairs.tolist():
+            for source, target in [(a, b), (b, a)]:
+                dist, edges = self.closest_points_on_boundary(source, target)
+                if dist <= max_distance:
+                    links.append((source, target, dist, edges))
+
+        return links
 
     def print_mesh_info(self):
         print("Mesh: {}".format(self.mesh))
@@ -423,26 +490,14 @@ class MeshSoup:
         """
         Split mesh into connected components (bodies) by face adjacency.
 
-        Returns an array of length N, where N is the number of faces,
-        and the value is the the body ID.
-        """
-        edges = []
-        for a, b in mesh.face_adjacency:
-            if mesh.face_normals[a, 1] >= walkable_threshold and mesh.face_normals[b, 1]:
-                edges.append([a, b])
-
-        components = trimesh.graph.connected_components(
-                edges=edges,
-                nodes=np.arange(len(mesh.faces)),
-                min_len=1,
-                engine='networkx')
-
-        body_indices = np.zeros(len(mesh.faces), dtype=int)
-
-        for i, component in enumerate(components):
-            body_indices[component] = i
+        Returns a list of face index arrays, one per body, and an array of
+        length N, where N is the number of faces, and the value is the body ID.
 
-        return components, body_indices
+        Faces are joined only if both of them are walkable, as for chunks.
+        """
+        if len(mesh.faces) == 0:
+            return [], np.zeros(0, dtype=int)
+        return label_components(len(mesh.faces), walkable_edges(mesh))
 
     @classmethod
     def from_directory(cls, dir_path, cache_dir=None, exclude=set()):
@@ -456,6 +511,8 @@ class MeshSoup:
         if isinstance(dir_path, str):
             path = Path(dir_path)
 
+        chunk_bounds = BoundingBoxIndex()
+
         skipped = set()
         for path in sorted(path.iterdir(), key=os.path.getmtime, reverse=True):
             if cache_dir is None:
@@ -476,19 +533,15 @@ class MeshSoup:
             # union (IOU), which is between 0 and 1.  We ensure freshness by
             # sorting the files by modified time, newest first.
             #
-            # This approach is O(N^2), which is a little risky. We have a few
-            # options for optimization, the most obvious being to save the list
-            # of skipped chunks and delete or never load them again.
-            skip_chunk = False
-            for other in soup.chunks:
-                iou = chunk.compute_iou(other)
-                if iou > iou_pruning_threshold:
-                    skip_chunk = True
-                    break
-            if skip_chunk:
+            # The spatial index limits the comparison to chunks with
+            # intersecting bounding boxes.
+            iou, _ = chunk_bounds.compute_max_iou(chunk.mesh.bounds)
+            if iou > iou_pruning_threshold:
                 skipped.add(chunk.id)
                 continue
 
+            chunk_bounds.insert(chunk.id, chunk.mesh.bounds)
+
             try:
                 # Prefer formatted UUID string if possible
                 # The names will be exported as objects in OBJ files
@@ -516,6 +569,8 @@ class MeshSoup:
         soup.lower = np.min(soup.mesh.vertices, axis=0)
         soup.upper = np.max(soup.mesh.vertices, axis=0)
 
+        soup.index_chunks()
+
         return soup, skipped
 
     @classmethod
@@ -531,7 +586,7 @@ class MeshSoup:
             origins.extend([i] * len(mesh.faces))
             local_ids.extend(range(len(mesh.faces)))
 
-            chunk = Chunk()
+            chunk = Chunk(str(i))
             chunk.set_mesh(mesh)
             soup.chunks.append(chunk)
 
@@ -540,8 +595,11 @@ class MeshSoup:
 
         soup.mesh = trimesh.util.concatenate(meshes)
         soup.components, soup.body_id = cls.split_mesh(soup.mesh)
+        soup.boundary_trees = dict()
 
         soup.lower = np.min(soup.mesh.vertices, axis=0)
         soup.upper = np.max(soup.mesh.vertices, axis=0)
 
+        soup.index_chunks()
+
         return soup
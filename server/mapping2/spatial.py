@@ -0,0 +1,129 @@
+import numpy as np
+
+from rtree import index
+
+
+class BoundingBoxIndex:
+    """
+    Spatial index of axis-aligned 3D bounding boxes.
+
+    Boxes are identified by arbitrary hashable keys, e.g. surface names. The
+    boxes are stored in an R-tree so that overlap queries only need to consider
+    boxes that actually intersect the query box instead of every box. The
+    R-tree itself does not survive pickling, so it is rebuilt from the saved
+    bounds when the object is loaded.
+    """
+
+    def __init__(self):
+        # Map from key to (2, 3) array of lower and upper bounds.
+        self.bounds = dict()
+
+        # The R-tree requires integer IDs, so we maintain a mapping.
+        self.ids = dict()
+        self.keys = dict()
+        self.next_id = 0
+
+        self._index = self._create_index()
+
+    def __contains__(self, key):
+        return key in self.bounds
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = self._create_index(self.bounds.items())
+
+    def _create_index(self, items=None):
+        properties = index.Property()
+        properties.dimension = 3
+
+        if items:
+            # Bulk loading is much faster than inserting boxes one at a time.
+            stream = ((self.ids[key], self._coordinates(bounds), None) for key, bounds in items)
+            return index.Index(stream, properties=properties)
+        else:
+            return index.Index(properties=properties)
+
+    @staticmethod
+    def _coordinates(bounds):
+        return tuple(bounds[0]) + tuple(bounds[1])
+
+    def insert(self, key, bounds):
+        """
+        Insert or update the bounding box for a key.
+        """
+        if key in self.bounds:
+            self.remove(key)
+
+        bounds = np.array(bounds, dtype=float)
+
+        _id = self.next_id
+        self.next_id += 1
+
+        self.bounds[key] = bounds
+        self.ids[key] = _id
+        self.keys[_id] = key
+        self._index.insert(_id, self._coordinates(bounds))
+
+    def remove(self, key):
+        bounds = self.bounds.pop(key)
+        _id = self.ids.pop(key)
+        del self.keys[_id]
+        self._index.delete(_id, self._coordinates(bounds))
+
+    def intersection(self, bounds):
+        """
+        Find keys of all boxes that intersect the given box.
+        """
+        return [self.keys[x] for x in self._index.intersection(self._coordinates(bounds))]
+
+    def compute_max_iou(self, bounds):
+        """
+        Compute intersection-over-union (IOU) between the given box and the
+        indexed box with maximal overlap.
+
+        Returns (max IOU, key) or (0, None) if no box intersects.
+        """
+        candidates = self.intersection(bounds)
+        if len(candidates) == 0:
+            return 0, None
+
+        bounds = np.asarray(bounds, dtype=float)
+        other = np.array([self.bounds[key] for key in candidates])
+
+        inter_lower = np.maximum(bounds[0], other[:, 0, :])
+        inter_upper = np.minimum(bounds[1], other[:, 1, :])
+        inter_volume = np.prod(np.maximum(inter_upper - inter_lower, 0), axis=1)
+
+        volume = np.prod(bounds[1] - bounds[0])
+        other_volume = np.prod(other[:, 1, :] - other[:, 0, :], axis=1)
+        union_volume = volume + other_volume - inter_volume
+
+        # Flat boxes have zero volume, and two of them could overlap with zero union.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iou = np.where(union_volume > 0, inter_volume / union_volume, 0)
+
+        i = np.argmax(iou)
+        return iou[i], candidates[i]
+
+    @classmethod
+    def from_bounds(cls, keys, bounds):
+        """
+        Create an index from a list of keys and matching (N, 2, 3) array of
+        bounds using R-tree bulk loading.
+        """
+        spatial_index = cls()
+        for i, key in enumerate(keys):
+            spatial_index.bounds[key] = np.array(bounds[i], dtype=float)
+            spatial_index.ids[key] = i
+            spatial_index.keys[i] = key
+        spatial_index.next_id = len(keys)
+        spatial_index._index = spatial_index._create_index(spatial_index.bounds.items())
+        return spatial_index
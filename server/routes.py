@@ -37,3 +37,44 @@ async def list_icons():
 
     return await make_response(jsonify({"file_paths": totalFiles}),
                                HTTPStatus.OK)
+
+
+@routes.route('/navigator/metrics', methods=['GET'])
+@auth.requires_user
+async def get_navigator_metrics():
+    """
+    Get navigator floor grid persistence metrics
+    ---
+    get:
+        summary: Get navigator floor grid persistence metrics
+        description: |-
+            Floor grids are written to disk in the background. This reports
+            the number of writes, how many updates were coalesced into an
+            earlier write, the number of grids waiting to be written, and write
+            latency in seconds.
+        tags:
+          - locations
+        responses:
+            200:
+                description: Floor grid persistence metrics.
+                content:
+                    application/json:
+                        schema:
+                            type: object
+                            properties:
+                                saves:
+                                    type: integer
+                                coalesced_updates:
+                                    type: integer
+                                backlog:
+                                    type: integer
+                                saves_in_progress:
+                                    type: integer
+                                last_save_seconds:
+                                    type: number
+                                max_save_seconds:
+                                    type: number
+                                mean_save_seconds:
+                                    type: number
+    """
+    return jsonify(current_app.navigator.dump_save_metrics()), HTTPStatus.OK
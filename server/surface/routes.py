@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import json
 import os
 import shutil
 import time
@@ -40,6 +41,44 @@ def get_surface_dir(location_id):
     return os.path.join(g.data_dir, 'locations', location_id.hex, 'surfaces')
 
 
+def get_surface_versions_file(location_id):
+    return os.path.join(g.data_dir, 'locations', location_id.hex, 'surface_versions.json')
+
+
+def read_surface_changes(path, location_id, since):
+    """
+    Read the surface versions file and list changes since a model version.
+    """
+    if not os.path.exists(path):
+        return {"model_version": 0, "since": since, "reset": True, "changed": [], "removed": []}
+
+    with open(path, "r") as source:
+        versions = json.load(source)
+
+    changed = []
+    for surface_id, version in versions['surfaces'].items():
+        if version > since:
+            changed.append({
+                "id": surface_id,
+                "version": version,
+                "fileUrl": "/locations/{}/surfaces/{}/surface.obj".format(location_id, surface_id)
+            })
+
+    removed = []
+    for surface_id, version in versions['removed'].items():
+        if version > since:
+            removed.append({"id": surface_id, "version": version})
+
+    tracked_since = versions['tracked_since']
+    return {
+        "model_version": versions['version'],
+        "since": since,
+        "reset": tracked_since is None or since < tracked_since,
+        "changed": changed,
+        "removed": removed
+    }
+
+
 @surfaces.route('/locations/<uuid:location_id>/surfaces', methods=['GET'])
 async def list_surfaces(location_id):
     """
@@ -75,6 +114,82 @@ async def list_surfaces(location_id):
     return jsonify(maybe_wrap(items)), HTTPStatus.OK
 
 
+@surfaces.route('/locations/<uuid:location_id>/surfaces/changes', methods=['GET'])
+async def list_surface_changes(location_id):
+    """
+    List surfaces changed since a model version
+    ---
+    get:
+        summary: List surfaces changed since a model version
+        description: |-
+            Clients which have downloaded the colored model at some model
+            version can use this to fetch only the surface.obj files that
+            changed since then, and to drop the surfaces that were removed.
+            If reset is true, changes from that far back are not known, and
+            the client should download the full model instead.
+        tags:
+         - surfaces
+        parameters:
+          - name: id
+            in: path
+            required: true
+            description: Location ID
+          - name: since
+            in: query
+            required: true
+            description: Last model version seen by the client.
+        responses:
+            200:
+                description: |-
+                    The current model version, the surfaces that changed
+                    after the given version with URLs of their files, and
+                    the surfaces that were removed after it.
+                content:
+                    application/json:
+                        schema:
+                            type: object
+                            properties:
+                                model_version:
+                                    type: integer
+                                since:
+                                    type: integer
+                                reset:
+                                    type: boolean
+                                changed:
+                                    type: array
+                                    items:
+                                        type: object
+                                        properties:
+                                            id:
+                                                type: string
+                                            version:
+                                                type: integer
+                                            fileUrl:
+                                                type: string
+                                removed:
+                                    type: array
+                                    items:
+                                        type: object
+                                        properties:
+                                            id:
+                                                type: string
+                                            version:
+                                                type: integer
+            400:
+                description: The since parameter is missing or invalid.
+    """
+    since = request.args.get("since", type=int)
+    if since is None:
+        raise exceptions.BadRequest(description="Missing or invalid since parameter")
+
+    path = get_surface_versions_file(location_id)
+
+    loop = asyncio.get_event_loop()
+    result = await loop.run_in_executor(current_app.thread_pool, read_surface_changes, path, location_id, since)
+
+    return jsonify(result), HTTPStatus.OK
+
+
 @surfaces.route('/locations/<uuid:location_id>/surfaces', methods=['DELETE'])
 @auth.requires_admin
 async def clear_surfaces(location_id):
@@ -1,4 +1,5 @@
 import os
+import shutil
 
 from http import HTTPStatus
 
@@ -55,6 +56,76 @@ async def test_location_routes():
         assert response.status_code == HTTPStatus.OK
         assert response.headers['Content-Type'].startswith("image/svg+xml")
 
+        route_url = "/locations/{}/route?from=-2,0,7.5&to=22,0,9.5".format(location['id'])
+
+        # Without a navigation mesh, the route is a straight line
+        response = await client.get(route_url)
+        assert response.status_code == HTTPStatus.OK
+        assert response.is_json
+        route = await response.get_json()
+        assert route == [{"x": -2.0, "y": 0.0, "z": 7.5}, {"x": 22.0, "y": 0.0, "z": 9.5}]
+
+        routes_url = "/locations/{}/routes?from=-2,0,7.5&from=4,0,1&to=22,0,9.5".format(location['id'])
+
+        response = await client.get(routes_url)
+        assert response.status_code == HTTPStatus.OK
+        assert response.is_json
+        routes = await response.get_json()
+        assert len(routes) == 2
+        assert routes[1] == [{"x": 4.0, "y": 0.0, "z": 1.0}, {"x": 22.0, "y": 0.0, "z": 9.5}]
+
+        response = await client.get("/locations/{}/routes?to=22,0,9.5".format(location['id']))
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+        # Colored model in OBJ and GLB formats
+        location_dir = os.path.join(app.config.get('VIZAR_DATA_DIR', 'data'), 'locations', location['id'].replace('-', ''))
+        os.makedirs(location_dir, exist_ok=True)
+        with open(os.path.join(location_dir, "colored.obj"), "w") as output:
+            output.write("o test\nv 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n")
+        with open(os.path.join(location_dir, "colored.glb"), "wb") as output:
+            output.write(b"glTF" + bytes(range(60)))
+
+        colored_url = "/locations/{}/colored.obj".format(location['id'])
+
+        response = await client.get(colored_url)
+        assert response.status_code == HTTPStatus.OK
+        assert (await response.get_data()).startswith(b"o test")
+        assert "Accept" in response.headers['Vary']
+
+        response = await client.get(colored_url, headers={"Accept": "model/gltf-binary"})
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['Content-Type'] == "model/gltf-binary"
+        assert (await response.get_data()).startswith(b"glTF")
+        etag = response.headers['ETag']
+
+        response = await client.get(colored_url, headers={"Accept": "model/gltf-binary", "If-None-Match": etag})
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+        response = await client.get(colored_url, headers={"Accept": "model/gltf-binary", "Range": "bytes=4-7"})
+        assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+        assert await response.get_data() == bytes(range(4))
+
+        response = await client.get("/locations/{}/model?colored".format(location['id']), headers={"Accept": "model/gltf-binary"})
+        assert response.status_code == HTTPStatus.OK
+        assert response.headers['Content-Type'] == "model/gltf-binary"
+
+        # Simplified model, falling back to full resolution for other levels
+        with open(os.path.join(location_dir, "colored-lod1.obj"), "w") as output:
+            output.write("o lod1\nv 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n")
+
+        response = await client.get(colored_url + "?lod=1")
+        assert response.status_code == HTTPStatus.OK
+        assert (await response.get_data()).startswith(b"o lod1")
+
+        response = await client.get(colored_url + "?lod=2")
+        assert response.status_code == HTTPStatus.OK
+        assert (await response.get_data()).startswith(b"o test")
+
+        response = await client.get(colored_url + "?lod=-1")
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+        shutil.rmtree(location_dir)
+
         # Test changing the name
         response = await client.patch(location_url, json=dict(id="bad", name="Changed"))
         assert response.status_code == HTTPStatus.OK
@@ -1,5 +1,7 @@
 import tempfile
 
+import numpy as np
+
 from server.mapping.datagrid import DataGrid
 
 
@@ -165,3 +167,32 @@ def test_resize_to_other():
     point = test.index_to_xz(k2)
     assert abs(point[0] - original[0]) < 0.01
     assert abs(point[1] - original[1]) < 0.01
+
+
+def test_a_star_engines():
+    # The compiled and Python searches should find exactly the same routes,
+    # including how ties between equally good paths are broken.
+    rng = np.random.default_rng(1)
+
+    for trial in range(20):
+        grid = DataGrid(width=12, height=12, left=-6, top=-6)
+        grid.data = (rng.random(grid.data.shape) < 0.25).astype(float)
+
+        cost = None
+        if trial % 2 == 1:
+            cost = rng.random(grid.data.shape)
+
+        a = (-5.5, 0, -5.5)
+        b = tuple(rng.uniform(-6, 6, size=3))
+        grid[grid.xyz_to_index(a)] = 0
+        grid[grid.xyz_to_index(b)] = 0
+
+        passable = grid.data < 0.25
+        expected = grid.a_star(a, b, cost=cost, passable=passable, engine="python")
+        path = grid.a_star(a, b, cost=cost, passable=passable, engine="numba")
+        assert path == expected
+
+        # The lambda interface uses the Python search and agrees as well.
+        if cost is None:
+            assert grid.a_star(a, b, passable=lambda cell, value: value < 0.25) == expected
+            assert grid.a_star(a, b, passable=DataGrid.zero_passable) == expected
@@ -1,3 +1,8 @@
+from types import SimpleNamespace
+
+import numpy as np
+import trimesh
+
 from server.mapping.floorplanner import Floorplanner
 
 
@@ -13,3 +18,51 @@ def test_floorplanner():
     fp.update_lines(initialize=False)
     assert 'files' in fp.data
     assert 'cutting_height' in fp.data
+
+
+def make_mesh(vertices, triangles):
+    return SimpleNamespace(vertices=np.array(vertices, dtype=float), triangles=np.array(triangles, dtype=int))
+
+
+def make_wall(x0, x1, z, columns=6):
+    # A vertical strip of quads from x0 to x1, two meters high.
+    vertices = []
+    for x in np.linspace(x0, x1, columns + 1):
+        vertices.extend([[x, 0, z], [x, 2, z]])
+
+    triangles = []
+    for i in range(columns):
+        a, b, c, d = 2*i, 2*i+1, 2*i+2, 2*i+3
+        triangles.extend([[a, c, b], [b, c, d]])
+
+    return make_mesh(vertices, triangles)
+
+
+def test_calculate_intersections():
+    fp = Floorplanner([])
+
+    # An open wall produces one polyline along its full length.
+    paths = fp.calculate_intersections(make_wall(0, 3, 1), headset_position=[0, 0.5, 0])
+    assert len(paths) == 1
+    path = np.array(paths[0])
+    assert np.allclose(path[:, 1], 0.5)
+    assert np.allclose(path[:, 2], 1)
+    assert np.allclose(sorted([path[0, 0], path[-1, 0]]), [0, 3])
+    assert np.all(np.diff(path[:, 0]) > 0) or np.all(np.diff(path[:, 0]) < 0)
+
+    # A closed box produces a closed loop around all four sides.
+    box = trimesh.creation.box(extents=[2, 2, 2])
+    paths = fp.calculate_intersections(make_mesh(box.vertices, box.faces), headset_position=[0, 0.25, 0])
+    assert len(paths) == 1
+    path = np.array(paths[0])
+    assert np.allclose(path[0], path[-1])
+    assert np.allclose(path[:, 1], 0.25)
+    assert np.isclose(np.sum(np.linalg.norm(np.diff(path, axis=0), axis=1)), 8)
+
+    # Separate walls produce separate polylines, and a plane that misses
+    # the mesh produces none.
+    walls = make_wall(0, 3, 1)
+    other = make_wall(0, 3, 4)
+    mesh = make_mesh(np.vstack((walls.vertices, other.vertices)), np.vstack((walls.triangles, other.triangles + len(walls.vertices))))
+    assert len(fp.calculate_intersections(mesh, headset_position=[0, 0.5, 0])) == 2
+    assert fp.calculate_intersections(mesh, headset_position=[0, 5, 0]) == []
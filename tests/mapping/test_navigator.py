@@ -1,7 +1,18 @@
+import asyncio
+import os
+import time
+import uuid
+
+import numpy as np
+
+from concurrent.futures import Future
 from unittest.mock import Mock
 from unittest.mock import create_autospec
+from server.mapping.datagrid import DataGrid
 from server.mapping.navigator import Navigator
+from server.mapping.tiledgrid import TiledDataGrid
 from server.location.models import Location
+from server.resources.geometry import Vector3f
 
 # TODO: Create mock objects (doesn't matter how correct they are)
 
@@ -45,3 +56,168 @@ def test_navigator_find_path_no_headset():
     #navigator = Navigator()
     #path = navigator.find_path(location, (0, 0), (10, 10))
     #assert(path == [(0, 0), (10, 10)])
+
+
+def test_navigator_cost_grid_cache(tmp_path, monkeypatch):
+    location = Mock(id=uuid.uuid4())
+    layer = Mock(id=1)
+
+    layer_dir = tmp_path / "locations" / location.id.hex / "layers" / "00000001"
+    layer_dir.mkdir(parents=True)
+    walls_path = str(layer_dir / "walls.npz")
+
+    walls = DataGrid(width=10, height=10, left=-5, top=-5)
+    walls.add_segment((-6, 0, 0), (0, 0, 0))
+    walls.save(walls_path)
+
+    loads = []
+    original_load = DataGrid.load
+    def counting_load(path):
+        loads.append(path)
+        return original_load(path)
+    monkeypatch.setattr(DataGrid, "load", counting_load)
+
+    navigator = Navigator(data_dir=str(tmp_path))
+    start = Vector3f(-4, 0, -4)
+    end = Vector3f(-4, 0, 4)
+
+    # The path must go around the wall.
+    path = navigator.find_path(location, layer, start, end)
+    assert len(path) > 2
+    assert loads == [walls_path]
+
+    # Later requests reuse the cached grid.
+    assert navigator.find_path(location, layer, start, end) == path
+    assert loads == [walls_path]
+
+    # Observing a user walk through the wall updates the cached grid in
+    # place, and the new path goes through the inferred door.
+    event = dict(
+        current=dict(location_id=str(location.id), position=dict(x=-4, y=0, z=4), type="headset", updated=1),
+        previous=dict(location_id=str(location.id), position=dict(x=-4, y=0, z=-4), type="headset", updated=0)
+    )
+    asyncio.run(navigator.on_headset_updated("headsets:updated", "/headsets/test", **event))
+    path = navigator.find_path(location, layer, start, end)
+    assert len(path) == 2
+    assert loads == [walls_path]
+
+    # The updated grid is the same as one built from scratch.
+    navigator.add_trace(location, [dict(position=dict(x=x, y=0, z=1)) for x in [-8, -2, 3]])
+    updated = navigator.get_cost_grid(location, layer)
+    navigator.cost_grids.clear()
+    rebuilt = navigator.get_cost_grid(location, layer)
+    assert len(loads) == 2
+    assert np.array_equal(updated.grid.data, rebuilt.grid.data)
+    assert np.array_equal(updated.passable, rebuilt.passable)
+    assert np.array_equal(updated.cost, rebuilt.cost)
+
+    # The grid is rebuilt if the updates since it was built are not known.
+    navigator.floor_versions[location.id] += 1
+    navigator.floor_updates[location.id].clear()
+    navigator.find_path(location, layer, start, end)
+    assert len(loads) == 3
+
+    # Replacing the walls file also invalidates the cached grid.
+    walls.save(walls_path)
+    os.utime(walls_path, ns=(0, 0))
+    navigator.find_path(location, layer, start, end)
+    assert len(loads) == 4
+
+
+class ManualPool:
+    """
+    Executor that runs submitted functions when asked, or immediately.
+    """
+    def __init__(self):
+        self.immediate = False
+        self.pending = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.pending.append((future, fn, args))
+        if self.immediate:
+            self.run_pending()
+        return future
+
+    def run_pending(self):
+        while len(self.pending) > 0:
+            future, fn, args = self.pending.pop(0)
+            future.set_result(fn(*args))
+
+
+def test_navigator_save_floor_grid(tmp_path):
+    location = Mock(id=uuid.uuid4())
+    pool = ManualPool()
+    navigator = Navigator(data_dir=str(tmp_path), save_pool=pool)
+
+    def event(x0, x1):
+        return dict(
+            current=dict(location_id=str(location.id), position=dict(x=x1, y=0, z=0), type="headset", updated=1),
+            previous=dict(location_id=str(location.id), position=dict(x=x0, y=0, z=0), type="headset", updated=0)
+        )
+
+    # A burst of updates results in one write in the background.
+    for i in range(5):
+        asyncio.run(navigator.on_headset_updated("headsets:updated", "/headsets/test", **event(i, i+1)))
+    assert len(pool.pending) == 1
+
+    metrics = navigator.dump_save_metrics()
+    assert metrics['coalesced_updates'] == 4
+    assert metrics['backlog'] == 1
+    assert metrics['saves_in_progress'] == 1
+
+    pool.run_pending()
+    metrics = navigator.dump_save_metrics()
+    assert metrics['saves'] == 1
+    assert metrics['backlog'] == 0
+
+    dname = tmp_path / "navigator" / location.id.hex
+    assert sorted(os.listdir(dname)) == ["floor.npz", "floor.png"]
+
+    loaded = TiledDataGrid.load(str(dname / "floor.npz"))
+    assert loaded[(4.5, 0, 0)] == navigator.get_floor_grid(location.id)[(4.5, 0, 0)] > 0
+
+    # Another update waits for the save interval, but a flush writes it now.
+    asyncio.run(navigator.on_headset_updated("headsets:updated", "/headsets/test", **event(5, 8)))
+    assert len(pool.pending) == 0
+    assert navigator.dump_save_metrics()['backlog'] == 1
+
+    pool.immediate = True
+    navigator.flush()
+    metrics = navigator.dump_save_metrics()
+    assert metrics['saves'] == 2
+    assert metrics['backlog'] == 0
+
+    loaded = TiledDataGrid.load(str(dname / "floor.npz"))
+    assert loaded[(7.5, 0, 0)] > 0
+
+
+def test_navigator_save_floor_grid_timer(tmp_path):
+    location = Mock(id=uuid.uuid4())
+    navigator = Navigator(data_dir=str(tmp_path))
+    navigator.save_interval = 0.2
+
+    def event(x0, x1):
+        return dict(
+            current=dict(location_id=str(location.id), position=dict(x=x1, y=0, z=0), type="headset", updated=1),
+            previous=dict(location_id=str(location.id), position=dict(x=x0, y=0, z=0), type="headset", updated=0)
+        )
+
+    asyncio.run(navigator.on_headset_updated("headsets:updated", "/headsets/test", **event(0, 1)))
+    navigator.save_futures[location.id].result()
+
+    # An update inside the save interval is written by a timer, even though
+    # no more updates arrive.
+    asyncio.run(navigator.on_headset_updated("headsets:updated", "/headsets/test", **event(1, 3)))
+    assert navigator.dump_save_metrics()['backlog'] == 1
+
+    deadline = time.time() + 5
+    while navigator.dump_save_metrics()['saves'] < 2 and time.time() < deadline:
+        time.sleep(0.05)
+
+    metrics = navigator.dump_save_metrics()
+    assert metrics['saves'] == 2
+    assert metrics['backlog'] == 0
+
+    loaded = TiledDataGrid.load(str(tmp_path / "navigator" / location.id.hex / "floor.npz"))
+    assert loaded[(2.5, 0, 0)] > 0
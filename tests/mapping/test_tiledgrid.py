@@ -0,0 +1,89 @@
+import tempfile
+
+import numpy as np
+
+from server.mapping.datagrid import DataGrid
+from server.mapping.tiledgrid import TiledDataGrid
+
+
+def test_get_and_set():
+    grid = TiledDataGrid(tile_size=8)
+
+    # Unallocated cells read as zero without allocating tiles.
+    assert grid[(0, 0, 0)] == 0
+    assert len(grid.tiles) == 0
+
+    grid[(0, 0, 0)] = 42
+    grid[(-100, 0, 250)] = 24
+    assert grid[(0, 0, 0)] == 42
+    assert grid[grid.xyz_to_index((-100, 0, 250))] == 24
+    assert len(grid.tiles) == 2
+
+    assert (0, 0, 0) in grid
+    assert (100, 0, 100) not in grid
+
+
+def test_add_segment():
+    tiled = TiledDataGrid(tile_size=8)
+    dense = DataGrid(width=10, height=10, left=-5, top=-5)
+
+    # The tiled grid matches a dense grid for segments inside its bounds.
+    for a, b in [((-4, 0, -4), (-4, 0, 4)), ((-3, 0, 2), (4, 0, -1))]:
+        tiled.add_segment(a, b, vspread=1)
+        dense.add_segment(a, b, vspread=1)
+
+    view = tiled.resize_to_other(dense)
+    assert view.H == dense.H and view.W == dense.W
+    assert np.allclose(view.data, dense.data)
+
+    # Segments far outside the original area are kept, and the range of
+    # cells that were written is returned.
+    bounds = tiled.add_segment((100, 0, 100), (102, 0, 100))
+    assert tiled[(101, 0, 100)] == 1
+    assert bounds == (400, 400, 1, 9)
+    assert len(tiled.tiles) < 20
+
+    full = tiled.to_dense()
+    assert full[(101, 0, 100)] == 1
+    assert full[(-4, 0, 0)] == tiled[(-4, 0, 0)] > 0
+
+
+def test_save_and_load():
+    grid = TiledDataGrid(tile_size=8)
+    grid.add_segment((-4, 0, -4), (30, 0, 4), vspread=1)
+
+    fp = tempfile.TemporaryFile()
+    grid.save(fp)
+
+    fp.seek(0)
+    other = TiledDataGrid.load(fp)
+    assert other.tile_size == grid.tile_size
+    assert other.tiles.keys() == grid.tiles.keys()
+    for key, tile in grid.tiles.items():
+        assert np.array_equal(other.tiles[key], tile)
+
+    # Dense grid files are converted when they are loaded.
+    dense = DataGrid(width=10, height=10, left=-5, top=-5)
+    dense.add_segment((-4, 0, -4), (-4, 0, 4), vspread=1)
+
+    fp = tempfile.TemporaryFile()
+    dense.save(fp)
+
+    fp.seek(0)
+    other = TiledDataGrid.load(fp)
+    assert np.allclose(other.resize_to_other(dense).data, dense.data)
+
+
+def test_snapshot():
+    grid = TiledDataGrid(tile_size=8)
+    grid[(0, 0, 0)] = 1
+
+    snapshot = grid.snapshot()
+    grid[(0, 0, 0)] = 2
+    grid[(10, 0, 10)] = 3
+    assert snapshot[(0, 0, 0)] == 1
+    assert snapshot[(10, 0, 10)] == 0
+
+    # Writing to the snapshot does not change the grid either.
+    snapshot[(0, 0, 0)] = 4
+    assert grid[(0, 0, 0)] == 2
@@ -0,0 +1,78 @@
+import pickle
+
+import numpy as np
+import trimesh
+
+from server.mapping2.arena import MeshArena
+
+
+def make_box(offset):
+    mesh = trimesh.creation.box(extents=[1, 1, 1])
+    mesh.apply_translation([offset, 0, 0])
+    return mesh
+
+
+def test_append():
+    meshes = [make_box(i) for i in range(3)]
+    arena = MeshArena()
+    for i, mesh in enumerate(meshes):
+        arena.append(str(i), mesh.vertices, mesh.faces)
+
+    expected = trimesh.util.concatenate(meshes)
+    assert np.array_equal(arena.mesh.vertices, expected.vertices)
+    assert np.array_equal(arena.mesh.faces, expected.faces)
+
+    assert arena.keys() == ["0", "1", "2"]
+    assert np.array_equal(arena.face_object_indices(), np.repeat([0, 1, 2], 12))
+    assert np.array_equal(arena.face_local_indices(), np.tile(np.arange(12), 3))
+    assert list(arena.vertex_ranges()) == [("0", 0, 8), ("1", 8, 16), ("2", 16, 24)]
+
+
+def test_replace_and_compact():
+    arena = MeshArena()
+    arena.compaction_threshold = 0.5
+    for i in range(4):
+        mesh = make_box(i)
+        arena.append(str(i), mesh.vertices, mesh.faces)
+
+    # Replacing one of four surfaces leaves a tombstone without compacting.
+    mesh = make_box(10)
+    arena.replace("1", mesh.vertices, mesh.faces)
+    assert arena.dead_faces == 12
+    assert arena.keys() == ["0", "2", "3", "1"]
+    assert len(arena.mesh.faces) == 48
+    assert np.allclose(arena.mesh.bounds, [[-0.5, -0.5, -0.5], [10.5, 0.5, 0.5]])
+
+    # The combined mesh and index arrays skip the removed faces.
+    assert np.array_equal(arena.face_object_indices(), np.repeat([0, 1, 2, 3], 12))
+    start, end = arena.vertex_range("1")
+    assert np.array_equal(arena.vertices[start:end], mesh.vertices)
+
+    # Removing enough surfaces triggers compaction.
+    arena.remove("0")
+    arena.remove("2")
+    assert arena.dead_faces == 0
+    assert arena.keys() == ["3", "1"]
+    assert arena.vertex_count == 16
+    assert list(arena.vertex_ranges()) == [("3", 0, 8), ("1", 8, 16)]
+
+    expected = trimesh.util.concatenate([make_box(3), make_box(10)])
+    assert np.array_equal(arena.mesh.vertices, expected.vertices)
+    assert np.array_equal(arena.mesh.faces, expected.faces)
+
+
+def test_pickle():
+    arena = MeshArena()
+    for i in range(3):
+        mesh = make_box(i)
+        arena.append(str(i), mesh.vertices, mesh.faces)
+    arena.remove("1")
+
+    other = pickle.loads(pickle.dumps(arena))
+    assert other.keys() == arena.keys()
+    assert np.array_equal(other.mesh.vertices, arena.mesh.vertices)
+    assert np.array_equal(other.mesh.faces, arena.mesh.faces)
+
+    mesh = make_box(5)
+    other.append("5", mesh.vertices, mesh.faces)
+    assert other.keys() == ["0", "2", "5"]
@@ -0,0 +1,77 @@
+import pickle
+
+import networkx as nx
+import numpy as np
+import trimesh
+
+from server.mapping2.chunk import Chunk, walkable_threshold
+
+
+def make_chunk():
+    # The top of the box is walkable, and the sides and bottom are not.
+    mesh = trimesh.creation.box(extents=[4, 1, 4]).subdivide().subdivide()
+
+    chunk = Chunk("test")
+    chunk.set_mesh(mesh)
+    return chunk
+
+
+def reference_graph(mesh):
+    graph = nx.Graph()
+    for a, b in mesh.face_adjacency:
+        if mesh.face_normals[a, 1] >= walkable_threshold and mesh.face_normals[b, 1] >= walkable_threshold:
+            graph.add_edge(a, b, weight=np.linalg.norm(mesh.triangles_center[a] - mesh.triangles_center[b]))
+    return graph
+
+
+def test_split_mesh():
+    chunk = make_chunk()
+    mesh = chunk.mesh
+
+    top = np.flatnonzero(mesh.face_normals[:, 1] >= walkable_threshold)
+    top_component = chunk.component_id[top[0]]
+    assert np.all(chunk.component_id[top] == top_component)
+    assert np.array_equal(chunk.components[top_component], top)
+
+    # Every other face is on its own.
+    assert len(chunk.components) == 1 + len(mesh.faces) - len(top)
+    for i, faces in enumerate(chunk.components):
+        assert np.all(chunk.component_id[faces] == i)
+
+
+def test_graph_matches_networkx():
+    chunk = make_chunk()
+    graph = reference_graph(chunk.mesh)
+
+    assert len(chunk.edges) == graph.number_of_edges()
+    for (a, b), weight in zip(chunk.edges, chunk.edge_weights):
+        assert np.isclose(graph.edges[a, b]['weight'], weight)
+        assert chunk.find_edge(a, b) == chunk.find_edge(b, a)
+        assert chunk.find_edge(a, b) >= 0
+
+    top = np.flatnonzero(chunk.mesh.face_normals[:, 1] >= walkable_threshold)
+    face1, face2 = top[0], top[-1]
+
+    path, edges = chunk.find_face_path(face1, face2)
+    expected = nx.astar_path_length(graph, face1, face2, weight='weight')
+    assert path[0] == face1 and path[-1] == face2
+    assert np.isclose(np.sum(chunk.edge_weights[edges]), expected)
+
+    # Faces which are not walkable are not connected to anything.
+    side = np.flatnonzero(chunk.mesh.face_normals[:, 1] < walkable_threshold)[0]
+    assert chunk.find_face_path(face1, side) == (None, None)
+
+
+def test_observed_transition():
+    chunk = make_chunk()
+
+    top = np.flatnonzero(chunk.mesh.face_normals[:, 1] >= walkable_threshold)
+    path, edges = chunk.find_face_path(top[0], top[-1])
+
+    chunk.observed_transition(top[0], top[-1])
+    assert np.sum(chunk.edge_hits) == len(edges)
+    assert np.all(chunk.edge_hits[edges] == 1)
+
+    # The hit counts should survive pickling.
+    other = pickle.loads(pickle.dumps(chunk))
+    assert np.array_equal(other.edge_hits, chunk.edge_hits)
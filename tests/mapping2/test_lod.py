@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import trimesh
+
+from server.mapping2.lod import LodCache, cluster_vertices, simplify_surface
+
+
+def make_surface():
+    mesh = trimesh.creation.icosphere(subdivisions=4, radius=1.0)
+    mesh.visual.vertex_colors = np.where(mesh.vertices[:, 0:1] > 0, [200, 20, 20, 255], [20, 20, 200, 255])
+    mesh.metadata['name'] = "surface"
+    mesh.metadata['mtime'] = 1.0
+    return mesh
+
+
+def test_cluster_vertices():
+    mesh = make_surface()
+
+    vertices, faces, colors = cluster_vertices(mesh.vertices, mesh.faces, 0.2, mesh.visual.vertex_colors)
+    assert 0 < len(faces) < len(mesh.faces)
+    assert len(colors) == len(vertices)
+
+    # No degenerate or unused vertices remain.
+    assert np.all(faces[:, 0] != faces[:, 1])
+    assert np.all(faces[:, 1] != faces[:, 2])
+    assert np.all(faces[:, 0] != faces[:, 2])
+    assert np.array_equal(np.unique(faces), np.arange(len(vertices)))
+
+    # Colors are averaged from the original vertices in each cluster.
+    assert np.all(colors[vertices[:, 0] > 0.2, 0] > colors[vertices[:, 0] > 0.2, 2])
+    assert np.all(colors[vertices[:, 0] < -0.2, 0] < colors[vertices[:, 0] < -0.2, 2])
+
+    # A cell size smaller than the edges keeps the mesh as it was.
+    vertices, faces, colors = cluster_vertices(mesh.vertices, mesh.faces, 1e-4)
+    assert colors is None
+    assert len(faces) == len(mesh.faces)
+    assert np.allclose(vertices[faces], mesh.vertices[mesh.faces])
+
+
+def test_lod_cache(tmp_path):
+    mesh = make_surface()
+    cache = LodCache(str(tmp_path), include_color=True)
+
+    simplified = cache.get("surface", mesh, 2)
+    expected = simplify_surface(mesh, 2, include_color=True)
+    assert np.allclose(simplified.vertices, expected.vertices)
+    assert np.array_equal(simplified.faces, expected.faces)
+
+    # The second request is read from the cache.
+    entries = os.listdir(tmp_path)
+    assert len(entries) == 1
+    loaded = cache.get("surface", mesh, 2)
+    assert np.array_equal(loaded.faces, simplified.faces)
+    assert np.array_equal(loaded.visual.vertex_colors, simplified.visual.vertex_colors)
+
+    # Recoloring the surface makes a new version, and the old one is pruned.
+    mesh.visual.vertex_colors = [0, 255, 0, 255]
+    mesh.metadata.pop('color_version', None)
+    cache.get("surface", mesh, 2)
+    cache.prune(2, [("surface", mesh)])
+    assert len(os.listdir(tmp_path)) == 1
+    assert os.listdir(tmp_path) != entries
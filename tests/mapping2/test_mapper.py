@@ -0,0 +1,67 @@
+import os
+
+from server.mapping2.mapper import ModelingTask, export_model, model_file_paths, model_lod_levels
+from server.mapping2.scene import LocationModel
+
+from .test_scene import make_surfaces
+
+
+def test_modeling_task_without_changes(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    location_dir = tmp_path / "location"
+    location_dir.mkdir()
+
+    def run_task(model_version):
+        task = ModelingTask(str(surfaces_dir), cache_dir=str(tmp_path / "cache"), location_dir=str(location_dir),
+                color_sources=[], model_version=model_version)
+        return task.run()
+
+    result = run_task(4)
+    assert result.model_version == 5
+
+    paths = model_file_paths(str(location_dir), "colored")
+    mtimes = {path: os.path.getmtime(path) for path in paths}
+
+    # Without surface changes, the model files are not written again and the
+    # model version stays the same.
+    result = run_task(result.model_version)
+    assert len(result.updated_surfaces) == 0
+    assert result.model_version == 5
+    assert {path: os.path.getmtime(path) for path in paths} == mtimes
+
+
+def test_export_model_levels(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    location_dir = tmp_path / "location"
+    location_dir.mkdir()
+    cache_dir = str(tmp_path / "cache")
+
+    # Files for a level that is no longer exported are removed.
+    stale_path = location_dir / "model-lod{}.obj".format(max(model_lod_levels) + 1)
+    stale_path.write_text("o stale\n")
+
+    model = LocationModel.from_directory(str(surfaces_dir))
+    assert export_model(model, str(location_dir), "model", cache_dir=cache_dir)
+    assert not stale_path.exists()
+
+    paths = model_file_paths(str(location_dir), "model")
+    assert all(os.path.exists(path) for path in paths)
+    mtimes = {path: os.path.getmtime(path) for path in paths}
+
+    # Only the level with a missing file is written again.
+    missing_paths = model_file_paths(str(location_dir), "model", model_lod_levels[0])
+    os.remove(missing_paths[1])
+    assert export_model(model, str(location_dir), "model", cache_dir=cache_dir)
+    for path in paths:
+        assert os.path.exists(path)
+        if path not in missing_paths:
+            assert os.path.getmtime(path) == mtimes[path]
+
+    # Nothing is written again for the same surfaces.
+    assert not export_model(model, str(location_dir), "model", cache_dir=cache_dir)
@@ -0,0 +1,94 @@
+import os
+
+import networkx as nx
+import numpy as np
+import trimesh
+
+from server.mapping2.navmesh import NavigationMesh, NavigationMeshCache
+
+
+def make_navmesh():
+    """
+    Create a navigation mesh with two floor tiles side by side.
+    """
+    mesh = trimesh.creation.box(extents=[4, 0.1, 2])
+    centers = mesh.triangles_center
+    component_ids = (centers[:, 0] > 0).astype(int)
+
+    graph = nx.Graph()
+    graph.add_node(0, center=np.array([-1, 0, 0]))
+    graph.add_node(1, center=np.array([1, 0, 0]))
+    graph.add_edge(0, 1)
+
+    return NavigationMesh(mesh=mesh, graph=graph, component_ids=component_ids)
+
+
+def test_navigation_mesh_cache(tmp_path):
+    path = str(tmp_path / "navmesh.pickle")
+    cache = NavigationMeshCache()
+
+    assert cache.get(path) is None
+
+    make_navmesh().save(path)
+    navmesh = cache.get(path)
+    assert navmesh is not None
+    assert cache.get(path) is navmesh
+    assert cache.total_bytes == navmesh.estimate_size()
+
+    points = navmesh.find_path([-1.5, 1, 0], [1.5, 1, 0]).reshape(-1, 3)
+    assert np.allclose(points[[0, -1], 0], [-1.5, 1.5])
+
+    # Updating the file should invalidate the cached entry.
+    make_navmesh().save(path)
+    os.utime(path, (0, 1))
+    reloaded = cache.get(path)
+    assert reloaded is not navmesh
+    assert len(cache) == 1
+
+    # Deleting the file should remove the entry.
+    os.remove(path)
+    assert cache.get(path) is None
+    assert len(cache) == 0
+    assert cache.total_bytes == 0
+
+
+def test_navigation_mesh_cache_eviction(tmp_path):
+    paths = [str(tmp_path / "navmesh{}.pickle".format(i)) for i in range(3)]
+    for path in paths:
+        make_navmesh().save(path)
+
+    size = make_navmesh().estimate_size()
+    cache = NavigationMeshCache(max_bytes=2*size)
+
+    first = cache.get(paths[0])
+    cache.get(paths[1])
+
+    # Touching the first entry makes the second the least recently used.
+    assert cache.get(paths[0]) is first
+    cache.get(paths[2])
+
+    assert list(cache.entries.keys()) == [paths[0], paths[2]]
+    assert cache.total_bytes <= cache.max_bytes
+
+
+def test_find_paths_to():
+    navmesh = make_navmesh()
+
+    # Add a third tile that is not connected to the others.
+    navmesh.graph.add_node(2, center=np.array([10, 0, 0]))
+
+    starts = [[-1.5, 1, 0], [1.5, 1, 0], [10, 1, 10]]
+    paths = navmesh.find_paths_to(starts, [1.0, 1, 0.5])
+
+    assert len(paths) == 3
+    assert np.allclose(paths[0], [[-1.5, 0.05, 0], [1.0, 0.05, 0.5]])
+    assert np.allclose(paths[1], [[1.5, 0.05, 0], [1.0, 0.05, 0.5]])
+    assert paths[2] is None
+
+    # The same destination component should reuse the cached tree.
+    tree = navmesh.get_route_tree(1)
+    navmesh.find_paths_to(starts[:1], [1.2, 1, 0])
+    assert navmesh.get_route_tree(1) is tree
+
+    single = navmesh.find_path(starts[0], [1.0, 1, 0.5])
+    assert np.allclose(single, paths[0])
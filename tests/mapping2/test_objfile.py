@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import trimesh
+
+from trimesh import util
+
+from server.mapping2.objfile import ObjFragmentCache, surface_version
+
+
+def make_meshes(count=3):
+    meshes = []
+    for i in range(count):
+        mesh = trimesh.creation.box(extents=[1, 1, 1])
+        mesh.apply_translation([2 * i, 0, 0])
+        mesh.visual.vertex_colors = [20 * i, 100, 200, 255]
+        mesh.metadata['mtime'] = float(i)
+        meshes.append(("surface{}".format(i), mesh))
+    return meshes
+
+
+def load_obj(path):
+    loaded = trimesh.load(path, group_material=False, process=False)
+    return {mesh.metadata['name']: mesh for mesh in loaded.dump()}
+
+
+def test_surface_version():
+    _, mesh = make_meshes(1)[0]
+    version = surface_version(mesh, include_color=True)
+    assert surface_version(mesh) != version
+
+    # The color checksum is kept until it is removed from the metadata by
+    # whatever recolors the surface.
+    mesh.visual.vertex_colors = [0, 0, 0, 255]
+    assert surface_version(mesh, include_color=True) == version
+    mesh.metadata.pop('color_version')
+    assert surface_version(mesh, include_color=True) != version
+
+
+def test_assemble(tmp_path):
+    meshes = make_meshes()
+    cache = ObjFragmentCache(str(tmp_path / "fragments"), include_color=True)
+
+    output_path = str(tmp_path / "model.obj")
+    cache.assemble(meshes, output_path)
+    assert sorted(os.listdir(tmp_path)) == ["fragments", "model.obj"]
+
+    loaded = load_obj(output_path)
+    assert sorted(loaded.keys()) == [key for key, _ in meshes]
+    for key, mesh in meshes:
+        assert np.allclose(loaded[key].vertices, mesh.vertices)
+        assert np.array_equal(loaded[key].faces, mesh.faces)
+        assert np.all(np.abs(loaded[key].visual.vertex_colors.astype(int) - mesh.visual.vertex_colors) <= 1)
+
+    # Assembling again reuses all of the fragments.
+    fragments = {fname: os.path.getmtime(tmp_path / "fragments" / fname) for fname in os.listdir(tmp_path / "fragments")}
+    assert len(fragments) == 2 * len(meshes)
+
+    cache.assemble(meshes, output_path)
+    assert {fname: os.path.getmtime(tmp_path / "fragments" / fname) for fname in os.listdir(tmp_path / "fragments")} == fragments
+
+
+def test_assemble_changed_surface(tmp_path):
+    meshes = make_meshes()
+    cache = ObjFragmentCache(str(tmp_path / "fragments"), include_color=True)
+
+    output_path = str(tmp_path / "model.obj")
+    cache.assemble(meshes, output_path)
+    before = set(os.listdir(tmp_path / "fragments"))
+
+    # Recoloring the last surface only replaces its fragments, and the
+    # fragments of the surfaces before it are reused.
+    key, mesh = meshes[-1]
+    mesh.visual.vertex_colors = [0, 0, 0, 255]
+    mesh.metadata.pop('color_version', None)
+    cache.assemble(meshes, output_path)
+
+    after = set(os.listdir(tmp_path / "fragments"))
+    assert len(after) == len(before)
+    assert len(before - after) == 2
+    assert all(fname.startswith(key) for fname in before - after)
+
+    loaded = load_obj(output_path)
+    assert np.all(loaded[key].visual.vertex_colors[:, 0:3] == 0)
+
+    # Removing the first surface shifts the vertex offsets of the others.
+    cache.assemble(meshes[1:], output_path)
+    loaded = load_obj(output_path)
+    assert sorted(loaded.keys()) == [key for key, _ in meshes[1:]]
+    for key, mesh in meshes[1:]:
+        assert np.allclose(loaded[key].vertices, mesh.vertices)
+        assert np.array_equal(loaded[key].faces, mesh.faces)
+
+
+def test_assemble_replaced_first_surface(tmp_path):
+    meshes = make_meshes()
+    cache = ObjFragmentCache(str(tmp_path / "fragments"), include_color=True)
+
+    output_path = str(tmp_path / "model.obj")
+    cache.assemble(meshes, output_path)
+    fragments = {fname: os.path.getmtime(tmp_path / "fragments" / fname) for fname in os.listdir(tmp_path / "fragments")}
+
+    # Replace the first surface with one that has more vertices, which
+    # shifts the vertex offsets of all of the surfaces after it.
+    key = meshes[0][0]
+    replacement = trimesh.creation.icosphere(subdivisions=1)
+    replacement.visual.vertex_colors = [255, 0, 0, 255]
+    replacement.metadata['mtime'] = 10.0
+    meshes[0] = (key, replacement)
+    cache.assemble(meshes, output_path)
+
+    # The vertex fragments of the later surfaces are reused as they were,
+    # and only their face fragments are written for the new offsets.
+    after = {fname: os.path.getmtime(tmp_path / "fragments" / fname) for fname in os.listdir(tmp_path / "fragments")}
+    for fname, mtime in fragments.items():
+        if fname.endswith(".v") and not fname.startswith(key):
+            assert after[fname] == mtime
+    assert len([fname for fname in after if fname.startswith(key)]) == 2
+    assert len(after) == len(fragments)
+
+    loaded = load_obj(output_path)
+    for key, mesh in meshes:
+        assert np.allclose(loaded[key].vertices, mesh.vertices, atol=1e-3)
+        assert np.array_equal(loaded[key].faces, mesh.faces)
+
+
+def test_assemble_unchanged_prefix(tmp_path, monkeypatch):
+    meshes = make_meshes()
+    cache = ObjFragmentCache(str(tmp_path / "fragments"), include_color=True)
+
+    output_path = str(tmp_path / "model.obj")
+    cache.assemble(meshes, output_path)
+
+    formatted = []
+    array_to_string = util.array_to_string
+    def counting_array_to_string(array, *args, **kwargs):
+        formatted.append(len(array))
+        return array_to_string(array, *args, **kwargs)
+    monkeypatch.setattr(util, "array_to_string", counting_array_to_string)
+
+    # Replacing the last surface only formats the vertices and faces of that
+    # surface, and the surfaces before it are copied from their fragments.
+    key = meshes[-1][0]
+    replacement = trimesh.creation.icosphere(subdivisions=1)
+    replacement.metadata['mtime'] = 10.0
+    meshes[-1] = (key, replacement)
+    cache.assemble(meshes, output_path)
+    assert formatted == [len(replacement.vertices), len(replacement.faces)]
+
+    loaded = load_obj(output_path)
+    for key, mesh in meshes:
+        assert np.allclose(loaded[key].vertices, mesh.vertices, atol=1e-3)
+        assert np.array_equal(loaded[key].faces, mesh.faces)
@@ -0,0 +1,543 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pytest
+import trimesh
+
+from PIL import Image
+
+from server.mapping2 import projection, scene
+from server.mapping2.objfile import surface_version
+from server.mapping2.scene import LocationModel, MeshColorSource, compute_ray_directions, normalized_uuid
+from server.mapping2.soup import LayerConfig
+
+
+def reference_ray_directions(width, height, fx, fy):
+    cx = 0.5 * width
+    cy = 0.5 * height
+
+    directions = np.ones((width * height, 3))
+    i = 0
+    for y in range(height):
+        for x in range(width):
+            directions[i, 0] = (x - cx) / fx
+            directions[i, 1] = (cy - y) / fy
+            i += 1
+
+    return directions
+
+
+def test_compute_ray_directions():
+    directions = compute_ray_directions(8, 6, (0.5, 0.75))
+    expected = reference_ray_directions(8, 6, 0.5 * 8, 0.75 * 6)
+    assert np.array_equal(directions, expected)
+
+    directions = compute_ray_directions(8, 6, (700, 700), focal_relative=False)
+    expected = reference_ray_directions(8, 6, 700, 700)
+    assert np.array_equal(directions, expected)
+
+    directions = compute_ray_directions(8, 6, (0.5, 0.75), dtype=np.float32)
+    assert directions.dtype == np.float32
+    assert np.allclose(directions, compute_ray_directions(8, 6, (0.5, 0.75)))
+
+
+def test_generate_rays():
+    pixels = np.random.randint(0, 256, size=(6, 8, 3), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "photo.png")
+        Image.fromarray(pixels).save(path)
+
+        position = np.array([1.0, 2.0, 3.0])
+        rotation = np.array([[0, 0, 1], [0, 1, 0], [-1, 0, 0]], dtype=float)
+        source = MeshColorSource(1, path, (0.5, 0.75), position, rotation)
+
+        origins, directions, colors = source.generate_rays()
+        assert origins.shape == (48, 3)
+        assert np.array_equal(origins, np.tile(position, (48, 1)))
+        assert np.array_equal(directions, np.matmul(reference_ray_directions(8, 6, 4, 4.5), rotation.T))
+        assert np.array_equal(colors, pixels.reshape(-1, 3))
+
+        origins, directions, colors = source.generate_rays(right_handed=True, dtype=np.float32)
+        assert origins.dtype == np.float32
+        assert directions.dtype == np.float32
+        assert np.array_equal(origins[0], [-1, 2, 3])
+
+
+def make_surfaces(dir_path, count=3):
+    """
+    Write a row of box-shaped surfaces, spaced along the x-axis, as PLY files.
+    """
+    surface_ids = []
+    for i in range(count):
+        mesh = trimesh.creation.box(extents=[2, 2, 2]).subdivide()
+        mesh.apply_translation([3 * i, 0, 5])
+
+        surface_id = "{:032x}".format(i + 1)
+        mesh.export(os.path.join(dir_path, surface_id + ".ply"))
+        surface_ids.append(surface_id)
+
+    return surface_ids
+
+
+def test_apply_color_source():
+    pixels = np.zeros((60, 80, 3), dtype=np.uint8)
+    pixels[:, :] = [10, 200, 30]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        surfaces_dir = os.path.join(tmpdir, "surfaces")
+        os.makedirs(surfaces_dir)
+        make_surfaces(surfaces_dir)
+
+        model = LocationModel.from_directory(surfaces_dir)
+        assert len(model.surface_ids) == 3
+        versions = {key: surface_version(surface, include_color=True) for key, surface in model.scene.geometry.items()}
+
+        path = os.path.join(tmpdir, "photo.png")
+        Image.fromarray(pixels).save(path)
+
+        # Camera positioned in front of the boxes and looking down the z-axis
+        # with a wide enough field of view to see all of them.
+        source = MeshColorSource(1, path, (0.5, 0.5), np.array([3.0, 0, -4]), np.eye(3))
+        affected = model.apply_color_source(source)
+        assert len(affected) == 3
+
+        for surface_id in affected:
+            surface = model.scene.geometry[str(surface_id)]
+            assert source in surface.metadata['color_sources']
+            assert surface_version(surface, include_color=True) != versions[str(surface_id)]
+
+            colors = surface.visual.vertex_colors[:, 0:3].astype(int)
+            changed = np.any(colors != surface.visual.defaults['material_diffuse'][0:3], axis=1)
+            assert np.any(changed)
+            assert np.all(np.abs(colors[changed] - [10, 200, 30]) <= 1)
+
+        # Applying the same source again should have no effect.
+        assert len(model.apply_color_source(source)) == 0
+
+
+def test_save_and_load_store():
+    pixels = np.zeros((60, 80, 3), dtype=np.uint8)
+    pixels[:, :] = [10, 200, 30]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        surfaces_dir = os.path.join(tmpdir, "surfaces")
+        os.makedirs(surfaces_dir)
+        make_surfaces(surfaces_dir)
+
+        model = LocationModel.from_directory(surfaces_dir)
+
+        path = os.path.join(tmpdir, "photo.png")
+        Image.fromarray(pixels).save(path)
+
+        source = MeshColorSource(1, path, (0.5, 0.5), np.array([3.0, 0, -4]), np.eye(3))
+        model.apply_color_source(source)
+
+        store_dir = os.path.join(tmpdir, "model_store")
+        model.save_store(store_dir)
+
+        # Saving again should replace the store in place.
+        model.save_store(store_dir)
+        assert sorted(os.listdir(tmpdir)) == ["model_store", "photo.png", "surfaces"]
+
+        other = LocationModel.from_store(store_dir)
+        assert other.surface_ids == model.surface_ids
+        assert other.mtime == model.mtime
+        assert other.color_sources == model.color_sources
+        assert np.array_equal(other.combined_mesh.vertices, model.combined_mesh.vertices)
+        assert np.array_equal(other.combined_mesh.faces, model.combined_mesh.faces)
+
+        for key in model.arena.keys():
+            surface = model.scene.geometry[key]
+            loaded = other.scene.geometry[key]
+            assert loaded.metadata['mtime'] == surface.metadata['mtime']
+            assert loaded.metadata['color_sources'] == surface.metadata['color_sources']
+            assert np.array_equal(loaded.faces, surface.faces)
+            assert np.array_equal(loaded.visual.vertex_colors, surface.visual.vertex_colors)
+
+        # The loaded model should still support overlap queries and updates.
+        key = model.arena.keys()[0]
+        iou, overlapping = other.compute_max_iou(model.scene.geometry[key])
+        assert overlapping == key
+        assert np.isclose(iou, 1.0)
+
+        assert len(other.apply_color_source(source)) == 0
+
+
+def test_store_version(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+    store_dir = tmp_path / "model_store"
+    model.save_store(store_dir)
+
+    manifest_path = store_dir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest['version'] == scene.MODEL_STORE_VERSION
+
+    # Stores from older versions still load, but newer ones are refused.
+    manifest['version'] = scene.MIN_MODEL_STORE_VERSION
+    manifest_path.write_text(json.dumps(manifest))
+    assert LocationModel.from_store(store_dir).surface_ids == model.surface_ids
+
+    manifest['version'] = scene.MODEL_STORE_VERSION + 1
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(Exception, match="Unsupported model store version"):
+        LocationModel.from_store(store_dir)
+
+
+def test_parallel_from_directory(tmp_path):
+    make_surfaces(tmp_path, count=4)
+
+    serial = LocationModel.from_directory(tmp_path)
+    parallel = LocationModel.from_directory(tmp_path, workers=2)
+
+    assert parallel.surface_ids == serial.surface_ids
+    assert np.allclose(parallel.combined_mesh.vertices, serial.combined_mesh.vertices)
+    assert np.array_equal(parallel.combined_mesh.faces, serial.combined_mesh.faces)
+
+
+def test_infer_walls_cache(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+    layers = [LayerConfig(height=0.5, svg_output=str(tmp_path / "walls.svg"))]
+
+    paths = model.infer_walls(layers)
+    assert os.path.exists(tmp_path / "walls.svg")
+
+    # The cached cross-sections should match slicing the combined mesh.
+    mesh = model.combined_mesh
+    expected, faces = trimesh.intersections.mesh_plane(mesh, [0, 1, 0], [0, 0.5, 0], return_faces=True)
+    assert np.allclose(model.get_wall_segments(0.5), expected[np.argsort(faces, kind='stable')])
+    assert len(paths[0].entities) > 0
+
+    # Replacing one surface should only slice that surface again.
+    keys = model.arena.keys()
+    cached = {key: model.wall_slices[(key, 0.5)] for key in keys}
+
+    replacement = model.scene.geometry[keys[0]].copy()
+    replacement.apply_translation([0, 0, 1])
+    replacement.metadata['mtime'] += 1
+    model.replace_surface(normalized_uuid(keys[0]), replacement)
+
+    model.infer_walls(layers)
+    assert model.wall_slices[(keys[0], 0.5)] is not cached[keys[0]]
+    for key in keys[1:]:
+        assert model.wall_slices[(key, 0.5)] is cached[key]
+
+    # Cross-sections for heights that are no longer used are dropped.
+    model.infer_walls([LayerConfig(height=1.0)])
+    assert set(height for _, height in model.wall_slices.keys()) == {1.0}
+
+    # The cache survives saving and loading the model store.
+    store_dir = tmp_path / "model_store"
+    model.save_store(store_dir)
+    other = LocationModel.from_store(store_dir)
+    assert other.wall_slices.keys() == model.wall_slices.keys()
+    assert np.array_equal(other.get_wall_segments(1.0), model.get_wall_segments(1.0))
+
+
+def test_infer_walls_slices(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+
+    svg_output = tmp_path / "slices.svg"
+    layers = [LayerConfig(height=0, svg_output=str(svg_output), slices=[-0.5, 0, 0.5])]
+    paths = model.infer_walls(layers)
+
+    assert len(paths) == 1
+    assert set(height for _, height in model.wall_slices.keys()) == {-0.5, 0.0, 0.5}
+
+    svg = svg_output.read_text()
+    for i in range(3):
+        assert 'id="walls-{}"'.format(i) in svg
+
+
+def test_infer_walls_scene_layer_config(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+
+    # Scripts import LayerConfig from the scene module, and it should accept
+    # the same options as the one used by the mapper.
+    paths = model.infer_walls([scene.LayerConfig(height=0)])
+    assert len(paths) == 1
+    assert scene.LayerConfig is LayerConfig
+
+
+def test_frustum_culling(tmp_path, monkeypatch):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    pixels = np.zeros((60, 80, 3), dtype=np.uint8)
+    pixels[:, :] = [10, 200, 30]
+
+    # Color sources are identified by image path, so each needs its own file.
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / "photo{}.png".format(i)))
+        Image.fromarray(pixels).save(paths[-1])
+
+    model = LocationModel.from_directory(surfaces_dir)
+    keys = model.arena.keys()
+
+    # A narrow camera looking straight at the first box only sees that box.
+    # It is slightly off-center, so that no rays hit exactly on mesh edges,
+    # where the chosen face could depend on floating point details.
+    narrow = MeshColorSource(1, paths[0], (2.0, 2.0), np.array([0.013, 0.021, 2]), np.eye(3))
+    visible = model.find_visible_surfaces(narrow)
+    assert len(visible) == 1
+
+    # A wide camera sees all of them, and one facing away sees none.
+    wide = MeshColorSource(2, paths[1], (0.5, 0.5), np.array([3.0, 0, -4]), np.eye(3))
+    assert sorted(model.find_visible_surfaces(wide)) == sorted(keys)
+
+    away = MeshColorSource(3, paths[2], (0.5, 0.5), np.array([3.0, 0, -4]), np.diag([-1.0, 1, -1]))
+    assert model.find_visible_surfaces(away) == []
+    assert len(model.apply_color_source(away)) == 0
+
+    # Culling should not change the resulting colors.
+    affected = model.apply_color_source(narrow)
+    assert [str(x) for x in affected] == visible
+
+    reference = LocationModel.from_directory(surfaces_dir)
+    monkeypatch.setattr(projection, "cull_surfaces", lambda source, keys, bounds, right_handed=True: list(keys))
+    reference.apply_color_source(narrow)
+
+    for key in keys:
+        assert np.array_equal(model.scene.geometry[key].visual.vertex_colors, reference.scene.geometry[key].visual.vertex_colors)
+
+
+def make_color_sources(dir_path):
+    """
+    Write a few solid color photos and return color sources looking at the
+    row of surfaces from different positions.
+    """
+    sources = []
+    cameras = [
+        ([3.013, 0.021, -4], np.eye(3)),
+        ([0.513, 0.021, -2], np.eye(3)),
+        ([6.013, 0.521, -3], np.eye(3)),
+        ([3.013, 0.021, 12], np.diag([-1.0, 1, -1])),
+    ]
+    for i, (position, rotation) in enumerate(cameras):
+        pixels = np.zeros((60, 80, 3), dtype=np.uint8)
+        pixels[:, :] = [40 * i, 200 - 40 * i, 30]
+
+        path = os.path.join(dir_path, "photo{}.png".format(i))
+        Image.fromarray(pixels).save(path)
+        sources.append(MeshColorSource(i + 1, path, (0.5, 0.5), np.array(position), rotation))
+
+    return sources
+
+
+def test_apply_color_sources(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+    sources = make_color_sources(tmp_path)
+
+    serial = LocationModel.from_directory(surfaces_dir)
+    serial_affected = set()
+    for source in sources:
+        serial_affected.update(serial.apply_color_source(source))
+
+    batched = LocationModel.from_directory(surfaces_dir)
+    assert batched.apply_color_sources(sources) == serial_affected
+
+    parallel = LocationModel.from_directory(surfaces_dir)
+    assert parallel.apply_color_sources(sources, workers=2) == serial_affected
+    assert parallel.color_sources == set(sources)
+
+    for key in serial.arena.keys():
+        expected = serial.scene.geometry[key]
+        for model in [batched, parallel]:
+            surface = model.scene.geometry[key]
+            assert surface.metadata['color_sources'] == expected.metadata['color_sources']
+            assert np.allclose(model.color_accumulators[key][1], serial.color_accumulators[key][1])
+            assert np.all(np.abs(surface.visual.vertex_colors.astype(int) - expected.visual.vertex_colors) <= 1)
+
+    # Sources which were already applied are skipped.
+    assert len(parallel.apply_color_sources(sources, workers=2)) == 0
+
+    # The accumulators survive saving and loading the model store.
+    store_dir = tmp_path / "model_store"
+    serial.save_store(store_dir)
+    other = LocationModel.from_store(store_dir)
+    assert other.color_accumulators.keys() == serial.color_accumulators.keys()
+    for key, (color_sums, weights) in serial.color_accumulators.items():
+        assert np.array_equal(other.color_accumulators[key][0], color_sums)
+        assert np.array_equal(other.color_accumulators[key][1], weights)
+
+
+def test_reproject_replaced_surface(tmp_path, monkeypatch):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    surface_ids = make_surfaces(surfaces_dir)
+    sources = make_color_sources(tmp_path)
+
+    model = LocationModel.from_directory(surfaces_dir)
+    model.apply_color_sources(sources)
+    keys = model.arena.keys()
+    assert all(len(model.color_hits[source]) > 0 for source in sources[:3])
+
+    # Modify the first surface, so that it is loaded again.
+    mesh = trimesh.creation.box(extents=[2, 2, 2]).subdivide().subdivide()
+    mesh.apply_translation([0, 0, 5])
+    path = surfaces_dir / (surface_ids[0] + ".ply")
+    mesh.export(path)
+    os.utime(path, (model.mtime + 10, model.mtime + 10))
+
+    replaced = str(normalized_uuid(surface_ids[0]))
+    unchanged = {key: model.scene.geometry[key].visual.vertex_colors.copy() for key in keys if key != replaced}
+
+    # Only the replacement surface should be ray cast against.
+    def fail(*args, **kwargs):
+        raise AssertionError("unexpected full projection")
+    monkeypatch.setattr("server.mapping2.scene.project_color_sources", fail)
+
+    updated = model.update_from_directory(str(surfaces_dir))
+    assert updated == {normalized_uuid(surface_ids[0])}
+
+    for key, colors in unchanged.items():
+        assert np.array_equal(model.scene.geometry[key].visual.vertex_colors, colors)
+    assert len(model.scene.geometry[replaced].metadata['color_sources']) > 0
+
+    # The result should match coloring the new geometry from scratch.
+    monkeypatch.undo()
+    reference = LocationModel.from_directory(surfaces_dir)
+    reference.apply_color_sources(sources)
+    for key in keys:
+        surface = model.scene.geometry[key]
+        expected = reference.scene.geometry[key]
+        assert surface.metadata['color_sources'] == expected.metadata['color_sources']
+        assert np.all(np.abs(surface.visual.vertex_colors.astype(int) - expected.visual.vertex_colors) <= 1)
+
+    # The cached hits survive saving and loading the model store.
+    store_dir = tmp_path / "model_store"
+    model.save_store(store_dir)
+    other = LocationModel.from_store(store_dir)
+    assert other.color_hits.keys() == model.color_hits.keys()
+    for source, source_hits in model.color_hits.items():
+        assert other.color_hits[source].keys() == source_hits.keys()
+        for key, (rays, distances) in source_hits.items():
+            assert np.array_equal(other.color_hits[source][key][0], rays)
+            assert np.array_equal(other.color_hits[source][key][1], distances)
+
+
+def test_export_obj_fragments(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+    model.apply_color_sources(make_color_sources(tmp_path))
+
+    expected_path = str(tmp_path / "expected.obj")
+    model.export_obj(expected_path, include_color=True)
+
+    output_path = str(tmp_path / "colored.obj")
+    model.export_obj(output_path, include_color=True, fragment_dir=str(tmp_path / "fragments"))
+
+    expected = trimesh.load(expected_path, group_material=False, process=False).dump()
+    loaded = trimesh.load(output_path, group_material=False, process=False).dump()
+    assert len(loaded) == len(expected)
+    for mesh, other in zip(loaded, expected):
+        assert mesh.metadata['name'] == other.metadata['name']
+        assert np.array_equal(mesh.vertices, other.vertices)
+        assert np.array_equal(mesh.faces, other.faces)
+        assert np.array_equal(mesh.visual.vertex_colors, other.visual.vertex_colors)
+
+
+def test_export_glb(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+    model.apply_color_sources(make_color_sources(tmp_path))
+
+    path = str(tmp_path / "colored.glb")
+    model.export_glb(path, include_color=True)
+
+    loaded = trimesh.load(path, process=False)
+    assert sorted(loaded.geometry.keys()) == sorted(model.arena.keys())
+    for key in model.arena.keys():
+        surface = model.scene.geometry[key]
+        mesh = loaded.geometry[key]
+        assert np.allclose(mesh.vertices, surface.vertices, atol=1e-6)
+        assert np.array_equal(mesh.faces, surface.faces)
+        assert np.array_equal(mesh.visual.vertex_colors, surface.visual.vertex_colors)
+
+    # The cached parts produce the same model, and are reused.
+    part_dir = tmp_path / "glb_parts"
+    cached_path = str(tmp_path / "cached.glb")
+    model.export_glb(cached_path, include_color=True, part_dir=str(part_dir))
+    parts = {fname: os.path.getmtime(part_dir / fname) for fname in os.listdir(part_dir)}
+    assert len(parts) == len(model.arena.keys())
+
+    loaded = trimesh.load(cached_path, process=False)
+    assert sorted(loaded.geometry.keys()) == sorted(model.arena.keys())
+    for key in model.arena.keys():
+        surface = model.scene.geometry[key]
+        mesh = loaded.geometry[key]
+        assert np.allclose(mesh.vertices, surface.vertices, atol=1e-6)
+        assert np.array_equal(mesh.faces, surface.faces)
+        assert np.array_equal(mesh.visual.vertex_colors, surface.visual.vertex_colors)
+
+    model.export_glb(cached_path, include_color=True, part_dir=str(part_dir))
+    assert {fname: os.path.getmtime(part_dir / fname) for fname in os.listdir(part_dir)} == parts
+
+
+def test_record_changes(tmp_path):
+    surfaces_dir = tmp_path / "surfaces"
+    surfaces_dir.mkdir()
+    surface_ids = make_surfaces(surfaces_dir)
+
+    model = LocationModel.from_directory(surfaces_dir)
+    keys = model.arena.keys()
+
+    # Every surface is new in the first version, which starts after the
+    # version the caller knows about.
+    assert model.record_changes(model.surface_ids, base_version=4) == 5
+    assert model.tracked_since == 5
+    assert model.surface_versions == {key: 5 for key in keys}
+
+    # Replace one surface with another, and recolor a second one.
+    replaced = str(normalized_uuid(surface_ids[0]))
+    replacement = model.scene.geometry[replaced].copy()
+    replacement.metadata['name'] = str(normalized_uuid("{:032x}".format(99)))
+    model.replace_surface(replaced, replacement)
+
+    recolored = str(normalized_uuid(surface_ids[1]))
+    assert model.record_changes([replacement.metadata['name'], recolored], base_version=5) == 6
+    assert model.surface_versions[replacement.metadata['name']] == 6
+    assert model.surface_versions[recolored] == 6
+    assert model.surface_versions[str(normalized_uuid(surface_ids[2]))] == 5
+    assert model.removed_surfaces == {replaced: 6}
+
+    # The versions survive saving and loading the model store.
+    store_dir = tmp_path / "model_store"
+    model.save_store(store_dir)
+    other = LocationModel.from_store(store_dir)
+    assert other.version == 6
+    assert other.tracked_since == 5
+    assert other.surface_versions == model.surface_versions
+    assert other.removed_surfaces == model.removed_surfaces
+
+    path = tmp_path / "surface_versions.json"
+    other.export_surface_versions(str(path))
+    assert json.loads(path.read_text())['removed'] == {replaced: 6}
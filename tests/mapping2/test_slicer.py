@@ -0,0 +1,32 @@
+import numpy as np
+import trimesh
+
+from server.mapping2.slicer import slice_heights
+
+
+def test_slice_heights_matches_mesh_plane():
+    rng = np.random.default_rng(0)
+
+    # Vertices on a coarse grid, so that many vertices and edges lie exactly
+    # on the slicing planes and every intersection case is exercised.
+    vertices = rng.integers(0, 5, size=(60, 3)) * 0.5
+    faces = rng.integers(0, 60, size=(200, 3))
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+    heights = [1.0, 0.25, 1.0, 2.0, -3.0]
+    lines, line_faces = slice_heights(vertices, faces, heights, return_faces=True)
+    assert len(lines) == len(heights)
+
+    for height, segments, segment_faces in zip(heights, lines, line_faces):
+        expected, expected_faces = trimesh.intersections.mesh_plane(mesh, [0, 1, 0], [0, height, 0], return_faces=True)
+
+        # mesh_plane groups segments by case, whereas ours are in face order.
+        order = np.argsort(expected_faces, kind='stable')
+        assert np.array_equal(segment_faces, expected_faces[order])
+        assert np.allclose(segments, expected[order])
+
+
+def test_slice_heights_empty():
+    lines = slice_heights(np.zeros((0, 3)), np.zeros((0, 3), dtype=int), [0.0, 1.0])
+    assert [x.shape for x in lines] == [(0, 2, 3), (0, 2, 3)]
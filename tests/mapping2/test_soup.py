@@ -0,0 +1,136 @@
+import numpy as np
+import trimesh
+
+from server.mapping2.soup import MeshSoup, walkable_threshold
+
+
+def make_soup():
+    """
+    Create a soup with two flat floor tiles side by side along the x-axis.
+    """
+    meshes = []
+    for i in range(2):
+        mesh = trimesh.creation.box(extents=[2, 0.1, 2]).subdivide()
+        mesh.apply_translation([2 * i, 0, 0])
+        meshes.append(mesh)
+    return MeshSoup.from_meshes(meshes)
+
+
+def reference_add_trace(soup, points):
+    """
+    Trace transitions with the original per-pair loop.
+    """
+    directions = np.tile(soup.down, [len(points), 1])
+    locations, index_ray, index_tri = soup.mesh.ray.intersects_location(ray_origins=points, ray_directions=directions, multiple_hits=False)
+
+    sorted_rays = np.argsort(index_ray)
+    for i in range(len(sorted_rays) - 1):
+        u = sorted_rays[i]
+        v = sorted_rays[i+1]
+        if index_tri[u] == index_tri[v]:
+            continue
+        if np.linalg.norm(locations[u] - locations[v]) > 2:
+            continue
+        soup.observed_transition(index_tri[u], index_tri[v])
+
+
+def reference_split_mesh(mesh):
+    """
+    Split a mesh into bodies with a per-pair loop.
+    """
+    edges = []
+    for a, b in mesh.face_adjacency:
+        if mesh.face_normals[a, 1] >= walkable_threshold and mesh.face_normals[b, 1] >= walkable_threshold:
+            edges.append([a, b])
+
+    return trimesh.graph.connected_components(edges=edges, nodes=np.arange(len(mesh.faces)), min_len=1, engine='networkx')
+
+
+def test_split_mesh():
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    components, body_id = MeshSoup.split_mesh(mesh)
+
+    expected = reference_split_mesh(mesh)
+    assert len(components) == len(expected)
+    assert set(frozenset(x) for x in components) == set(frozenset(x) for x in expected)
+    for i, faces in enumerate(components):
+        assert np.all(body_id[faces] == i)
+
+    # Steep faces are not joined to the walkable faces next to them.
+    steep = np.flatnonzero((mesh.face_normals[:, 1] > 0) & (mesh.face_normals[:, 1] < walkable_threshold))
+    assert len(steep) > 0
+    assert all(len(components[body_id[face]]) == 1 for face in steep)
+
+
+def test_face_local_to_global_index():
+    soup = make_soup()
+
+    num_faces = len(soup.chunks[0].mesh.faces)
+    assert soup.face_local_to_global_index(0, 5) == 5
+    assert soup.face_local_to_global_index(1, 5) == num_faces + 5
+    assert len(soup.face_component) == len(soup.mesh.faces)
+
+
+def test_add_trace():
+    points = np.column_stack((np.linspace(-0.5, 2.5, 40), np.ones(40), np.linspace(-0.5, 0.5, 40)))
+
+    soup = make_soup()
+    soup.add_trace(None, points, apply_cylinder=True)
+
+    expected = make_soup()
+    reference_add_trace(expected, points)
+
+    assert len(soup.component_graph.edges) > 0
+    assert set(map(frozenset, soup.component_graph.edges)) == set(map(frozenset, expected.component_graph.edges))
+
+    # Crossing from one tile to the other must link their top components.
+    chunks = set(a[0] for edge in soup.component_graph.edges for a in edge)
+    assert chunks == {0, 1}
+
+    assert len(soup.visited) > 0
+    assert soup.visited_chunks == {0, 1}
+    assert len(soup.touched) > 0
+
+
+def reference_closest_points_on_boundary(soup, source, target):
+    closest_indices = set()
+    closest_dist = np.inf
+
+    source_boundary = soup.find_boundary_edges(source)
+    target_boundary = soup.find_boundary_edges(target)
+    target_vertices = 0.5 * (soup.mesh.vertices[target_boundary[:, 0]] + soup.mesh.vertices[target_boundary[:, 1]])
+
+    for i in range(len(source_boundary)):
+        v = soup.mesh.vertices[source_boundary[i, 0], :]
+        distances = np.linalg.norm(v - target_vertices, axis=1)
+        min_ind = np.argmin(distances)
+        closest_indices.add(min_ind)
+        closest_dist = min(closest_dist, distances[min_ind])
+
+    return closest_dist, target_boundary[sorted(closest_indices), :]
+
+
+def make_plates():
+    """
+    Create a soup with two flat plates separated by a small gap.
+    """
+    meshes = []
+    for i in range(2):
+        mesh = trimesh.Trimesh(vertices=[[0, 0, 0], [0, 0, 1], [1, 0, 1], [1, 0, 0]], faces=[[0, 1, 2], [0, 2, 3]]).subdivide()
+        mesh.apply_translation([1.5 * i, 0, 0])
+        meshes.append(mesh)
+    return MeshSoup.from_meshes(meshes)
+
+
+def test_closest_points_on_boundary():
+    soup = make_plates()
+    assert len(soup.components) == 2
+
+    dist, edges = soup.closest_points_on_boundary(0, 1)
+    expected_dist, expected_edges = reference_closest_points_on_boundary(soup, 0, 1)
+    assert np.isclose(dist, expected_dist)
+    assert np.array_equal(edges, expected_edges)
+
+    links = soup.find_boundary_links(max_distance=1.0)
+    assert sorted((a, b) for a, b, _, _ in links) == [(0, 1), (1, 0)]
+    assert soup.find_boundary_links(max_distance=0.1) == []
@@ -0,0 +1,51 @@
+import pickle
+
+import numpy as np
+
+from server.mapping2.spatial import BoundingBoxIndex
+
+
+def test_compute_max_iou():
+    index = BoundingBoxIndex()
+    assert index.compute_max_iou([[0, 0, 0], [1, 1, 1]]) == (0, None)
+
+    index.insert("a", [[0, 0, 0], [2, 2, 2]])
+    index.insert("b", [[1, 0, 0], [3, 2, 2]])
+    index.insert("c", [[10, 0, 0], [11, 1, 1]])
+
+    assert sorted(index.intersection([[0.5, 0.5, 0.5], [1.5, 1.5, 1.5]])) == ["a", "b"]
+
+    iou, key = index.compute_max_iou([[0, 0, 0], [2, 2, 2]])
+    assert key == "a"
+    assert np.isclose(iou, 1.0)
+
+    iou, key = index.compute_max_iou([[1.5, 0, 0], [3, 2, 2]])
+    assert key == "b"
+    assert np.isclose(iou, 0.75)
+
+    assert index.compute_max_iou([[5, 5, 5], [6, 6, 6]]) == (0, None)
+
+
+def test_insert_and_remove():
+    index = BoundingBoxIndex()
+    index.insert("a", [[0, 0, 0], [1, 1, 1]])
+    index.insert("a", [[5, 5, 5], [6, 6, 6]])
+    assert len(index) == 1
+    assert index.intersection([[0, 0, 0], [1, 1, 1]]) == []
+    assert index.intersection([[5, 5, 5], [6, 6, 6]]) == ["a"]
+
+    index.remove("a")
+    assert "a" not in index
+    assert index.intersection([[5, 5, 5], [6, 6, 6]]) == []
+
+
+def test_pickle():
+    index = BoundingBoxIndex()
+    index.insert("a", [[0, 0, 0], [1, 1, 1]])
+    index.insert("b", [[2, 2, 2], [3, 3, 3]])
+
+    other = pickle.loads(pickle.dumps(index))
+    assert sorted(other.intersection([[0.5, 0.5, 0.5], [2.5, 2.5, 2.5]])) == ["a", "b"]
+
+    other.insert("c", [[0, 0, 0], [1, 1, 1]])
+    assert sorted(other.intersection([[0, 0, 0], [1, 1, 1]])) == ["a", "c"]
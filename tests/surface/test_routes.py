@@ -1,4 +1,6 @@
+import json
 import os
+import shutil
 import uuid
 
 from http import HTTPStatus
@@ -248,3 +250,67 @@ async def test_clear_surfaces():
         # Clean up
         response = await client.delete('/locations/{}'.format(location['id']))
         assert response.status_code == HTTPStatus.OK
+
+
+@pytest.mark.asyncio
+async def test_surface_changes():
+    """
+    Test listing surface changes since a model version
+    """
+    changed_id = str(uuid.uuid4())
+    unchanged_id = str(uuid.uuid4())
+    removed_id = str(uuid.uuid4())
+
+    async with app.test_client() as client:
+        # Create a test location
+        response = await client.post("/locations", json=dict(name="Surface Test"))
+        assert response.status_code == HTTPStatus.CREATED
+        assert response.is_json
+        location = await response.get_json()
+
+        changes_url = "/locations/{}/surfaces/changes".format(location['id'])
+
+        # Without a colored model, the client must load the full model.
+        response = await client.get(changes_url + "?since=0")
+        assert response.status_code == HTTPStatus.OK
+        changes = await response.get_json()
+        assert changes['reset']
+        assert changes['changed'] == []
+
+        response = await client.get(changes_url)
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+        location_dir = os.path.join(app.config.get('VIZAR_DATA_DIR', 'data'), 'locations', location['id'].replace('-', ''))
+        os.makedirs(location_dir, exist_ok=True)
+        with open(os.path.join(location_dir, "surface_versions.json"), "w") as output:
+            json.dump({
+                "version": 3,
+                "tracked_since": 1,
+                "surfaces": {changed_id: 3, unchanged_id: 1},
+                "removed": {removed_id: 2}
+            }, output)
+
+        response = await client.get(changes_url + "?since=1")
+        assert response.status_code == HTTPStatus.OK
+        changes = await response.get_json()
+        assert changes['model_version'] == 3
+        assert not changes['reset']
+        assert [x['id'] for x in changes['changed']] == [changed_id]
+        assert changes['changed'][0]['fileUrl'].endswith("/surfaces/{}/surface.obj".format(changed_id))
+        assert [x['id'] for x in changes['removed']] == [removed_id]
+
+        response = await client.get(changes_url + "?since=2")
+        changes = await response.get_json()
+        assert [x['id'] for x in changes['changed']] == [changed_id]
+        assert changes['removed'] == []
+
+        response = await client.get(changes_url + "?since=0")
+        changes = await response.get_json()
+        assert changes['reset']
+        assert len(changes['changed']) == 2
+
+        shutil.rmtree(location_dir)
+
+        # Clean up
+        response = await client.delete('/locations/{}'.format(location['id']))
+        assert response.status_code == HTTPStatus.OK